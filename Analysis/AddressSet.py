@@ -0,0 +1,173 @@
+"""A compact, memory-mapped set of Ethereum addresses."""
+
+import os
+import numpy as np
+
+ADDRESS_DTYPE = np.dtype("S20")
+
+
+class AddressSet(object):
+    """
+    A set of addresses stored as sorted 20-byte records in a mapped file.
+
+    Description:
+    ------------
+    The set lives in two files:
+
+        path        sorted, unique 20-byte addresses
+        path.log    addresses added since, in the order they were saved
+
+    Opening the set maps the sorted file (nothing is read up front) and
+    loads the log, which is kept small. Lookups are a binary search of the
+    sorted file plus a check of the log. save() only appends the addresses
+    added since the last save to the log; once the log holds more than
+    compact_ratio times the sorted file (and at least min_compact
+    addresses), both are merged into a new sorted file.
+
+    Addresses are hex strings ("0x..." as geth returns them). Lookups of
+    anything that is not an address (e.g. None) are simply not found.
+
+    Parameters:
+    -----------
+    path <str>                          # The sorted file
+    load <bool> default True            # Open the saved set; with False the
+                                        # set starts empty and replaces the
+                                        # files on the first save()
+    compact_ratio <float> default 0.1
+    min_compact <int> default 100000
+
+    Usage:
+    ------
+        contracts = AddressSet("contracts.addresses")
+        contracts.add("0x...")
+        "0x..." in contracts
+        contracts.save()
+    """
+
+    def __init__(self, path, load=True, compact_ratio=0.1, min_compact=100000):
+        """Open (or start) the set."""
+        self.path = path
+        self.log_path = "{}.log".format(path)
+        self.compact_ratio = compact_ratio
+        self.min_compact = min_compact
+        # Replace the files on the next save instead of appending
+        self._reset = not load
+        self._base = np.zeros(0, dtype=ADDRESS_DTYPE)
+        # Saved to the log, but not yet merged into the sorted file
+        self._log = set()
+        # Added since the last save
+        self._new = set()
+        if load:
+            self._open()
+
+    # PRIVATE
+
+    def _open(self):
+        """Map the sorted file and read the log."""
+        self._base = np.zeros(0, dtype=ADDRESS_DTYPE)
+        if os.path.isfile(self.path):
+            n = os.path.getsize(self.path) // ADDRESS_DTYPE.itemsize
+            if n:
+                self._base = np.memmap(
+                    self.path, dtype=ADDRESS_DTYPE, mode="r", shape=(n,))
+        self._log = set()
+        if os.path.isfile(self.log_path):
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+            # A partially written record (e.g. after a crash) is dropped
+            n = len(data) // ADDRESS_DTYPE.itemsize * ADDRESS_DTYPE.itemsize
+            self._log = set(
+                data[i:i + ADDRESS_DTYPE.itemsize]
+                for i in range(0, n, ADDRESS_DTYPE.itemsize))
+            # Addresses the last merge got into the sorted file already
+            self._log = set(a for a in self._log if not self._inBase(a))
+
+    def _key(self, address):
+        """The 20 raw bytes of an address, or None if it is not one."""
+        try:
+            key = bytes.fromhex(address[2:])
+        except (TypeError, ValueError):
+            return None
+        return key if len(key) == ADDRESS_DTYPE.itemsize else None
+
+    def _inBase(self, key):
+        i = np.searchsorted(self._base, key)
+        # numpy drops trailing zero bytes from S20 values
+        return i < len(self._base) and \
+            self._base[i].ljust(ADDRESS_DTYPE.itemsize, b"\0") == key
+
+    def _write(self, path, data):
+        """Write bytes to path atomically."""
+        tmp = "{}.tmp".format(path)
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    # PUBLIC
+
+    def add(self, address):
+        """Add an address to the set."""
+        key = self._key(address)
+        if key is not None and key not in self:
+            self._new.add(key)
+
+    def __contains__(self, address):
+        key = address if isinstance(address, bytes) else self._key(address)
+        if key is None:
+            return False
+        return key in self._new or key in self._log or self._inBase(key)
+
+    def __getitem__(self, address):
+        """1 for members and 0 otherwise, like the old defaultdict(int)."""
+        return int(address in self)
+
+    def __len__(self):
+        return len(self._base) + len(self._log) + len(self._new)
+
+    def __iter__(self):
+        """Yield every address as a hex string."""
+        for key in self._base:
+            yield "0x" + key.ljust(ADDRESS_DTYPE.itemsize, b"\0").hex()
+        for key in list(self._log) + list(self._new):
+            yield "0x" + key.hex()
+
+    def keys(self):
+        """Every address as 20 raw bytes (a numpy S20 array)."""
+        return np.concatenate((
+            np.asarray(self._base),
+            np.array(sorted(self._log | self._new), dtype=ADDRESS_DTYPE)))
+
+    def save(self):
+        """Append the addresses added since the last save to the files."""
+        if self._reset:
+            # Write the whole set over whatever was saved before
+            self._reset = False
+            self.compact()
+            return
+        if self._new:
+            with open(self.log_path, "ab") as f:
+                # Drop a partial record left by a crash
+                f.truncate(f.tell() // ADDRESS_DTYPE.itemsize *
+                    ADDRESS_DTYPE.itemsize)
+                f.write(b"".join(sorted(self._new)))
+                f.flush()
+                os.fsync(f.fileno())
+            self._log.update(self._new)
+            self._new = set()
+        if len(self._log) > max(
+                self.compact_ratio * len(self._base), self.min_compact):
+            self.compact()
+
+    def compact(self):
+        """Merge the log into the sorted file."""
+        self._log.update(self._new)
+        self._new = set()
+        merged = np.union1d(
+            np.asarray(self._base),
+            np.array(sorted(self._log), dtype=ADDRESS_DTYPE))
+        self._write(self.path, merged.tobytes())
+        # The log is only cleared once the new sorted file is in place
+        self._write(self.log_path, b"")
+        self._open()
@@ -0,0 +1,210 @@
+"""A snapshot of a TxnGraph as memory-mapped CSR arrays."""
+
+import json
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.realpath(os.path.join(
+    os.path.dirname(__file__), "..", "Preprocessing", "Crawler")))
+from AddressTable import AddressTable
+
+MAGIC = b"TXNCSR01"
+VERSION = 1
+# Bytes before the first array (magic, header length and header)
+HEADER_SIZE = 4096
+# Arrays start on multiples of this many bytes
+ALIGN = 64
+# name --> dtype of every array a snapshot may hold
+ARRAYS = {
+    "offsets": np.dtype("<i8"),
+    "targets": np.dtype("<i4"),
+    "weights": np.dtype("<f8"),
+    "counts": np.dtype("<i8"),
+    "balances": np.dtype("<f8"),
+    "address_ids": np.dtype("<i4")
+}
+
+
+def write(path, arrays, **header):
+    """
+    Write a snapshot file.
+
+    Description:
+    ------------
+    The file is MAGIC, the length of the header (8 bytes, little endian)
+    and the header as JSON, padded to HEADER_SIZE bytes, followed by each
+    array, aligned to ALIGN bytes. The header records the dtype, length
+    and offset of every array along with the keyword arguments given. The
+    file is written to path.tmp first and moved into place, so a snapshot
+    is never seen half written.
+
+    Params:
+    -------
+    path <str>
+    arrays <dict>: name (one of ARRAYS) --> numpy array
+    header: anything JSON serializable (e.g. start_block=1)
+    """
+    arrays = {
+        name: np.ascontiguousarray(a, dtype=ARRAYS[name])
+        for name, a in arrays.items()
+    }
+    layout = dict()
+    start = HEADER_SIZE
+    for name, a in arrays.items():
+        layout[name] = {
+            "dtype": a.dtype.str, "length": len(a), "offset": start}
+        start += -(-a.nbytes // ALIGN) * ALIGN
+    data = json.dumps(dict(header, version=VERSION, arrays=layout)).encode()
+    assert len(MAGIC) + 8 + len(data) <= HEADER_SIZE, "Header is too large"
+
+    tmp = "{}.tmp".format(path)
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([len(data)], dtype="<u8").tobytes())
+        f.write(data)
+        for name, a in arrays.items():
+            f.seek(layout[name]["offset"])
+            f.write(a.tobytes())
+        f.truncate(start)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CSRSnapshot(object):
+    """
+    Read a TxnGraph snapshot without graph_tool.
+
+    Description:
+    ------------
+    A snapshot (see TxnGraph.exportCSR) holds the graph in compressed
+    sparse row form, i.e. the edges sorted by source vertex:
+
+        offsets      int64, n_vertices + 1: the edges of vertex v are
+                     offsets[v]:offsets[v + 1]
+        targets      int32, n_edges: the target vertex of each edge
+        weights      float64, n_edges: the value of each edge
+        counts       int64, n_edges: transactions per edge (collapsed
+                     graphs only)
+        balances     float64, n_vertices: the vertex weights
+        address_ids  int32, n_vertices: AddressTable ids (-1 for none)
+
+    Opening a snapshot reads the header and maps the arrays read-only, so
+    it takes constant time and nothing is copied until it is used. Edges of
+    one source keep the order they had in the graph.
+
+    Parameters:
+    -----------
+    path <str>
+    address_table <AddressTable> default None   # The table the ids are
+                                                # in; the one the graph
+                                                # used by default
+
+    Usage:
+    ------
+        s = CSRSnapshot("1_1000000.csr")
+        s.weights.sum()
+        targets, weights = s.outEdges(v)
+        g = s.toGraph()     # a graph_tool Graph, like TxnGraph.graph
+    """
+
+    def __init__(self, path, address_table=None):
+        """Read the header and map the arrays."""
+        self.path = path
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            assert magic == MAGIC, "{} is not a CSR snapshot".format(path)
+            size = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            self.header = json.loads(f.read(size).decode())
+        assert self.header["version"] <= VERSION, \
+            "Unsupported snapshot version {}".format(self.header["version"])
+
+        for name, a in self.header["arrays"].items():
+            setattr(self, name, self._map(a))
+        self.counts = getattr(self, "counts", None)
+
+        self.start_block = self.header.get("start_block")
+        self.end_block = self.header.get("end_block")
+        self.start_timestamp = self.header.get("start_timestamp")
+        self.end_timestamp = self.header.get("end_timestamp")
+        self._address_table = address_table
+
+    # PRIVATE
+
+    def _map(self, a):
+        if not a["length"]:
+            return np.zeros(0, dtype=a["dtype"])
+        return np.memmap(self.path, dtype=a["dtype"], mode="r",
+            shape=(a["length"],), offset=a["offset"])
+
+    # PUBLIC
+
+    @property
+    def address_table(self):
+        """The AddressTable of the graph (opened on first use)."""
+        if self._address_table is None:
+            self._address_table = AddressTable(self.header["address_table"])
+        return self._address_table
+
+    @property
+    def num_vertices(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    def sources(self):
+        """The source vertex of each edge."""
+        return np.repeat(
+            np.arange(self.num_vertices, dtype=np.int64),
+            np.diff(self.offsets))
+
+    def outDegree(self):
+        """The number of edges from each vertex."""
+        return np.diff(self.offsets)
+
+    def inDegree(self):
+        """The number of edges to each vertex."""
+        return np.bincount(self.targets, minlength=self.num_vertices)
+
+    def outEdges(self, v):
+        """The targets and weights of the edges from vertex v."""
+        a, b = self.offsets[v], self.offsets[v + 1]
+        return self.targets[a:b], self.weights[a:b]
+
+    def toGraph(self):
+        """
+        Build a graph_tool Graph from the snapshot.
+
+        Returns:
+        --------
+        <Graph> with the same PropertyMaps as TxnGraph.graph (edges are
+        ordered by source vertex)
+        """
+        from graph_tool.all import Graph
+
+        graph = Graph()
+        graph.add_vertex(self.num_vertices)
+        eprops = [graph.new_edge_property("double")]
+        graph.edge_properties["weight"] = eprops[0]
+        columns = [self.sources(), self.targets, self.weights]
+        if self.counts is not None:
+            eprops.append(graph.new_edge_property("int64_t"))
+            graph.edge_properties["count"] = eprops[1]
+            columns.append(self.counts)
+        if self.num_edges:
+            graph.add_edge_list(np.column_stack(columns), eprops=eprops)
+
+        weights = graph.new_vertex_property("double")
+        weights.a = self.balances
+        graph.vertex_properties["weight"] = weights
+        ids = graph.new_vertex_property("int32_t")
+        ids.a = self.address_ids
+        graph.vertex_properties["address_id"] = ids
+        addresses = graph.new_vertex_property("string")
+        for i, a in enumerate(self.address_table.addresses(self.address_ids)):
+            # Contract creations have no "to" address
+            addresses[graph.vertex(i)] = a or ""
+        graph.vertex_properties["address"] = addresses
+        return graph
@@ -1,13 +1,15 @@
-
 """Build a hash map of all contract addresses on the Ethereum network."""
 
-from collections import defaultdict
-import requests
-import json
+from AddressSet import AddressSet
+import numpy as np
 import pickle
 import os
-import time
+import sys
 import pymongo
+sys.path.append(os.path.realpath(os.path.join(
+    os.path.dirname(__file__), "..", "Preprocessing", "Crawler")))
+from RPCClient import RPCClient
+import crawler_util
 DIR = "."
 
 class ContractMap(object):
@@ -18,13 +20,26 @@ class ContractMap(object):
 
     - find(): searches all blocks after self.last_block and adds them
             to the table. Updates self.last_block
-    - save(): saves the object to a pickle file ".contracts.p"
-    - load(): loads the object from pickle file ".contracts.p"
+    - add(): adds addresses known to be contracts (e.g. from a Crawler
+            with discover_contracts=True)
+    - ids(): the ids of all contracts in an AddressTable (cached until
+            the addresses or the table change)
+    - save(): saves the object to ".contracts.p" (the last block) and the
+            address files next to it
+    - load(): loads the object from ".contracts.p"
 
     Attributes:
 
-    - addresses: defaultdict with default value of 0 for non-contracts and
-        values of 1 for contract addresses.
+    - addresses: AddressSet of contract addresses, saved as
+        ".contracts.p.addresses". addresses[a] is 1 for contracts and 0
+        otherwise (as with the defaultdict it replaces).
+    - eoas: AddressSet of addresses known to have no code, which are not
+        checked again (".contracts.p.eoas"). Entries never expire, so
+        contracts deployed later to such an address are only found
+        through add().
+
+    Address sets are memory-mapped, so loading a map takes constant time,
+    and save() only appends what was added since the last save.
 
     Usage:
 
@@ -38,21 +53,56 @@ class ContractMap(object):
     # ./contracts.p by default.
     cmap = ContractMap()
 
+    # With discover=True, contracts are taken from contract creation
+    # transactions (and their receipts) instead of calling eth_getCode on
+    # every recipient. Contracts created by other contracts are missed, and
+    # blocks must have been crawled by a Crawler that keeps the hash of
+    # creations (or with discover_contracts=True, which stores "creates").
+    cmap = ContractMap(mongo_client, discover=True)
+
+    # Or keep the map up to date as blocks are crawled:
+    crawler = Crawler(start=False, discover_contracts=True)
+    crawler.onContracts(cmap.add)
+
     """
 
     def __init__(self,
                 mongo_client=None,
                 last_block=0,
                 load=False,
-                filepath="{}/.contracts.p".format(DIR)):
+                filepath="{}/.contracts.p".format(DIR),
+                rpc=None,
+                ipc_path=None,
+                batch_size=100,
+                window_blocks=1000,
+                discover=False):
         """Initialize with a mongo client and an optional last block."""
         self.client = mongo_client
         self.last_block = last_block
         self.url = "http://localhost:8545"
-        self.headers = {"content-type": "application/json"}
+        # Share a Crawler's RPCClient if one is given. If ipc_path is
+        # given, talk to geth over its unix socket instead of HTTP.
+        self.rpc = rpc or RPCClient(self.url, ipc_path=ipc_path)
         self.filepath = filepath
+        # eth_getCode calls per JSON-RPC batch
+        self.batch_size = max(int(batch_size), 1)
+        # Blocks whose recipients are deduplicated before checking them
+        self.window_blocks = max(int(window_blocks), 1)
+        # Find contracts from creation transactions rather than eth_getCode
+        self.discover = discover
 
-        self.addresses = defaultdict(int)
+        self.addresses = AddressSet(
+            "{}.addresses".format(filepath), load=False)
+        # Addresses geth reported no code for (a negative cache). It is
+        # never expired: an address that gets code after it was checked
+        # (e.g. a contract deployed to an address that was sent ether
+        # first, or with CREATE2) stays out of self.addresses unless it is
+        # add()ed, e.g. by a Crawler with discover_contracts=True. Delete
+        # the .eoas files to check every address again.
+        self.eoas = AddressSet("{}.eoas".format(filepath), load=False)
+        # The last result of ids(), as ((table path, table size, number of
+        # addresses), ids)
+        self._ids = None
 
         if load:
             self.load()
@@ -71,21 +121,69 @@ class ContractMap(object):
 
     def _rpcRequest(self, method, params, key):
         """Make an RPC request to geth on port 8545."""
-        payload = {
-            "method": method,
-            "params": params,
-            "jsonrpc": "2.0",
-            "id": 0
-        }
+        # The RPCClient backs off on its own if geth gets overloaded
+        return self.rpc.request(method, params, key)
+
+    def _checkCode(self, candidates):
+        """
+        Ask geth for the code at each candidate address in batches.
 
-        res = requests.post(self.url,
-            data=json.dumps(payload),
-            headers=self.headers).json()
+        Addresses with code are added to self.addresses and the rest to
+        self.eoas. An address geth gave no answer for is left unknown so
+        it is checked again later.
+        """
+        candidates = list(candidates)
+        for i in range(0, len(candidates), self.batch_size):
+            chunk = candidates[i:i + self.batch_size]
+            codes = self.rpc.batch(
+                [("eth_getCode", [a, "latest"]) for a in chunk], "result")
+            for a, code in zip(chunk, codes):
+                if code is None:
+                    continue
+                if code != "0x":
+                    self.addresses.add(a)
+                else:
+                    self.eoas.add(a)
 
-        # Geth will sometimes crash if overloaded with requests
-        time.sleep(0.005)
+    def _checkCreations(self, hashes):
+        """Add the contracts created by transactions, from their receipts."""
+        self.add([
+            a for a in crawler_util.contractAddresses(
+                self.rpc, list(hashes), self.batch_size)
+            if a
+        ])
 
-        return res[key]
+    def _check(self, candidates):
+        """Check a window of candidate addresses (or creation hashes)."""
+        if self.discover:
+            self._checkCreations(candidates)
+        else:
+            self._checkCode(candidates)
+
+    def add(self, addresses):
+        """
+        Mark addresses as contracts.
+
+        An address may also be in self.eoas (e.g. if it was sent ether
+        before the contract was created); being a contract wins.
+        """
+        for a in addresses:
+            self.addresses.add(a)
+
+    def ids(self, table):
+        """
+        The ids of every contract in an AddressTable, sorted.
+
+        Contracts the table does not know are left out (and not added to
+        it); they are not in any graph using the table. The result is kept
+        until contracts are added or the table grows, so a map shared by
+        many snapshots only looks its addresses up once.
+        """
+        key = (os.path.realpath(table.path), len(table), len(self.addresses))
+        if self._ids is None or self._ids[0] != key:
+            ids = table.lookup(self.addresses.keys())
+            self._ids = (key, np.unique(ids[ids >= 0]))
+        return self._ids[1]
 
     def find(self):
         """
@@ -93,38 +191,57 @@ class ContractMap(object):
 
         Iterate through all blocks and search for new contract addresses.
         Append them to self.addresses if found.
+
+        The recipients of every window_blocks blocks are collected and
+        deduplicated first. Addresses already known to be contracts or
+        EOAs (self.eoas) are skipped, and the rest are checked with
+        batched eth_getCode calls. With self.discover, only contract
+        creations are looked at: their "creates" field if the crawler
+        stored one, or else their receipt (fetched in batches).
         """
         blocks = self.client.find(
             {"number": {"$gt": self.last_block}},
             sort=[("number", pymongo.ASCENDING)]
         )
         counter = 0
+        candidates = set()
+        # Blocks may be stored in the compact (binary) schema, or with
+        # their transactions only in the TxnIndex
+        blocks = crawler_util.readBlocks(
+            blocks, self.client.database, ["to", "creates", "hash"])
         for block in blocks:
-            if block["transactions"]:
-                # Loop through all of the transactions in the current block
-                # Add all the nodes to a global set (self.nodes)
-                for txn in block["transactions"]:
-                    if txn["to"] and not self.addresses[txn["to"]]:
-                        # Get the code at the "to" address.
-                        code = self._rpcRequest(
-                            "eth_getCode",
-                            [txn["to"], "latest"],
-                            "result")
-                        # Add addressees if there is non-empty data
-                        if code != "0x":
-                            self.addresses[txn["to"]] = 1
+            for txn in block["transactions"]:
+                to = txn["to"]
+                if self.discover:
+                    # Contract creations have no recipient
+                    if to is None and txn.get("creates"):
+                        self.add([txn["creates"]])
+                    elif to is None and "hash" in txn:
+                        candidates.add(txn["hash"])
+                elif to and to not in self.addresses and to not in self.eoas:
+                    candidates.add(to)
 
-            self.last_block = block["number"]
             counter += 1
+            if not counter % self.window_blocks:
+                self._check(candidates)
+                candidates = set()
+                self.last_block = block["number"]
             # Save the list every 10000 blocks in case geth crashes
             # midway through the procedure
             if not counter % 10000:
                 print("Done with block {}...".format(self.last_block))
                 self.save()
+        if counter:
+            self._check(candidates)
+            self.last_block = block["number"]
 
     def save(self):
-        """Pickle the object and save it to a file."""
-        state = (self.last_block, self.addresses)
+        """Save new addresses, then pickle the last block to a file."""
+        self.addresses.save()
+        self.eoas.save()
+        # The last block is written last so it never runs ahead of the
+        # addresses
+        state = (self.last_block,)
         pickle.dump(state, open(self.filepath, "wb"))
 
     def load(self):
@@ -132,5 +249,15 @@ class ContractMap(object):
         no_file = "Error loading ContractMap: No file exists in that path."
         assert os.path.isfile(self.filepath), no_file
         state = pickle.load(open(self.filepath, "rb"))
-        self.addresses = state[1]
         self.last_block = state[0]
+        self._ids = None
+        if len(state) > 1:
+            # An older map pickled in full; it is converted on save()
+            for a, is_contract in state[1].items():
+                if is_contract:
+                    self.addresses.add(a)
+            for a in (state[2] if len(state) > 2 else set()):
+                self.eoas.add(a)
+            return
+        self.addresses = AddressSet("{}.addresses".format(self.filepath))
+        self.eoas = AddressSet("{}.eoas".format(self.filepath))
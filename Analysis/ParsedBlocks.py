@@ -2,8 +2,10 @@
 
 import tags
 from ContractMap import ContractMap
+from CSRSnapshot import CSRSnapshot
 import os
 import csv
+import numpy as np
 import requests
 
 
@@ -41,12 +43,17 @@ class ParsedBlocks(object):
 
     Parameters:
     -----------
-    txn_graph: TxnGraph instance (with a prebuilt graph)
+    txn_graph: TxnGraph instance (with a prebuilt graph), or a CSRSnapshot
+        of one (which needs no graph_tool)
     run: boolean, optional. Calculate the data when instantiated.
+    contract_map: ContractMap, optional. Loaded from its file by default;
+        pass the same one when parsing many snapshots so its contract ids
+        are only looked up once.
 
     """
 
-    def __init__(self, txn_graph, run=True, csv_file="blockchain.csv"):
+    def __init__(self, txn_graph, run=True, csv_file="blockchain.csv",
+                contract_map=None):
         """Initialize the graph, address hash maps, and data fields."""
         self.txn_graph = txn_graph
         self.csv_file = csv_file
@@ -57,7 +64,12 @@ class ParsedBlocks(object):
         # 1: Exchanges, 2: Crowdsale contracts, 3: mining pools, 0: Other
         self.tags = tags.tags
         # 1: Contracts, 0: Other
-        self.contracts = ContractMap(load=True).addresses
+        if contract_map is None:
+            contract_map = ContractMap(load=True)
+        self.contracts = contract_map.addresses
+        # The same addresses, as ids in the graph's AddressTable
+        self.address_table = txn_graph.address_table
+        self.contract_ids = contract_map.ids(self.address_table)
 
         # Snapshot specific data:
         # ------------------------
@@ -147,67 +159,107 @@ class ParsedBlocks(object):
             return True
         return False
 
+    def _addressIds(self):
+        """The address id of each vertex in the graph (-1 for none)."""
+        if isinstance(self.txn_graph, CSRSnapshot):
+            return self.txn_graph.address_ids.astype(np.int64)
+        graph = self.txn_graph.graph
+        if "address_id" in graph.vertex_properties:
+            return graph.vertex_properties["address_id"].a.astype(np.int64)
+        # Graphs built before address ids were kept
+        address_prop = graph.vertex_properties["address"]
+        return self.address_table.intern([
+            address_prop[v] or None for v in graph.vertices()
+        ]).astype(np.int64)
+
+    def _edges(self):
+        """
+        The source, target, amount and transaction count of every edge.
+
+        In a collapsed graph an edge is every transaction between a pair of
+        addresses, with the total amount.
+        """
+        if isinstance(self.txn_graph, CSRSnapshot):
+            snapshot = self.txn_graph
+            amount = np.asarray(snapshot.weights)
+            count = np.asarray(snapshot.counts) \
+                if snapshot.counts is not None \
+                else np.ones(len(amount), dtype=np.int64)
+            return (snapshot.sources(), snapshot.targets.astype(np.int64),
+                amount, count)
+
+        graph = self.txn_graph.graph
+        edges = graph.get_edges([graph.edge_properties["weight"]])
+        # The edgeWeight of this edge is the amount of the transaction
+        amount = edges[:, 2]
+        if "count" in graph.edge_properties:
+            count = graph.get_edges(
+                [graph.edge_properties["count"]])[:, 2].astype(np.int64)
+        else:
+            count = np.ones(len(amount), dtype=np.int64)
+        return (edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64),
+            amount, count)
+
+    def _balances(self):
+        """The weight (balance) of each vertex."""
+        if isinstance(self.txn_graph, CSRSnapshot):
+            return np.asarray(self.txn_graph.balances)
+        return self.txn_graph.graph.vertex_properties["weight"].a
+
+    def _tagsOf(self, ids):
+        """The tag of each address id (0 if untagged)."""
+        # Tagged addresses the table does not know are in no graph
+        tag_ids = self.address_table.lookup(list(self.tags.keys()))
+        tag_values = np.array(list(self.tags.values()))[tag_ids >= 0]
+        tag_ids = tag_ids[tag_ids >= 0]
+        if not len(tag_ids):
+            return np.zeros(len(ids), dtype=tag_values.dtype)
+        order = np.argsort(tag_ids)
+        tag_ids, tag_values = tag_ids[order], tag_values[order]
+        pos = np.minimum(np.searchsorted(tag_ids, ids), len(tag_ids) - 1)
+        return np.where(tag_ids[pos] == ids, tag_values[pos], 0)
+
     # PUBLIC METHODS
 
     def parse(self):
-        """Iterate through the graph to calculate metrics of interest."""
+        """
+        Iterate through the graph to calculate metrics of interest.
+
+        Vertices are identified by their address ids, so every metric is
+        computed on arrays over all of the edges at once.
+        """
         if not self.headers:
             self._setHeaders()
 
-        vWeights = self.txn_graph.graph.vertex_properties["weight"]
-        eWeights = self.txn_graph.graph.edge_properties["weight"]
-
-        # A dictionary mapping vertex --> balance
-        balances = list()
-
-        # Iterate over vertices (i.e. addresses)
-        for v in self.txn_graph.graph.vertices():
-            if self._isPeer(v):
-                balances.append(vWeights[v])
-
-        # Iterates over a bunch of Edge instances (i.e. transactions)
-        address_prop = self.txn_graph.graph.vertex_properties["address"]
-
-        # All of the addresses encountered
-        address_dump = list()
-
-        for e in self.txn_graph.graph.edges():
-            to_addr = address_prop[e.target()]
-            from_addr = address_prop[e.source()]
-            address_dump.append(to_addr)
-            address_dump.append(from_addr)
-
-            amount = eWeights[e]
-            # The edgeWeight of this edge is the amount of the transaction
-            self.data["transaction_count"] += 1
-            self.data["transaction_sum"] += amount
-
-            # If the target/source of the txn is an exchange:
-            if self.tags[from_addr] == 1:
-                self.data["exchange_out_sum"] += amount
-                self.data["exchange_out_count"] += 1
-            elif self.tags[to_addr] == 1:
-                self.data["exchange_in_sum"] += amount
-                self.data["exchange_in_count"] += 1
-
-            # If the target is a crowdsale wallet:
-            if self.tags[to_addr] == 2:
-                self.data["crowdsale_txn_sum"] += amount
-                self.data["crowdsale_txn_count"] += 1
-
-            # If the target is a contract:
-            if self.contracts[to_addr]:
-                self.data["contract_txn_sum"] += amount
-                self.data["contract_txn_count"] += 1
-
-            # If source and target are both peer nodes
-            if self._isPeer(to_addr) and self._isPeer(from_addr):
-                self.data["p2p_txn_sum"] += amount
-                self.data["p2p_txn_count"] += 1
+        # Per vertex (i.e. address)
+        ids = self._addressIds()
+        contract = np.isin(ids, self.contract_ids)
+        tag = self._tagsOf(ids)
+        peer = ~contract & (tag == 0)
+        balances = self._balances()[peer]
+
+        # Per edge (i.e. transaction): source, target, amount and count
+        src, dst, amount, count = self._edges()
+
+        def add(name, mask):
+            self.data[name + "_sum"] += float(amount[mask].sum())
+            self.data[name + "_count"] += int(count[mask].sum())
+
+        add("transaction", np.ones(len(amount), dtype=bool))
+        # If the target/source of the txn is an exchange:
+        exchange_out = tag[src] == 1
+        add("exchange_out", exchange_out)
+        add("exchange_in", ~exchange_out & (tag[dst] == 1))
+        # If the target is a crowdsale wallet:
+        add("crowdsale_txn", tag[dst] == 2)
+        # If the target is a contract:
+        add("contract_txn", contract[dst])
+        # If source and target are both peer nodes
+        add("p2p_txn", peer[dst] & peer[src])
 
         # Record all unique addresses up to this point
-        addr_set = set(address_dump)
-        self.data["num_addr"] = len(addr_set)
+        self.data["num_addr"] = len(np.unique(
+            ids[np.concatenate((src, dst))]))
 
     def saveData(self):
         """Save the data to a line in the CSV file."""
@@ -4,14 +4,36 @@ import six.moves.cPickle as pickle
 from graph_tool.all import *
 import pymongo
 import os
+import sys
 import subprocess
 import signal
 import copy
+import hashlib
+import uuid
+import numpy as np
 from tags import tags
 import analysis_util
+sys.path.append(os.path.realpath(os.path.join(
+    os.path.dirname(__file__), "..", "Preprocessing", "Crawler")))
+import crawler_util
+from AddressTable import AddressTable
+import CSRSnapshot
 env = analysis_util.set_env()
 DIR = env["mongo"] + "/data"
 DATADIR = env["txn_data"]
+# The id of the empty graph at the start block (see _stateId)
+ROOT_ID = "0"*16
+
+
+def _stateId(parent, end):
+    """
+    The id of the state reached by adding the blocks up to end to the
+    state with id parent.
+
+    Blocks are read from (start, end), so a state depends on every end
+    block on the way to it, not just the last one; ids chain them all.
+    """
+    return hashlib.sha1("{}:{}".format(parent, end).encode()).hexdigest()[:16]
 
 class TxnGraph(object):
     """
@@ -35,6 +57,20 @@ class TxnGraph(object):
     snap <bool> (default=True)     # Build the graph upon instantiation.
     save <bool> (default=True)     # Save the graph automatically
     load <bool> (default=False)    # Skip building the graph and load a
+    address_table <AddressTable>   # Interns addresses as int ids; the
+                                   # shared table at DEFAULT_PATH by default
+    collapse <bool> (default=False)  # Keep one edge per (from, to) pair,
+                                   # weighted by the total value, with the
+                                   # number of transactions in the "count"
+                                   # edge property
+    resume <bool> (default=False)  # Start from the latest checkpoint at or
+                                   # before end_block and only add the
+                                   # blocks after it
+    compact_every <int> (default=100)  # Write a full base snapshot after
+                                   # this many checkpoint deltas
+    overwrite <bool> (default=False)  # Delete the existing checkpoints of
+                                   # start_block before checkpointing a
+                                   # new build
 
 
     Usage:
@@ -43,6 +79,12 @@ class TxnGraph(object):
 
         g = TxnGraph(previous={graph: <Graph>, end_block: <int>})
 
+    Keep one edge per pair of addresses (total flow and transaction count)
+    instead of one per transaction:
+
+        g = TxnGraph(a, b, collapse=True)
+        g.graph.edge_properties["count"]
+
     Draw the image (saved by default to DATADIR/snapshots/a_b.png,
     where a=start_block, b=end_block):
 
@@ -52,10 +94,53 @@ class TxnGraph(object):
 
         g.save()
 
-    Load a graph with start_block=a, end_block=b from DATADIR if it exists:
+    Load a graph with start_block=a, end_block=b from DATADIR if it exists
+    (either saved with save() or rebuilt from checkpoints):
 
         g.load(a, b)
 
+    Export the graph as memory-mapped arrays (DATADIR/csr/a_b.csr), which
+    can be read without graph_tool (see CSRSnapshot):
+
+        g.exportCSR()
+        s = CSRSnapshot.CSRSnapshot(g.f_csr)
+
+    Checkpoints:
+    ------------
+    A new graph and every extend() are checkpointed (with save=True) as
+    append-only deltas rather than by rewriting the whole graph. The deltas
+    of graphs starting at block a are kept in DATADIR/checkpoints/a/ (or
+    a_collapsed/ with collapse=True):
+
+        delta_x_y_p_c.npz  the vertices and edges added going from end
+                           block x (state p) to end block y (state c)
+        base_y_c.gt/.p     a full snapshot of state c at end block y,
+                           written after every compact_every deltas (older
+                           ones are removed)
+
+    Since blocks are read from (start, end), the state at a block depends
+    on every end block on the way to it (e.g. 1 --> 1000 --> 2000 leaves
+    out block 1000, but 1 --> 2000 does not). The ids p and c chain those
+    end blocks, so a delta is only ever applied to the state it was built
+    on. Any state is rebuilt from the closest base (or the empty graph)
+    plus the deltas that lead from it, wherever they came from. To pick up where a previous run stopped (e.g. after a
+    crash) and continue to block b:
+
+        g = TxnGraph(1, b, resume=True)
+
+    If blocks from f on were rewritten (a chain reorganization), go back to
+    the last checkpoint before f and build forward again:
+
+        end = g.end_block
+        g.rewind(f)
+        while g.end_block < end:
+            g.extend(n)     # the same steps of n blocks as before
+
+    Building a graph from scratch adds its own delta next to any existing
+    ones rather than replacing them (pass overwrite=True to delete them
+    first). Deltas hold address ids, so every graph sharing checkpoints
+    must use the same AddressTable.
+
     """
 
     # PRIVATE
@@ -66,18 +151,31 @@ class TxnGraph(object):
                 save=True,
                 load=False,
                 previous=None,
+                address_table=None,
+                collapse=False,
+                resume=False,
+                compact_every=100,
+                overwrite=False,
                 **kwargs):
 
         self.f_pickle = None
         self.f_snapshot = None
+        self.f_csr = None
         self.start_block = max(args[0] if len(args) > 0 else 1, 1)
         self.end_block = args[1] if len(args) > 1 else 2
 
         self.start_timestamp = None
         self.end_timestamp = None
 
-        # A lookup table mapping ethereum address --> graph node
-        self.nodes = dict()
+        # Address ids (from the shared AddressTable) are used instead of
+        # hex strings wherever possible
+        self.address_table = address_table if address_table is not None \
+            else AddressTable()
+        # Address id + 1 --> graph vertex index (-1 if not in the graph).
+        # Slot 0 is "no address" (the "to" of a contract creation). It is
+        # not saved, but rebuilt from addressIds when a graph is loaded.
+        self.vertex_map = np.full(1, -1, dtype=np.int32)
+        # Unused; edges are added in bulk and no longer kept one by one
         self.edges = list()
         # A graph_tool Graph object
         self.graph = None
@@ -85,19 +183,40 @@ class TxnGraph(object):
         self.f_graph = None
         # PropertyMap of edges weighted by eth value of transaction
         self.edgeWeights = None
+        # With collapse, each edge is a (from, to) pair of vertices. The
+        # weight is the total value sent and edgeCounts (a PropertyMap)
+        # the number of transactions. pairs holds the sorted pair keys
+        # (from << 32 | to) and pairEdges the edge index of each.
+        self.collapse = collapse
+        self.edgeCounts = None
+        self.pairs = np.zeros(0, dtype=np.int64)
+        self.pairEdges = np.zeros(0, dtype=np.int64)
         # PropertyMap of vertices weighted by eth value they hold
         # at the time of the end_block.
         self.vertexWeights = None
         # All addresses (each node has an address)
         self.addresses = None
+        # PropertyMap of the address id of each vertex (-1 for none)
+        self.addressIds = None
         # Record big exchange addresses
         self.exchanges = list()
         # Record all contracts
         self.contracts = list()
+        # Changes made since the last checkpoint, one tuple of arrays (as
+        # returned by _readBlocks) per call to _addBlocks
+        self._pending = list()
+        # The end block of the last checkpoint (None if the graph did not
+        # come from checkpoints, e.g. a previous graph)
+        self._saved_end = self.start_block
+        # The id of the current state and of the last checkpointed one
+        self._state_id = ROOT_ID
+        self._saved_id = ROOT_ID
+        self.compact_every = max(int(compact_every), 1)
+        self._deltas_since_base = 0
         # Run
-        self._init(snap, save, load, previous)
+        self._init(snap, save, load, previous, resume, overwrite)
 
-    def _init(self, snap, save, load, previous):
+    def _init(self, snap, save, load, previous, resume, overwrite):
         self.graph = Graph()
 
         # Accept a previous graph as an argument
@@ -107,6 +226,9 @@ class TxnGraph(object):
             self.graph = previous["graph"]
             assert "end_block" in previous, a_str
             self.start_block = previous["end_block"]
+            self._saved_end = None
+            # Nothing else can be built on a graph of unknown origin
+            self._state_id = uuid.uuid4().hex[:16]
 
         # Set filepaths
         self._setFilePaths()
@@ -115,25 +237,37 @@ class TxnGraph(object):
         if load:
             self.load(self.start_block, self.end_block)
 
+        # Continue from the latest checkpoint
+        elif resume:
+            end = self.end_block
+            self._restore(self.start_block, end, exact=False)
+            if self.end_block < end:
+                self.extend(end - self.end_block, save=save)
+
         else:
             # Take a snapshot
             if snap:
                 self.snap()
 
-            # Save this graph automatically
+            # Checkpoint this graph automatically. The new delta only adds
+            # a path to the existing checkpoints unless told to replace
+            # them.
             if save:
-                self.save()
+                if overwrite:
+                    self._clearCheckpoints()
+                self.checkpoint()
 
     def _setFilePaths(self, start=None, end=None):
         """Set the file paths based on the start/end block numbers."""
         if not start:
             start = self.start_block
         if not end:
-            start = self.end_block
+            end = self.end_block
 
         self.f_pickle = "{}/pickles/{}_{}.p".format(DATADIR, start, end)
         self.f_graph = "{}/graphs/{}_{}.gt".format(DATADIR, start, end)
         self.f_snapshot = "{}/snapshots/{}_{}.png".format(DATADIR, start, end)
+        self.f_csr = "{}/csr/{}_{}.csr".format(DATADIR, start, end)
 
     def _getMongoClient(self):
         """Connect to a mongo client (assuming one is running)."""
@@ -167,91 +301,480 @@ class TxnGraph(object):
         self.end_timestamp = end["timestamp"]
         return client
 
-    def _addEdgeWeight(self, newEdge, value):
-        """
-        Add to the weight of a given edge (i.e. the amount of ether that has
-        flown through it). Create a new one if needed.
+    def _readBlocks(self, client, start, end):
         """
-        if self.edgeWeights[newEdge] is not None:
-            self.edgeWeights[newEdge] += value
-        else:
-            self.edgeWeights[newEdge] = 0
+        Read the transactions in blocks (start, end) into arrays.
 
-    def _addVertexWeight(self, from_v, to_v, value):
-        """
-        Add to the weight of a given vertex (i.e. the amount of ether)
-        it holds. Create a new weight if needed.
+        Description:
+        ------------
+        Addresses are interned in the AddressTable, and new vertices are
+        assigned in bulk in the order the one-vertex-at-a-time build used
+        to create them: for each transaction the "to" address first, then
+        the "from" address. Self referencing transactions are left out.
+
+        Returns:
+        --------
+        <tuple> (source vertices, target vertices, values) as numpy arrays,
+        the address ids of the new vertices (-1 for "no address") and
+        which of the new vertices are contracts
         """
-        if self.vertexWeights[to_v] is not None:
-            self.vertexWeights[to_v] += value
-        else:
-            self.vertexWeights[to_v] = 0
-        if self.vertexWeights[from_v] is not None:
-            # We shouldn't need to worry about overspending
-            # as the ethereum protocol should not let you spend
-            # more ether than you have!
-            self.vertexWeights[from_v] -= value
-        else:
-            self.vertexWeights[from_v] = 0
-
-    def _addBlocks(self, client, start, end):
-        """Add new blocks to current graph attribute."""
-        # Get a cursor containing all of the blocks
-        # between the start/end blocks
         blocks = client.find(
             {"number": {"$gt": start, "$lt": end}},
+            {"_id": 0, "number": 1, "compact": 1, "transactions": 1},
             sort=[("number", pymongo.ASCENDING)]
         )
+        to = list()
+        frm = list()
+        values = list()
+        has_data = list()
+        # Blocks may be stored in the compact (binary) schema, or with
+        # their transactions only in the TxnIndex
+        blocks = crawler_util.readBlocks(
+            blocks, client.database, ["from", "to", "value", "data"])
         for block in blocks:
-            if block["transactions"]:
-                # Loop through all of the transactions in the current block
-                # Add all the nodes to a global set (self.nodes)
-                for txn in block["transactions"]:
-
-                    # Graph vetices will be referenced temporarily, but the
-                    #   unique addresses will persist in self.nodes
-                    to_v = None
-                    from_v = None
-
-                    # Exclude self referencing transactions
-                    if txn["to"] == txn["from"]:
-                        continue
-
-                    # Set the "to" vertex
-                    if txn["to"] not in self.nodes:
-                        to_v = self.graph.add_vertex()
-                        self.nodes[txn["to"]] = to_v
-                        self.addresses[to_v] = txn["to"]
-
-                        # If there is data, this is going to a contract
-                        if "data" in txn:
-                            if txn["data"] != "0x":
-                                self.contracts.append(txn["to"])
-                    else:
-                        to_v = self.nodes[txn["to"]]
-
-                    # Set the "from" vertex
-                    if txn["from"] not in self.nodes:
-                        from_v = self.graph.add_vertex()
-                        self.nodes[txn["from"]] = from_v
-                        self.addresses[from_v] = txn["from"]
-                    else:
-                        from_v = self.nodes[txn["from"]]
-
-                    # Add a directed edge
-                    newEdge = self.graph.add_edge(from_v, to_v)
-                    self.edges.append(newEdge)
-
-                    # Update the weights
-                    self._addEdgeWeight(newEdge, txn["value"])
-                    self._addVertexWeight(from_v, to_v, txn["value"])
+            for txn in block["transactions"]:
+                to.append(txn["to"])
+                frm.append(txn["from"])
+                values.append(txn["value"])
+                has_data.append(txn.get("data", "0x") != "0x")
+        n = len(to)
+        ids = self.address_table.intern(to + frm)
+        # Slots in vertex_map are ids + 1; slot 0 is "no address" (the
+        # "to" of contract creations)
+        to = ids[:n].astype(np.int64) + 1
+        frm = ids[n:].astype(np.int64) + 1
+        # Exclude self referencing transactions
+        keep = to != frm
+        to, frm = to[keep], frm[keep]
+        values = np.array(values, dtype=np.float64)[keep]
+        has_data = np.array(has_data, dtype=bool)[keep]
+
+        self._growVertexMap(len(self.address_table) + 1)
+        # New slots, in order of first appearance
+        order = np.empty(2*len(to), dtype=np.int64)
+        order[0::2] = to
+        order[1::2] = frm
+        slots, first = np.unique(order, return_index=True)
+        is_new = self.vertex_map[slots] < 0
+        slots, first = slots[is_new], first[is_new]
+        by_first = np.argsort(first, kind="stable")
+        slots, first = slots[by_first], first[by_first]
+        self.vertex_map[slots] = np.arange(
+            self.graph.num_vertices(),
+            self.graph.num_vertices() + len(slots))
+
+        # If there is data, a new "to" vertex is a contract
+        contract = (first % 2 == 0) & has_data[first // 2]
+
+        return (
+            self.vertex_map[frm].astype(np.int64),
+            self.vertex_map[to].astype(np.int64),
+            values,
+            slots - 1,
+            contract)
+
+    def _growVertexMap(self, n):
+        """
+        Make room for n slots in vertex_map.
+
+        The capacity at least doubles, so adding a few addresses per extend
+        does not copy the whole map each time.
+        """
+        if len(self.vertex_map) < n:
+            self.vertex_map = np.concatenate((
+                self.vertex_map,
+                np.full(max(n, 2*len(self.vertex_map)) - len(self.vertex_map),
+                    -1, dtype=np.int32)))
+
+    def _buildVertexMap(self):
+        """Rebuild vertex_map from the address id of each vertex."""
+        ids = self.addressIds.a.astype(np.int64)
+        self.vertex_map = np.full(1, -1, dtype=np.int32)
+        self._growVertexMap(int(ids.max()) + 2 if len(ids) else 1)
+        self.vertex_map[ids + 1] = np.arange(len(ids), dtype=np.int32)
+
+    def _addBlocks(self, client, start, end):
+        """
+        Add new blocks to current graph attribute.
+
+        Transactions are read into arrays first, then the new vertices and
+        all of the edges (with their weights) are added in bulk. The arrays
+        are kept for the next checkpoint.
+        """
+        part = self._readBlocks(client, start, end)
+        self._apply(*part)
+        self._pending.append(part)
+        self._state_id = _stateId(self._state_id, end)
+
+    def _apply(self, src, dst, values, new, contract):
+        """
+        Add vertices and edges read by _readBlocks (or from a checkpoint).
+
+        Parameters:
+        -----------
+        src, dst <np.ndarray>: source and target vertex of each transaction
+        values <np.ndarray>: the value of each transaction
+        new <np.ndarray>: address ids of the new vertices, in vertex order
+        contract <np.ndarray of bool>: which new vertices are contracts
+        """
+        if len(new):
+            first = self.graph.num_vertices()
+            # Already set when the arrays were read, but not when replaying
+            self._growVertexMap(int(np.max(new)) + 2)
+            self.vertex_map[new + 1] = np.arange(first, first + len(new))
+            self.graph.add_vertex(len(new))
+            ids = self.addressIds.a
+            ids[first:] = new
+            self.addressIds.a = ids
+            addresses = self.address_table.addresses(new)
+            for i, a in enumerate(addresses, first):
+                # Contract creations have no "to" address
+                self.addresses[self.graph.vertex(i)] = a or ""
+            self.contracts.extend(
+                a for a, c in zip(addresses, contract) if c)
+        if len(src) and self.collapse:
+            self._addCollapsedEdges(src, dst, values)
+        elif len(src):
+            # Each edge is weighted by the value of its transaction
+            self.graph.add_edge_list(
+                np.column_stack((src, dst, values)),
+                eprops=[self.edgeWeights])
+        if len(src):
+            # A vertex gains what it receives and loses what it sends.
+            # Interleaving the updates applies them to each vertex in the
+            # same order as one transaction at a time would.
+            index = np.empty(2*len(src), dtype=np.int64)
+            index[0::2] = dst
+            index[1::2] = src
+            delta = np.empty(2*len(src))
+            delta[0::2] = values
+            delta[1::2] = -values
+            weights = self.vertexWeights.a
+            np.add.at(weights, index, delta)
+            self.vertexWeights.a = weights
         self._addPropertyMaps()
 
+    def _addCollapsedEdges(self, src, dst, values):
+        """
+        Add transactions to the one edge of each (from, to) pair.
+
+        Edge weights hold the total value and edgeCounts the number of
+        transactions. New pairs get a new edge (in order of first
+        appearance); the edges of known pairs are found in self.pairs,
+        which stays sorted so each extend only merges its new pairs in.
+        """
+        keys = (src << 32) | dst
+        pairs, first, inverse = np.unique(
+            keys, return_index=True, return_inverse=True)
+        sums = np.bincount(inverse, weights=values)
+        counts = np.bincount(inverse)
+
+        # Pairs that already have an edge
+        edges = np.full(len(pairs), -1, dtype=np.int64)
+        if len(self.pairs):
+            pos = np.searchsorted(self.pairs, pairs)
+            pos[pos == len(self.pairs)] = 0
+            known = self.pairs[pos] == pairs
+            edges[known] = self.pairEdges[pos[known]]
+        known = edges >= 0
+        if known.any():
+            weights = self.edgeWeights.a
+            weights[edges[known]] += sums[known]
+            self.edgeWeights.a = weights
+            n = self.edgeCounts.a
+            n[edges[known]] += counts[known]
+            self.edgeCounts.a = n
+
+        # New pairs
+        new = np.flatnonzero(~known)
+        new = new[np.argsort(first[new], kind="stable")]
+        if len(new):
+            start = self.graph.edge_index_range
+            self.graph.add_edge_list(
+                np.column_stack((
+                    pairs[new] >> 32, pairs[new] & 0xffffffff,
+                    sums[new], counts[new])),
+                eprops=[self.edgeWeights, self.edgeCounts])
+            # Merge the new keys (sorted, since pairs is) into self.pairs
+            # rather than sorting all of them again
+            order = np.argsort(new)
+            pos = np.searchsorted(self.pairs, pairs[new[order]])
+            self.pairs = np.insert(self.pairs, pos, pairs[new[order]])
+            self.pairEdges = np.insert(
+                self.pairEdges, pos, start + np.arange(len(new))[order])
+
     def _addPropertyMaps(self):
         """Add PropertyMap attributes to Graph instance."""
         self.graph.vertex_properties["weight"] = self.vertexWeights
         self.graph.vertex_properties["address"] = self.addresses
+        self.graph.vertex_properties["address_id"] = self.addressIds
         self.graph.edge_properties["weight"] = self.edgeWeights
+        if self.collapse:
+            self.graph.edge_properties["count"] = self.edgeCounts
+
+    def _newPropertyMaps(self):
+        """Create empty PropertyMaps for a new graph."""
+        self.edgeWeights = self.graph.new_edge_property("double")
+        if self.collapse:
+            self.edgeCounts = self.graph.new_edge_property("int64_t")
+        self.vertexWeights = self.graph.new_vertex_property("double")
+        self.addresses = self.graph.new_vertex_property("string")
+        self.addressIds = self.graph.new_vertex_property("int32_t")
+
+    def _loadPropertyMaps(self):
+        """Point the PropertyMap attributes at those of a loaded graph."""
+        self.vertexWeights = self.graph.vertex_properties["weight"]
+        self.addresses = self.graph.vertex_properties["address"]
+        if "address_id" in self.graph.vertex_properties:
+            self.addressIds = self.graph.vertex_properties["address_id"]
+        else:
+            # Saved before vertices had address ids
+            self.addressIds = self.graph.new_vertex_property("int32_t")
+            self.addressIds.a = self.address_table.lookup([
+                self.addresses[v] or None for v in self.graph.vertices()])
+        self.edgeWeights = self.graph.edge_properties["weight"]
+        self.edgeCounts = self.graph.edge_properties["count"] \
+            if "count" in self.graph.edge_properties else None
+        self._addPropertyMaps()
+
+    def _checkpointDir(self, start=None):
+        """The directory holding the checkpoints of graphs from start."""
+        start = start or self.start_block
+        return "{}/checkpoints/{}{}".format(
+            DATADIR, start, "_collapsed" if self.collapse else "")
+
+    def _checkpoints(self, start=None):
+        """
+        The checkpoints of graphs from start.
+
+        Returns:
+        --------
+        <tuple> the bases, as (end block, state id) sorted, and a dict of
+        the deltas: (end block x, state id p) --> list of (end block y,
+        state id c) of delta_x_y_p_c
+        """
+        bases = list()
+        deltas = dict()
+        d = self._checkpointDir(start)
+        for name in (os.listdir(d) if os.path.isdir(d) else list()):
+            stem, ext = os.path.splitext(name)
+            parts = stem.split("_")
+            # A base counts once its pickle (written last) is in place
+            if parts[0] == "base" and ext == ".p" and len(parts) == 3:
+                bases.append((int(parts[1]), parts[2]))
+            elif parts[0] == "delta" and ext == ".npz" and len(parts) == 5:
+                deltas.setdefault((int(parts[1]), parts[3]), list()).append(
+                    (int(parts[2]), parts[4]))
+        return sorted(bases), deltas
+
+    def _clearCheckpoints(self, after=None):
+        """
+        Remove the checkpoints of graphs from self.start_block.
+
+        With after, only those ending past block after are removed.
+        """
+        d = self._checkpointDir()
+        for name in (os.listdir(d) if os.path.isdir(d) else list()):
+            # delta_x_y_p_c.npz or base_y_c.gt/.p (or a .tmp of one)
+            parts = name.split(".")[0].split("_")
+            end = int(parts[2] if parts[0] == "delta" else parts[1])
+            if after is None or end > after:
+                os.remove(os.path.join(d, name))
+        self._deltas_since_base = 0
+
+    def _writeDelta(self):
+        """Write the changes since the last checkpoint to a delta file."""
+        parts = self._pending or [(
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+            np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+        )]
+        arrays = [np.concatenate([p[i] for p in parts]) for i in range(5)]
+        f = "{}/delta_{}_{}_{}_{}.npz".format(
+            self._checkpointDir(), self._saved_end, self.end_block,
+            self._saved_id, self._state_id)
+        with open(f + ".tmp", "wb") as output:
+            np.savez(output,
+                src=arrays[0], dst=arrays[1], values=arrays[2],
+                new=arrays[3], contract=arrays[4],
+                # Parts are applied one at a time, as they were added
+                edge_offsets=np.cumsum([0] + [len(p[0]) for p in parts]),
+                vertex_offsets=np.cumsum([0] + [len(p[3]) for p in parts]),
+                timestamps=np.array([
+                    self.start_timestamp or 0, self.end_timestamp or 0]))
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(f + ".tmp", f)
+        self._deltas_since_base += 1
+
+    def _applyDelta(self, f):
+        """Apply the changes in a delta file."""
+        with np.load(f) as delta:
+            e, v = delta["edge_offsets"], delta["vertex_offsets"]
+            for i in range(len(e) - 1):
+                self._apply(
+                    delta["src"][e[i]:e[i+1]], delta["dst"][e[i]:e[i+1]],
+                    delta["values"][e[i]:e[i+1]], delta["new"][v[i]:v[i+1]],
+                    delta["contract"][v[i]:v[i+1]])
+            timestamps = delta["timestamps"]
+        if timestamps[1]:
+            self.start_timestamp = int(timestamps[0])
+            self.end_timestamp = int(timestamps[1])
+
+    def _writeBase(self):
+        """Write a full snapshot to the checkpoints and drop older ones."""
+        d = self._checkpointDir()
+        old, _ = self._checkpoints()
+        f = "{}/base_{}_{}".format(d, self.end_block, self._state_id)
+        self._dump(f + ".gt.tmp", f + ".p.tmp", empty=True)
+        os.replace(f + ".gt.tmp", f + ".gt")
+        os.replace(f + ".p.tmp", f + ".p")
+        # Later bases (e.g. written by another process) are kept. Older
+        # ones can still be rebuilt from the deltas.
+        for end, state in old:
+            if end < self.end_block:
+                f = "{}/base_{}_{}".format(d, end, state)
+                os.remove(f + ".p")
+                if os.path.exists(f + ".gt"):
+                    os.remove(f + ".gt")
+
+    def _reset(self):
+        """Go back to an empty graph ending at the start block."""
+        self.graph = Graph()
+        self._newPropertyMaps()
+        self._addPropertyMaps()
+        self.end_block = self.start_block
+        self.start_timestamp = None
+        self.end_timestamp = None
+        self.vertex_map = np.full(1, -1, dtype=np.int32)
+        self.pairs = np.zeros(0, dtype=np.int64)
+        self.pairEdges = np.zeros(0, dtype=np.int64)
+        self.contracts = list()
+        self._pending = list()
+        self._state_id = ROOT_ID
+
+    def _restore(self, start, end, exact=True):
+        """
+        Rebuild the state at end (from start) from the checkpoints.
+
+        Description:
+        ------------
+        Search the checkpoints (breadth first, from every base at or before
+        end and from the empty graph) for the states they lead to, then
+        load the one at end that needs the fewest deltas replayed. With
+        exact=False, take the latest state at or before end instead.
+
+        Returns:
+        --------
+        <int> the end block of the restored state
+        """
+        self.start_block = start
+        d = self._checkpointDir(start)
+        bases, deltas = self._checkpoints(start)
+        # state --> (state before it, or None for a base or the empty
+        # graph, and the number of deltas replayed to reach it)
+        found = {(start, ROOT_ID): (None, 0)}
+        queue = [(start, ROOT_ID)]
+        for b in bases:
+            if b[0] <= end:
+                found[b] = (None, 0)
+                queue.append(b)
+        for state in queue:
+            for child in deltas.get(state, list()):
+                if child[0] <= end and child not in found:
+                    found[child] = (state, found[state][1] + 1)
+                    queue.append(child)
+
+        reached = [s for s in found if s[0] == end] if exact else found
+        assert reached, "No checkpoints reach block {} from block {}".format(
+            end, start)
+        # The latest state, then the fewest deltas, then the latest base
+        state = max(reached, key=lambda s: (s[0], -found[s][1]))
+        path = list()
+        while found[state][0] is not None:
+            path.append(state)
+            state = found[state][0]
+
+        self._reset()
+        if state != (start, ROOT_ID):
+            f = "{}/base_{}_{}".format(d, *state)
+            self._undump(f + ".gt", f + ".p")
+            self.end_block, self._state_id = state
+        for y, child in reversed(path):
+            self._applyDelta("{}/delta_{}_{}_{}_{}.npz".format(
+                d, self.end_block, y, self._state_id, child))
+            self.end_block, self._state_id = y, child
+        self._pending = list()
+        self._saved_end = self.end_block
+        self._saved_id = self._state_id
+        self._deltas_since_base = len(path)
+        self._setFilePaths()
+        return self.end_block
+
+    def _dump(self, f_graph, f_pickle, empty=False):
+        """
+        Save the graph to f_graph and the rest of the object to f_pickle.
+
+        An empty graph is only saved with empty=True.
+        """
+        # We cannot save any of the graph_tool objects so we need to stash
+        # them in a temporary object
+        tmp = {
+            "edges": self.edges,
+            "edgeWeights": self.edgeWeights,
+            "edgeCounts": self.edgeCounts,
+            "vertexWeights": self.vertexWeights,
+            "addresses": self.addresses,
+            "addressIds": self.addressIds,
+            "graph": self.graph,
+            "vertex_map": self.vertex_map,
+            "_pending": self._pending
+        }
+        # Empty the graph_tool objects
+        self.edges = list()
+        self.edgeWeights = None
+        self.edgeCounts = None
+        self.vertexWeights = None
+        self.addresses = None
+        self.addressIds = None
+        # Rebuilt from the address ids of the vertices on load
+        self.vertex_map = None
+        self._pending = list()
+
+        # Save the graph to a file (but not if it is empty)
+        if self.graph.num_vertices() > 0 or empty:
+            self.graph.save(f_graph, fmt="gt")
+
+        self.graph = None
+
+        # Save the rest of this object to a pickle
+        with open(f_pickle, "wb") as output:
+            pickle.dump(self.__dict__, output)
+            output.flush()
+            os.fsync(output.fileno())
+
+        # Reload from tmp
+        self.edges = tmp["edges"]
+        self.edgeWeights = tmp["edgeWeights"]
+        self.edgeCounts = tmp["edgeCounts"]
+        self.vertexWeights = tmp["vertexWeights"]
+        self.addresses = tmp["addresses"]
+        self.addressIds = tmp["addressIds"]
+        self.graph = tmp["graph"]
+        self.vertex_map = tmp["vertex_map"]
+        self._pending = tmp["_pending"]
+
+    def _undump(self, f_graph, f_pickle):
+        """Load a graph and object saved with _dump."""
+        # Load the graph from file
+        tmp_graph = load_graph(f_graph)
+
+        # Load the object from a pickle
+        with open(f_pickle, "rb") as input:
+            tmp = pickle.load(input)
+            self.__dict__.update(tmp)
+            self.graph = tmp_graph
+        self._loadPropertyMaps()
+        self._buildVertexMap()
 
     # PUBLIC
     # ------
@@ -278,9 +801,7 @@ class TxnGraph(object):
         client, popen = self._getMongoClient()
 
         # Add PropertyMaps
-        self.edgeWeights = self.graph.new_edge_property("double")
-        self.vertexWeights = self.graph.new_vertex_property("double")
-        self.addresses = self.graph.new_vertex_property("string")
+        self._newPropertyMaps()
 
         # Add blocks to the graph
         self._addBlocks(client, self.start_block, self.end_block)
@@ -290,6 +811,14 @@ class TxnGraph(object):
             # TODO get this to work
             popen.kill()
 
+    def vertex(self, address):
+        """The vertex of an address, or None if it is not in the graph."""
+        i = self.address_table.lookup([address])[0] + 1
+        if (address is not None and i == 0) or \
+                i >= len(self.vertex_map) or self.vertex_map[i] < 0:
+            return None
+        return self.graph.vertex(int(self.vertex_map[i]))
+
     def save(self):
         """Pickle TxnGraph. Save the graph_tool Graph object separately."""
         if not os.path.exists(DATADIR+"/pickles"):
@@ -299,41 +828,33 @@ class TxnGraph(object):
         if not os.path.exists(DATADIR+"/snapshots"):
             os.makedirs(DATADIR+"/snapshots")
 
-        # We cannot save any of the graph_tool objects so we need to stash
-        # them in a temporary object
-        tmp = {
-            "nodes": self.nodes,
-            "edges": self.edges,
-            "edgeWeights": self.edgeWeights,
-            "vertexWeights": self.vertexWeights,
-            "addresses": self.addresses,
-            "graph": self.graph
-        }
-        # Empty the graph_tool objects
-        self.nodes = dict()
-        self.edges = list()
-        self.edgeWeights = None
-        self.vertexWeights = None
-        self.addresses = None
+        self._dump(self.f_graph, self.f_pickle)
 
-        # Save the graph to a file (but not if it is empty)
-        if len(self.nodes) > 0:
-            self.graph.save(self.f_graph, fmt="gt")
-
-        self.graph = None
-
-        # Save the rest of this object to a pickle
-        with open(self.f_pickle, "wb") as output:
-            pickle.dump(self.__dict__, output)
-            output.close()
+    def checkpoint(self):
+        """
+        Checkpoint the changes since the last checkpoint.
 
-        # Reload from tmp
-        self.nodes = tmp["nodes"]
-        self.edges = tmp["edges"]
-        self.edgeWeights = tmp["edgeWeights"]
-        self.vertexWeights = tmp["vertexWeights"]
-        self.addresses = tmp["addresses"]
-        self.graph = tmp["graph"]
+        Description:
+        ------------
+        Only the vertices and edges added since the last checkpoint are
+        written (see Checkpoints above), so a checkpoint costs about as much
+        as the blocks it covers. Every compact_every deltas a full base
+        snapshot is written as well, so rebuilding a state never replays
+        more than compact_every deltas. A graph that was not built from
+        checkpoints (e.g. from a previous graph) gets a base right away.
+        """
+        d = self._checkpointDir()
+        if not os.path.exists(d):
+            os.makedirs(d)
+        if self._saved_end is not None:
+            self._writeDelta()
+        if self._saved_end is None or \
+                self._deltas_since_base >= self.compact_every:
+            self._writeBase()
+            self._deltas_since_base = 0
+        self._pending = list()
+        self._saved_end = self.end_block
+        self._saved_id = self._state_id
 
     def load(self, start_block, end_block):
         """
@@ -344,7 +865,8 @@ class TxnGraph(object):
         Load a pickle of a different TxnGraph object as well as a saved Graph
         object as TxnGraph.graph. This can be called upon instantiation with
         load=True OR can be called any time by passing new start/end block
-        params.
+        params. If the graph was not saved with save(), it is rebuilt from
+        its checkpoints.
 
         Parameters:
         -----------
@@ -353,15 +875,92 @@ class TxnGraph(object):
         """
         self._setFilePaths(start_block, end_block)
 
-        # Load the graph from file
-        tmp_graph = load_graph(self.f_graph)
+        if not os.path.isfile(self.f_pickle):
+            self._restore(start_block, end_block)
+            return
 
-        # Load the object from a pickle
-        with open(self.f_pickle, "rb") as input:
-            tmp = pickle.load(input)
-            self.__dict__.update(tmp)
-            self.graph = tmp_graph
-            input.close()
+        self._undump(self.f_graph, self.f_pickle)
+        # Whatever follows is checkpointed on top of a full base
+        self._pending = list()
+        self._saved_end = None
+        if "_state_id" not in self.__dict__:
+            # Saved before states had ids
+            self._state_id = uuid.uuid4().hex[:16]
+
+    def rewind(self, block):
+        """
+        Go back to the latest checkpoint that does not include block.
+
+        Description:
+        ------------
+        For when the blocks from block on have changed (e.g. after a chain
+        reorganization): the state is restored from the checkpoints ending
+        at or before block, and the checkpoints past it, which were built
+        from the old blocks, are deleted. Changes that were not
+        checkpointed are dropped. extend() the graph again from there.
+
+        Parameters:
+        -----------
+        block <int>: the first block that changed
+
+        Returns:
+        --------
+        <int> the new end block
+        """
+        end = self._restore(self.start_block, block, exact=False)
+        self._clearCheckpoints(after=end)
+        return end
+
+    def exportCSR(self, path=None):
+        """
+        Export the graph as a CSRSnapshot.
+
+        Description:
+        ------------
+        Write the edges, sorted by source vertex (compressed sparse rows),
+        with their weights (and counts if collapsed), and the weight and
+        address id of every vertex to a single file. Reading it back needs
+        only numpy; see CSRSnapshot.
+
+        Parameters:
+        -----------
+        path <str>, default self.f_csr
+
+        Returns:
+        --------
+        <str> the path written
+        """
+        path = path or self.f_csr
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        eprops = [self.edgeWeights]
+        if self.collapse:
+            eprops.append(self.edgeCounts)
+        edges = self.graph.get_edges(eprops).reshape(-1, 2 + len(eprops))
+        src = edges[:, 0].astype(np.int64)
+        # Stable, so the edges of a vertex keep their order
+        order = np.argsort(src, kind="stable")
+        n = self.graph.num_vertices()
+        arrays = {
+            "offsets": np.concatenate((
+                [0], np.cumsum(np.bincount(src, minlength=n)))),
+            "targets": edges[order, 1],
+            "weights": edges[order, 2],
+            "balances": self.vertexWeights.a,
+            "address_ids": self.addressIds.a
+        }
+        if self.collapse:
+            arrays["counts"] = edges[order, 3]
+
+        CSRSnapshot.write(path, arrays,
+            start_block=int(self.start_block),
+            end_block=int(self.end_block),
+            start_timestamp=self.start_timestamp,
+            end_timestamp=self.end_timestamp,
+            collapse=self.collapse,
+            address_table=os.path.realpath(self.address_table.path))
+        return path
 
     def draw(self, **kwargs):
         """
@@ -390,6 +989,9 @@ class TxnGraph(object):
             print("Nothing to draw!")
             return
 
+        if not os.path.exists(DATADIR+"/snapshots"):
+            os.makedirs(DATADIR+"/snapshots")
+
         # Testing to allow negative numbers
         deg.a = abs(deg.a)**0.5
 
@@ -431,12 +1033,12 @@ class TxnGraph(object):
         this method can be used to add n blocks to the existing TxnGraph
         instance. It can be called multiple times to iterate over the block
         chain with resolution of n blocks. The extended TxnGraph will be
-        saved by default.
+        checkpointed by default (see checkpoint()).
 
         Parameters:
         -----------
         n <int>: number of blocks to add (from the last_block)
-        save <bool>, default True: save the new state automatically
+        save <bool>, default True: checkpoint the new state automatically
         """
         old_end = self.end_block
         new_end = self.end_block + n
@@ -447,4 +1049,4 @@ class TxnGraph(object):
         self._setFilePaths()
 
         if save:
-            self.save()
+            self.checkpoint()
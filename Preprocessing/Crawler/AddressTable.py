@@ -0,0 +1,232 @@
+"""A persistent table giving every address a small integer id."""
+
+import fcntl
+import os
+import threading
+import numpy as np
+
+ADDRESS_DTYPE = np.dtype("S20")
+ID_DTYPE = np.dtype("<i4")
+DEFAULT_PATH = os.path.join(
+    os.environ.get("BLOCKCHAIN_MONGO_DATA_DIR", "."), "address_table")
+
+
+class AddressTable(object):
+    """
+    Intern addresses as int32 ids that stay the same forever.
+
+    Description:
+    ------------
+    The id of an address is its position in an append-only file of 20-byte
+    records, so ids never change and id --> address is a single read of a
+    memory-mapped array. For address --> id the table keeps an index (the
+    sorted records plus their ids) covering the first records; addresses
+    appended after it are kept in a small dict, and the index is rebuilt
+    once that grows past reindex_ratio of the table. All files are
+    memory-mapped, so opening a table takes constant time.
+
+        path/records.dat   20-byte addresses, in id order
+        path/index.dat     the first n addresses sorted, then their n ids
+        path/lock          taken while appending
+
+    Appends take an exclusive lock on path/lock and first pick up any
+    records other processes (e.g. several crawlers) appended, so the table
+    can be shared by processes on one host.
+
+    Addresses are hex strings ("0x..." as geth returns them); bulk calls
+    also take a numpy array of 20-byte keys (dtype S20). None (the "to" of
+    a contract creation) has no id and maps to -1.
+
+    Parameters:
+    -----------
+    path <str> default DEFAULT_PATH     # Directory of the table
+    reindex_ratio <float> default 0.05
+    min_reindex <int> default 100000
+
+    Usage:
+    ------
+        table = AddressTable()
+        ids = table.intern(["0x...", "0x..."])    # np.int32 array
+        ids = table.lookup(addresses)             # -1 where unknown
+        addresses = table.addresses(ids)
+    """
+
+    def __init__(self, path=DEFAULT_PATH, reindex_ratio=0.05,
+            min_reindex=100000):
+        """Open (or create) the table."""
+        self.path = path
+        self.reindex_ratio = reindex_ratio
+        self.min_reindex = min_reindex
+        os.makedirs(path, exist_ok=True)
+        self._records_file = os.path.join(path, "records.dat")
+        self._index_file = os.path.join(path, "index.dat")
+        self._lock_file = os.path.join(path, "lock")
+        self._lock = threading.Lock()
+        self._n = 0
+        self._records = np.zeros(0, dtype=ADDRESS_DTYPE)
+        # Address --> id for records above the index
+        self._tail = dict()
+        with self._lock:
+            self._openIndex()
+            self._refresh()
+
+    def __getstate__(self):
+        """Pickle just the location (e.g. as part of a TxnGraph)."""
+        return {
+            "path": self.path,
+            "reindex_ratio": self.reindex_ratio,
+            "min_reindex": self.min_reindex
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    # PRIVATE
+
+    def _map(self, f, dtype, n, offset=0):
+        """Map n records of a file read-only."""
+        if not n:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(f, dtype=dtype, mode="r", shape=(n,), offset=offset)
+
+    def _openIndex(self):
+        n = os.path.getsize(self._index_file) // \
+            (ADDRESS_DTYPE.itemsize + ID_DTYPE.itemsize) \
+            if os.path.isfile(self._index_file) else 0
+        self._sorted = self._map(self._index_file, ADDRESS_DTYPE, n)
+        self._order = self._map(
+            self._index_file, ID_DTYPE, n, n * ADDRESS_DTYPE.itemsize)
+        self._tail = dict()
+        self._n = n
+
+    def _refresh(self):
+        """Pick up records appended since we last looked (by anyone)."""
+        n = os.path.getsize(self._records_file) // ADDRESS_DTYPE.itemsize \
+            if os.path.isfile(self._records_file) else 0
+        if n == self._n and len(self._records) == n:
+            return
+        self._records = self._map(self._records_file, ADDRESS_DTYPE, n)
+        for i in range(self._n, n):
+            self._tail[self._key(self._records[i])] = i
+        self._n = n
+
+    def _key(self, k):
+        # numpy drops trailing zero bytes from S20 values
+        return bytes(k).ljust(ADDRESS_DTYPE.itemsize, b"\0")
+
+    def _keys(self, addresses):
+        """
+        Convert addresses to an S20 array plus a mask of real addresses.
+        """
+        if isinstance(addresses, np.ndarray) and addresses.dtype.kind == "S":
+            keys = addresses.astype(ADDRESS_DTYPE)
+            return keys, np.ones(len(keys), dtype=bool)
+        addresses = list(addresses)
+        valid = np.array([a is not None for a in addresses], dtype=bool)
+        hexes = "".join(a[2:] for a in addresses if a is not None)
+        keys = np.zeros(len(addresses), dtype=ADDRESS_DTYPE)
+        keys[valid] = np.frombuffer(bytes.fromhex(hexes), dtype=ADDRESS_DTYPE)
+        return keys, valid
+
+    def _find(self, keys, valid):
+        """Ids of keys (-1 where unknown or not valid)."""
+        ids = np.full(len(keys), -1, dtype=ID_DTYPE)
+        if len(self._sorted):
+            pos = np.searchsorted(self._sorted, keys)
+            pos[pos == len(self._sorted)] = 0
+            hit = valid & (self._sorted[pos] == keys)
+            ids[hit] = self._order[pos[hit]]
+        if self._tail:
+            for i in np.flatnonzero(valid & (ids < 0)):
+                ids[i] = self._tail.get(self._key(keys[i]), -1)
+        return ids
+
+    def _write(self, f, data):
+        tmp = "{}.tmp".format(f)
+        with open(tmp, "wb") as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, f)
+
+    def _reindex(self):
+        """Rebuild the sorted index over every record."""
+        records = np.asarray(self._records)
+        order = np.argsort(records, kind="stable").astype(ID_DTYPE)
+        self._write(
+            self._index_file, records[order].tobytes() + order.tobytes())
+        self._openIndex()
+        self._refresh()
+
+    # PUBLIC
+
+    def __len__(self):
+        return self._n
+
+    def lookup(self, addresses):
+        """
+        The ids of addresses, without adding any.
+
+        Returns:
+        --------
+        <np.ndarray of int32>, -1 for addresses that are not in the table
+        """
+        keys, valid = self._keys(addresses)
+        with self._lock:
+            ids = self._find(keys, valid)
+            if (valid & (ids < 0)).any():
+                # Another process may have added them
+                self._refresh()
+                ids = self._find(keys, valid)
+        return ids
+
+    def intern(self, addresses):
+        """
+        The ids of addresses, adding any that are new.
+
+        Returns:
+        --------
+        <np.ndarray of int32>, -1 only for None
+        """
+        keys, valid = self._keys(addresses)
+        with self._lock:
+            ids = self._find(keys, valid)
+            if not (valid & (ids < 0)).any():
+                return ids
+            with open(self._lock_file, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._refresh()
+                    ids = self._find(keys, valid)
+                    missing = np.flatnonzero(valid & (ids < 0))
+                    # Each new address once, in order of first appearance
+                    new, first = np.unique(keys[missing], return_index=True)
+                    new = new[np.argsort(first, kind="stable")]
+                    with open(self._records_file, "ab") as f:
+                        # Drop a partial record left by a crash
+                        f.truncate(self._n * ADDRESS_DTYPE.itemsize)
+                        f.write(new.tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+                    self._refresh()
+                    if len(self._tail) > max(
+                            self.reindex_ratio * self._n, self.min_reindex):
+                        self._reindex()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            return self._find(keys, valid)
+
+    def addresses(self, ids):
+        """The hex addresses of ids (None for -1)."""
+        with self._lock:
+            if len(ids) and np.max(ids) >= self._n:
+                self._refresh()
+            records = self._records
+        return [
+            "0x" + self._key(records[i]).hex() if i >= 0 else None
+            for i in ids
+        ]
+
+    def address(self, i):
+        """The hex address with id i."""
+        return self.addresses([i])[0]
@@ -0,0 +1,380 @@
+"""Storage backends the crawler can write parsed blocks to."""
+
+import crawler_util
+import glob
+import os
+import pymongo
+import re
+import threading
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class MongoStore(object):
+    """
+    Store parsed blocks as documents in a mongo collection (the default).
+
+    Every backend has the same methods: insert(), insertMany(), replace(),
+    highestBlock(), findGaps() and recentBlocks().
+
+    Parameters:
+    -----------
+    client <mongodb Client>     # The collection returned by initMongo
+    compact <bool> default False # Store blocks with compactBlock(); read
+                                 # them with crawler_util.expandBlock()
+    txn_index <TxnIndex> default None  # Also write every transaction to
+                                       # this flat, indexed collection
+    embed <bool> default True   # Keep the transactions in the block
+                                # documents; with False (and a txn_index)
+                                # blocks only record "n_txns" (read them
+                                # with crawler_util.readBlocks())
+    """
+
+    def __init__(self, client, compact=False, txn_index=None, embed=True):
+        """Initialize with a mongo collection."""
+        assert embed or txn_index, "Transactions must be stored somewhere"
+        self.client = client
+        self.compact = compact
+        self.txn_index = txn_index
+        self.embed = embed
+
+    def _encode(self, block):
+        if not self.embed:
+            doc = {k: v for k, v in block.items() if k != "transactions"}
+            doc["n_txns"] = len(block["transactions"])
+            return doc
+        return crawler_util.compactBlock(block) if self.compact else block
+
+    def insert(self, block):
+        """Insert one block. Returns an error string or None."""
+        e = crawler_util.insertMongo(self.client, self._encode(block))
+        if not e and self.txn_index:
+            e = "; ".join(self.txn_index.insert([block])) or None
+        return e
+
+    def insertMany(self, blocks):
+        """
+        Insert blocks, skipping ones that are already stored.
+
+        Returns:
+        --------
+        <tuple> (inserted <int>, duplicates <int>, errors <list of str>,
+                 block numbers that were not stored <list of int>)
+        """
+        n, dups, errors, failed = crawler_util.insertManyMongo(
+            self.client, [self._encode(b) for b in blocks])
+        if self.txn_index:
+            # Duplicates are indexed again too, in case an earlier run
+            # stopped between writing a block and indexing it
+            failed_set = set(failed)
+            errors = errors + self.txn_index.insert(
+                [b for b in blocks if b["number"] not in failed_set])
+        return n, dups, errors, failed
+
+    def replace(self, blocks):
+        """Overwrite blocks by number (e.g. after a reorg)."""
+        crawler_util.replaceBlocks(
+            self.client, [self._encode(b) for b in blocks])
+        if self.txn_index:
+            self.txn_index.replace(blocks)
+
+    def highestBlock(self):
+        """The highest stored block number (0 if empty)."""
+        return crawler_util.highestBlock(self.client)
+
+    def findGaps(self, start, end):
+        """The missing (a, b) ranges in [start, end)."""
+        return crawler_util.findGaps(self.client, start, end)
+
+    def recentBlocks(self, n):
+        """The number and hash of the top n stored blocks, ascending."""
+        highest = self.highestBlock()
+        return list(self.client.find(
+            {"number": {"$gt": highest - n}},
+            {"number": 1, "hash": 1, "_id": 0},
+            sort=[("number", pymongo.ASCENDING)]))
+
+
+class ColumnarStore(object):
+    """
+    Store blocks as append-only Parquet segments of flattened transactions.
+
+    Description:
+    ------------
+    Every flush writes one new segment per block range partition touched:
+
+        path/<lo>_<hi>/<first>_<last>.txns.parquet    one row per transaction
+        path/<lo>_<hi>/<first>_<last>.blocks.parquet  one row per block
+
+    where [lo, hi) is a partition of partition_blocks blocks. Transaction
+    segments have the columns block, timestamp, from, to, value (ether) and
+    has_data, so an analysis can read just the columns it needs with
+    scanTransactions() without a mongo server. The block segments record
+    every stored block (including ones with no transactions) with its hash,
+    and are what highestBlock() and findGaps() use.
+
+    Requires pyarrow.
+
+    Parameters:
+    -----------
+    path <str>                          # Root directory of the store
+    partition_blocks <int> default 100000
+
+    Usage:
+    ------
+        store = ColumnarStore("/data/blocks")
+        c = Crawler(store=store)
+        table = store.scanTransactions(["from", "to", "value"], 1, 100000)
+    """
+
+    def __init__(self, path, partition_blocks=100000):
+        """Initialize the store, creating the directory if needed."""
+        if pa is None:
+            raise ImportError("ColumnarStore requires pyarrow")
+        self.path = path
+        self.partition_blocks = max(int(partition_blocks), 1)
+        os.makedirs(path, exist_ok=True)
+        self.txn_schema = pa.schema([
+            ("block", pa.int64()),
+            ("timestamp", pa.int64()),
+            ("from", pa.string()),
+            ("to", pa.string()),
+            ("value", pa.float64()),
+            ("has_data", pa.bool_())
+        ])
+        self.block_schema = pa.schema([
+            ("number", pa.int64()),
+            ("timestamp", pa.int64()),
+            ("hash", pa.string()),
+            ("n_txns", pa.int32())
+        ])
+        # Partition --> set of stored block numbers, loaded on demand
+        self._numbers = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """Pickle without the lock and cache (e.g. for worker processes)."""
+        state = dict(self.__dict__)
+        del state["_lock"]
+        state["_numbers"] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # PRIVATE
+
+    def _partition(self, n):
+        return (n // self.partition_blocks) * self.partition_blocks
+
+    def _partitionDir(self, lo):
+        return os.path.join(
+            self.path, "{:012d}_{:012d}".format(lo, lo + self.partition_blocks))
+
+    def _blockFiles(self, lo=None):
+        pattern = "*" if lo is None else os.path.basename(self._partitionDir(lo))
+        return sorted(glob.glob(
+            os.path.join(self.path, pattern, "*.blocks.parquet")))
+
+    def _stored(self, lo):
+        """The set of block numbers stored in partition lo."""
+        if lo not in self._numbers:
+            numbers = set()
+            for f in self._blockFiles(lo):
+                numbers.update(
+                    pq.read_table(f, columns=["number"])["number"].to_pylist())
+            self._numbers[lo] = numbers
+        return self._numbers[lo]
+
+    def _write(self, table, path):
+        """Write a table to path atomically."""
+        tmp = "{}.tmp".format(path)
+        pq.write_table(table, tmp)
+        os.replace(tmp, path)
+
+    def _writeSegment(self, lo, blocks):
+        """Write the blocks of one partition as a new segment."""
+        d = self._partitionDir(lo)
+        os.makedirs(d, exist_ok=True)
+        name = os.path.join(d, "{:012d}_{:012d}".format(
+            blocks[0]["number"], blocks[-1]["number"]))
+        # Segments are never overwritten; pick a fresh name if needed
+        suffix = 0
+        base = name
+        while os.path.exists(name + ".blocks.parquet"):
+            suffix += 1
+            name = "{}.{}".format(base, suffix)
+
+        txns = {k: list() for k in self.txn_schema.names}
+        for b in blocks:
+            for t in b["transactions"]:
+                txns["block"].append(b["number"])
+                txns["timestamp"].append(b["timestamp"])
+                txns["from"].append(t["from"])
+                txns["to"].append(t["to"])
+                txns["value"].append(t["value"])
+                txns["has_data"].append(t["data"] != "0x")
+        self._write(
+            pa.table(txns, schema=self.txn_schema), name + ".txns.parquet")
+        # The blocks file goes last: a segment only counts once it exists
+        self._write(pa.table({
+            "number": [b["number"] for b in blocks],
+            "timestamp": [b["timestamp"] for b in blocks],
+            "hash": [b.get("hash") for b in blocks],
+            "n_txns": [len(b["transactions"]) for b in blocks]
+        }, schema=self.block_schema), name + ".blocks.parquet")
+
+    # PUBLIC
+
+    def insert(self, block):
+        """Insert one block. Returns an error string or None."""
+        errors = self.insertMany([block])[2]
+        return errors[0] if errors else None
+
+    def insertMany(self, blocks):
+        """
+        Append blocks, skipping ones that are already stored.
+
+        Returns:
+        --------
+        <tuple> (inserted <int>, duplicates <int>, errors <list of str>,
+                 block numbers that were not stored <list of int>)
+        """
+        inserted = duplicates = 0
+        errors = list()
+        failed = list()
+        with self._lock:
+            parts = dict()
+            for b in sorted(blocks, key=lambda b: b["number"]):
+                parts.setdefault(self._partition(b["number"]), list()).append(b)
+            for lo, part in parts.items():
+                stored = self._stored(lo)
+                new = list()
+                for b in part:
+                    if b["number"] in stored:
+                        duplicates += 1
+                    elif not new or new[-1]["number"] != b["number"]:
+                        new.append(b)
+                    else:
+                        duplicates += 1
+                if not new:
+                    continue
+                try:
+                    self._writeSegment(lo, new)
+                except Exception as err:
+                    errors.append(str(err))
+                    failed.extend(b["number"] for b in new)
+                    continue
+                stored.update(b["number"] for b in new)
+                inserted += len(new)
+        return inserted, duplicates, errors, failed
+
+    def replace(self, blocks):
+        """
+        Overwrite blocks by number (e.g. after a reorg).
+
+        The old rows are removed from the segments that hold them, which
+        are rewritten, and the new blocks are appended as a new segment.
+        """
+        numbers = [b["number"] for b in blocks]
+        with self._lock:
+            for lo in set(self._partition(n) for n in numbers):
+                mask = pa.array(numbers, pa.int64())
+                for f in self._blockFiles(lo):
+                    t = pq.read_table(f)
+                    if not pc.any(pc.is_in(t["number"], mask)).as_py():
+                        continue
+                    self._write(
+                        t.filter(pc.invert(pc.is_in(t["number"], mask))), f)
+                    txn_file = f.replace(".blocks.parquet", ".txns.parquet")
+                    t = pq.read_table(txn_file)
+                    self._write(
+                        t.filter(pc.invert(pc.is_in(t["block"], mask))),
+                        txn_file)
+                self._stored(lo).difference_update(numbers)
+        self.insertMany(blocks)
+
+    def highestBlock(self):
+        """The highest stored block number (0 if empty)."""
+        partitions = sorted(set(
+            _partitionRange(f)[0] for f in self._blockFiles()))
+        for lo in reversed(partitions):
+            stored = self._stored(lo)
+            if stored:
+                return max(stored)
+        return 0
+
+    def findGaps(self, start, end):
+        """The missing (a, b) ranges in [start, end)."""
+        gaps = list()
+        expected = start
+        for lo in range(self._partition(start), end, self.partition_blocks):
+            for n in sorted(self._stored(lo)):
+                if n < expected or n >= end:
+                    continue
+                if n > expected:
+                    gaps.append((expected, n))
+                expected = n + 1
+        if expected < end:
+            gaps.append((expected, end))
+        return gaps
+
+    def recentBlocks(self, n):
+        """The number and hash of the top n stored blocks, ascending."""
+        highest = self.highestBlock()
+        rows = list()
+        for lo in range(self._partition(max(highest - n + 1, 0)),
+                highest + 1, self.partition_blocks):
+            for f in self._blockFiles(lo):
+                t = pq.read_table(f, columns=["number", "hash"])
+                rows.extend(r for r in t.to_pylist()
+                    if r["number"] > highest - n)
+        return sorted(rows, key=lambda r: r["number"])
+
+    def scanTransactions(self, columns=None, start=None, end=None):
+        """
+        Read flattened transactions in [start, end) as a pyarrow Table.
+
+        Params:
+        -------
+        columns <list of str> default all: any of block, timestamp, from,
+            to, value, has_data
+        start <int> default None: first block (inclusive)
+        end <int> default None: last block (exclusive)
+        """
+        # Skip segments whose write did not finish (no blocks file)
+        files = [
+            f.replace(".blocks.parquet", ".txns.parquet")
+            for f in self._blockFiles()
+        ]
+        if start is not None or end is not None:
+            lo = self._partition(start or 0)
+            files = [
+                f for f in files
+                if _partitionRange(f)[1] > lo and
+                (end is None or _partitionRange(f)[0] < end)
+            ]
+        if not files:
+            return self.txn_schema.empty_table().select(
+                columns or self.txn_schema.names)
+        dataset = ds.dataset(files, schema=self.txn_schema, format="parquet")
+        condition = None
+        if start is not None:
+            condition = ds.field("block") >= start
+        if end is not None:
+            c = ds.field("block") < end
+            condition = c if condition is None else condition & c
+        return dataset.to_table(columns=columns, filter=condition)
+
+
+def _partitionRange(f):
+    """The [lo, hi) block range of the partition a segment file is in."""
+    lo, hi = re.match(
+        r"(\d+)_(\d+)", os.path.basename(os.path.dirname(f))).groups()
+    return int(lo), int(hi)
@@ -0,0 +1,83 @@
+"""Buffer parsed blocks and write them to mongo in bulk."""
+
+import logging
+import time
+
+
+class BlockWriter(object):
+    """
+    Buffer parsed blocks and flush them to a store with bulk inserts.
+
+    Description:
+    ------------
+    Blocks passed to add() are held in memory until either max_docs blocks
+    are buffered or max_delay seconds have passed since the last flush, and
+    are then written with a single insertMany (an unordered insert_many for
+    mongo). Blocks that already exist (e.g. duplicate keys on the unique
+    "number" index) are skipped silently; any other failure is logged and
+    kept in self.errors.
+
+    Parameters:
+    -----------
+    store <BlockStore>          # MongoStore or ColumnarStore to write to
+    max_docs <int> default 500  # Flush once this many blocks are buffered
+    max_delay <float> default 2 # Flush once the buffer is this old (seconds)
+    on_flush <function> default None   # Called with the block numbers
+                                       # stored by each flush
+
+    Usage:
+    ------
+        writer = BlockWriter(MongoStore(mongo_client))
+        for block in blocks:
+            writer.add(block)
+        writer.flush()
+    """
+
+    def __init__(self, store, max_docs=500, max_delay=2.0, on_flush=None):
+        """Initialize an empty buffer."""
+        self.store = store
+        self.on_flush = on_flush
+        self.max_docs = max(int(max_docs), 1)
+        self.max_delay = max_delay
+        self.buffer = list()
+        self.last_flush = time.time()
+        # Running totals
+        self.inserted = 0
+        self.duplicates = 0
+        # Errors that were not duplicate keys
+        self.errors = list()
+
+    def add(self, block):
+        """Buffer a block, flushing if the buffer is full or stale."""
+        self.buffer.append(block)
+        if len(self.buffer) >= self.max_docs or \
+                time.time() - self.last_flush >= self.max_delay:
+            return self.flush()
+        return list()
+
+    def flush(self):
+        """
+        Write all buffered blocks to the store.
+
+        Returns:
+        --------
+        <list of str> errors from this flush (duplicates are not errors)
+        """
+        self.last_flush = time.time()
+        if not self.buffer:
+            return list()
+        docs = self.buffer
+        self.buffer = list()
+        n, dups, errors, failed = self.store.insertMany(docs)
+        self.inserted += n
+        self.duplicates += dups
+        if dups:
+            logging.info("Skipped {} blocks already stored".format(dups))
+        for e in errors:
+            logging.error("Error inserting block: {}".format(e))
+        self.errors.extend(errors)
+        if self.on_flush:
+            failed = set(failed)
+            self.on_flush(
+                [d["number"] for d in docs if d["number"] not in failed])
+        return errors
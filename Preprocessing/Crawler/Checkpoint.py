@@ -0,0 +1,142 @@
+"""A small durable record of which blocks the crawler has stored."""
+
+import json
+import logging
+import os
+import tempfile
+
+
+class Checkpoint(object):
+    """
+    Track the blocks stored in mongo without scanning the collection.
+
+    Description:
+    ------------
+    The record holds the contiguous high-water mark (every block from 1 to
+    high_water is stored), the highest stored block, and the holes (missing
+    half-open ranges) between them. It is small, so it is rewritten in full
+    after each committed batch: the new record goes to a temporary file
+    which then atomically replaces the old one, so a crash leaves either the
+    old or the new record, never a torn one. A record that cannot be read
+    anyway is ignored by load(), as if there were none.
+
+    Parameters:
+    -----------
+    path <str>  # The checkpoint file (JSON)
+
+    Usage:
+    ------
+        cp = Checkpoint("crawler_checkpoint.json")
+        if not cp.load():
+            cp.reset(highest, crawler_util.findGaps(client, 1, highest + 1))
+        cp.commit([1001, 1002, 1003])
+        missing = cp.gaps(1, 2000000)
+    """
+
+    def __init__(self, path):
+        """Initialize an empty record (nothing stored)."""
+        self.path = path
+        self.high_water = 0
+        self.highest = 0
+        self.holes = list()
+
+    def load(self):
+        """Read the record from disk. Returns False if there is none."""
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+            high_water = int(state["high_water"])
+            highest = int(state["highest"])
+            holes = [(int(a), int(b)) for a, b in state["holes"]]
+        except (ValueError, KeyError, TypeError) as err:
+            # Treated as no checkpoint, so the store is scanned instead
+            logging.warning("Ignoring unreadable checkpoint {}: {}".format(
+                self.path, err))
+            return False
+        self.high_water, self.highest, self.holes = high_water, highest, holes
+        return True
+
+    def save(self):
+        """Atomically replace the record on disk."""
+        state = {
+            "high_water": self.high_water,
+            "highest": self.highest,
+            "holes": self.holes
+        }
+        # A temporary file of our own, so processes saving the same
+        # record at once cannot write into each other's
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + ".", suffix=".tmp",
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def reset(self, highest, holes):
+        """
+        Replace the record with the result of a full scan.
+
+        Params:
+        -------
+        highest <int>: the highest block stored
+        holes <list of tuple>: missing (a, b) ranges below highest
+        """
+        self.highest = highest
+        self.holes = [(a, b) for a, b in holes if a < highest + 1]
+        self._advance()
+        self.save()
+
+    def _advance(self):
+        """Recompute the high-water mark from the holes."""
+        if self.holes and self.holes[0][0] <= 1:
+            self.holes[0] = (max(self.holes[0][0], 1), self.holes[0][1])
+        self.high_water = self.holes[0][0] - 1 if self.holes else self.highest
+
+    def commit(self, numbers):
+        """Record that the given block numbers are now stored, and save."""
+        numbers = sorted(set(numbers))
+        if not numbers:
+            return
+        # Anything between the old and new highest block is a hole until
+        # it is committed
+        if numbers[-1] > self.highest:
+            self.holes.append((self.highest + 1, numbers[-1] + 1))
+            self.highest = numbers[-1]
+
+        # Cut each committed block out of the holes
+        holes = list()
+        i = 0
+        for a, b in self.holes:
+            while i < len(numbers) and numbers[i] < a:
+                i += 1
+            start = a
+            while i < len(numbers) and numbers[i] < b:
+                if numbers[i] > start:
+                    holes.append((start, numbers[i]))
+                start = numbers[i] + 1
+                i += 1
+            if start < b:
+                holes.append((start, b))
+        self.holes = holes
+        self._advance()
+        self.save()
+
+    def gaps(self, start, end):
+        """The missing (a, b) ranges in [start, end), like findGaps."""
+        out = list()
+        for a, b in self.holes + [(self.highest + 1, max(end, self.highest + 1))]:
+            a, b = max(a, start), min(b, end)
+            if a < b:
+                if out and out[-1][1] == a:
+                    out[-1] = (out[-1][0], b)
+                else:
+                    out.append((a, b))
+        return out
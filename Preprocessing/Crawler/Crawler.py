@@ -1,9 +1,20 @@
 """A client to interact with node and to save data to mongo."""
 
 from pymongo import MongoClient
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import crawler_util
-import requests
-import json
+from BlockStore import MongoStore
+from BlockWriter import BlockWriter
+from Checkpoint import Checkpoint
+from LeaseManager import LeaseManager
+from AddressTable import AddressTable
+from RawArchive import RawArchive
+from ReorgBuffer import ReorgBuffer
+from RPCClient import RPCClient
+from TxnIndex import TxnIndex
+import multiprocessing
+import queue
 import sys
 import os
 import logging
@@ -34,7 +45,40 @@ class Crawler(object):
     -----------
     rpc_port: <int> default 8545 	# The port on which geth RPC can be called
     host: <string> default "http://localhost" # The geth host
+    ipc_path: <string> default None	# Path to geth.ipc; used instead of
+                                    # host/rpc_port when given
     start: <bool> default True		# Create the graph upon instantiation
+    db_name: <string> default "blockchain"	# The mongo database to fill
+    store: <BlockStore> default None	# Where blocks are written; a
+                                    # MongoStore of db_name by default
+    mongo_client: <mongodb Client> default None	# The blocks collection
+                                    # (from crawler_util.initMongo); mongo
+                                    # on localhost is only connected to
+                                    # when something needs it
+    compact: <bool> default False	# Use the compact (binary) schema for
+                                    # the default MongoStore
+    txn_index: <bool> default False	# Also write each transaction to the
+                                    # flat, indexed txns collection (see
+                                    # TxnIndex) from the default MongoStore
+    embed_txns: <bool> default True	# Keep transactions inside the block
+                                    # documents too (only with txn_index)
+    batch_size: <int> default 100	# Blocks requested per JSON-RPC batch
+    workers: <int> default 4		# Threads fetching/decoding batches
+    max_in_flight: <int> default 8	# Batches fetched ahead of the writer
+    flush_size: <int> default 500	# Blocks buffered per bulk insert
+    checkpoint_path: <string> default True	# Where to record progress
+                                    # (None to disable); True names it
+                                    # after the store (see checkpointPath)
+    verify: <bool> default False	# Rescan mongo for missing blocks instead
+                                    # of trusting the checkpoint
+    archive_path: <string> default None	# Keep every block geth sends
+                                    # (as JSON) in a RawArchive in this
+                                    # directory
+    discover_contracts: <bool> default False	# Look up the receipts of
+                                    # contract creations and store the new
+                                    # address as the txn's "creates"
+    address_table: <string> default None	# Add every address seen to
+                                    # the AddressTable in this directory
 
     Usage:
     ------
@@ -47,9 +91,32 @@ class Crawler(object):
     Get the data from a particular block:
         block = crawler.getBlock(block_number)
 
+    Get the data from several blocks in a single batched request:
+        blocks = crawler.getBlocks([n1, n2, n3])
+
     Save the block to mongo. This will fail if the block already exists:
         crawler.saveBlock(block)
 
+    Backfill a range of blocks with several worker processes:
+        crawler.runParallel(1, 1000000, processes=8)
+
+    Share the work with other crawlers (on any host) using the same mongo:
+        crawler.runDistributed()
+
+    Decode blocks again from the archive (e.g. after changing what
+    decodeBlockFast keeps) without asking geth:
+        crawler = Crawler(start=False, archive_path="/data/raw")
+        crawler.redecode()
+
+    Follow the head of the chain, storing each new block as it arrives:
+        for head in crawler.follow():
+            print(head)
+
+    Keep a ContractMap up to date while crawling:
+        crawler = Crawler(start=False, discover_contracts=True)
+        crawler.onContracts(cmap.add)
+        crawler.run()
+
     """
 
     def __init__(
@@ -57,51 +124,224 @@ class Crawler(object):
         start=True,
         rpc_port=8545,
         host="http://localhost",
-        delay=0.0001
+        ipc_path=None,
+        db_name=crawler_util.DB_NAME,
+        store=None,
+        mongo_client=None,
+        compact=False,
+        txn_index=False,
+        embed_txns=True,
+        batch_size=100,
+        workers=4,
+        max_in_flight=8,
+        flush_size=500,
+        checkpoint_path=True,
+        verify=False,
+        archive_path=None,
+        discover_contracts=False,
+        address_table=None
     ):
         """Initialize the Crawler."""
         logging.debug("Starting Crawler")
+        # Keep the options so worker processes can build their own Crawler
+        # (a store holds open connections, so it is not passed on)
+        self.options = {
+            "rpc_port": rpc_port,
+            "host": host,
+            "ipc_path": ipc_path,
+            "db_name": db_name,
+            "compact": compact,
+            "txn_index": txn_index,
+            "embed_txns": embed_txns,
+            "batch_size": batch_size,
+            "workers": workers,
+            "max_in_flight": max_in_flight,
+            "flush_size": flush_size,
+            "checkpoint_path": checkpoint_path,
+            "archive_path": archive_path,
+            "discover_contracts": discover_contracts,
+            "address_table": address_table
+        }
         self.url = "{}:{}".format(host, rpc_port)
-        self.headers = {"content-type": "application/json"}
+        # A pooled client shared by all of the fetching threads. It paces
+        # requests to geth adaptively, so no fixed delay is needed.
+        self.rpc = RPCClient(self.url, ipc_path=ipc_path)
 
-        # Initializes to default host/port = localhost/27017
-        self.mongo_client = crawler_util.initMongo(MongoClient())
+        # The mongo collection of blocks, connected to on first use (a
+        # Crawler writing to another store may never need it)
+        self.db_name = db_name
+        self._mongo_client = mongo_client
+        # A flat copy of every transaction, for per-address queries
+        self.txn_index = TxnIndex(self.mongo_client.database) \
+            if txn_index else None
+        # The backend parsed blocks are written to
+        self.store = store if store is not None else MongoStore(
+            self.mongo_client,
+            compact=compact,
+            txn_index=self.txn_index,
+            embed=embed_txns or not txn_index)
         # The max block number that is in mongo
         self.max_block_mongo = None
         # The max block number in the public blockchain
         self.max_block_geth = None
         # Record errors for inserting block data into mongo
         self.insertion_errors = list()
-        # Make a stack of block numbers that are in mongo
-        self.block_queue = crawler_util.makeBlockQueue(self.mongo_client)
-        # The delay between requests to geth
-        self.delay = delay
+        # Record (block number, error) for blocks geth sent that we could
+        # not decode. These blocks are not stored.
+        self.decode_errors = list()
+        # Functions called with the first rewritten block number when
+        # follow() rewrites blocks after a chain reorganization
+        self.reorg_listeners = list()
+        # Look up contracts created by the blocks we fetch, and call these
+        # functions with the new addresses
+        self.discover_contracts = discover_contracts
+        self.contract_listeners = list()
+        # Ids for every address, shared with the analysis code
+        self.address_table = AddressTable(address_table) \
+            if address_table else None
+        # A durable record of the blocks stored, updated after every bulk
+        # insert, so we know where we left off without scanning mongo
+        self.checkpoint = None
+        self.checkpoint_loaded = False
+        if checkpoint_path is True:
+            checkpoint_path = checkpointPath(self.store, db_name)
+        if checkpoint_path:
+            self.checkpoint = Checkpoint(checkpoint_path)
+            self.checkpoint_loaded = self.checkpoint.load()
+        # Raw responses from geth, kept so blocks can be decoded again
+        self.archive = RawArchive(archive_path) if archive_path else None
+        # Buffers blocks written by add_blocks into bulk inserts
+        self.writer = BlockWriter(
+            self.store,
+            max_docs=flush_size,
+            on_flush=self.checkpoint.commit if self.checkpoint else None)
+        # The number of blocks requested from geth in a single batch
+        self.batch_size = max(int(batch_size), 1)
+        # The number of threads fetching and decoding batches of blocks
+        self.workers = max(int(workers), 1)
+        # The number of batches that may be fetched ahead of the writer.
+        # This bounds memory to roughly max_in_flight*batch_size blocks.
+        self.max_in_flight = max(int(max_in_flight), self.workers)
 
         if start:
             self.max_block_mongo = self.highestBlockMongo()
             self.max_block_geth = self.highestBlockEth()
-            self.run()
+            self.run(verify=verify)
+
+    @property
+    def mongo_client(self):
+        """The blocks collection in mongo (connected to on first use)."""
+        if self._mongo_client is None:
+            # Initializes to default host/port = localhost/27017
+            self._mongo_client = crawler_util.initMongo(
+                MongoClient(), self.db_name)
+        return self._mongo_client
 
     def _rpcRequest(self, method, params, key):
         """Make an RPC request to geth on port 8545."""
-        payload = {
-            "method": method,
-            "params": params,
-            "jsonrpc": "2.0",
-            "id": 0
-        }
-        time.sleep(self.delay)
-        res = requests.post(
-              self.url,
-              data=json.dumps(payload),
-              headers=self.headers).json()
-        return res[key]
+        return self.rpc.request(method, params, key)
+
+    def _rpcBatchRequest(self, calls, key):
+        """Make a batch of RPC requests to geth in a single POST."""
+        return self.rpc.batch(calls, key)
+
+    def _archive(self, numbers, data):
+        """
+        Append blocks to the archive, if there is one.
+
+        The transport has already parsed the response, so each block is
+        serialized again with fast_dumps (all fields, maybe not the same
+        bytes geth sent).
+        """
+        if self.archive:
+            for n, d in zip(numbers, data):
+                if d is not None:
+                    self.archive.append(n, crawler_util.fast_dumps(d))
+
+    def _decode(self, n, data):
+        """Decode a block, recording (rather than storing) failures."""
+        try:
+            return crawler_util.decodeBlockFast(data)
+        except crawler_util.DecodeError as err:
+            logging.error("Could not decode block {}: {}".format(n, err))
+            self.decode_errors.append((n, str(err)))
+            return None
 
     def getBlock(self, n):
         """Get a specific block from the blockchain and filter the data."""
         data = self._rpcRequest("eth_getBlockByNumber", [hex(n), True], "result")
-        block = crawler_util.decodeBlock(data)
-        return block
+        self._archive([n], [data])
+        b = self._decode(n, data)
+        if b:
+            self._enrich([b])
+        return b
+
+    def getBlocks(self, numbers):
+        """
+        Get several blocks from the blockchain in one batched request.
+
+        Params:
+        -------
+        numbers <list of int>
+
+        Returns:
+        --------
+        <list> of parsed blocks (or None if a block could not be decoded)
+        in the same order as numbers
+        """
+        calls = [("eth_getBlockByNumber", [hex(n), True]) for n in numbers]
+        data = self._rpcBatchRequest(calls, "result")
+        self._archive(numbers, data)
+        blocks = [self._decode(n, d) for n, d in zip(numbers, data)]
+        self._enrich([b for b in blocks if b])
+        return blocks
+
+    def _enrich(self, blocks):
+        """Find new contracts and intern addresses of decoded blocks."""
+        if self.discover_contracts:
+            self._discoverContracts(blocks)
+        if self.address_table is not None:
+            self.address_table.intern([
+                a for b in blocks for t in b["transactions"]
+                for a in (t["from"], t["to"]) if a
+            ])
+
+    def _discoverContracts(self, blocks):
+        """
+        Record the contracts created in blocks.
+
+        The receipts of every contract creation in blocks are fetched in
+        batches; each creation gets the new address as "creates", and the
+        contract listeners are called with the new addresses. Contracts
+        created by other contracts have no creation transaction of their
+        own and are not found this way.
+        """
+        creations = [
+            t for b in blocks for t in b["transactions"]
+            if t["to"] is None and "hash" in t
+        ]
+        if not creations:
+            return
+        addresses = crawler_util.contractAddresses(
+            self.rpc, [t["hash"] for t in creations], self.batch_size)
+        found = list()
+        for t, a in zip(creations, addresses):
+            if a:
+                t["creates"] = a
+                found.append(a)
+        if found:
+            for f in self.contract_listeners:
+                f(found)
+
+    def onContracts(self, callback):
+        """
+        Register callback(addresses) to be called with new contracts.
+
+        Requires discover_contracts=True. It is called from the threads
+        fetching blocks, as soon as the receipts for a batch are in (before
+        the blocks are stored), e.g. with ContractMap.add.
+        """
+        self.contract_listeners.append(callback)
 
     def highestBlockEth(self):
         """Find the highest numbered block in geth."""
@@ -110,64 +350,541 @@ class Crawler(object):
 
     def saveBlock(self, block):
         """Insert a given parsed block into mongo."""
-        e = crawler_util.insertMongo(self.mongo_client, block)
+        e = self.store.insert(block)
         if e:
             self.insertion_errors.append(e)
+        elif self.checkpoint:
+            self.checkpoint.commit([block["number"]])
 
     def highestBlockMongo(self):
         """Find the highest numbered block in the mongo database."""
-        highest_block = crawler_util.highestBlock(self.mongo_client)
+        highest_block = self.store.highestBlock()
         logging.info("Highest block found in mongodb:{}".format(highest_block))
         return highest_block
 
+    def findGaps(self, start=1, end=None, verify=False):
+        """
+        Find the ranges of blocks in [start, end) that are missing in mongo.
+
+        end defaults to the highest block in mongo. Returns a list of
+        half-open (a, b) ranges. The answer comes from the checkpoint if
+        there is one, unless verify=True, in which case mongo is scanned.
+        """
+        if end is None:
+            end = self.highestBlockMongo()
+        if self.checkpoint_loaded and not verify:
+            return self.checkpoint.gaps(start, end)
+        return self.store.findGaps(start, end)
+
+    def verifyCheckpoint(self):
+        """
+        Rebuild the checkpoint from a full scan of mongo.
+
+        Returns the missing (a, b) ranges below the highest stored block.
+        """
+        highest = self.highestBlockMongo()
+        gaps = self.store.findGaps(1, highest + 1)
+        if self.checkpoint:
+            self.checkpoint.reset(highest, gaps)
+            self.checkpoint_loaded = True
+        return gaps
+
     def add_block(self, n):
         """Add a block to mongo."""
         b = self.getBlock(n)
+        # Blocks that failed to decode are left out so they show up as gaps
         if b:
             self.saveBlock(b)
-            time.sleep(0.001)
-        else:
-            self.saveBlock({"number": n, "transactions": []})
 
-    def run(self):
+    def _fetchBatch(self, batch):
+        """Fetch and decode a batch of blocks (runs on a worker thread)."""
+        # Blocks that failed to decode are left out so they show up as gaps
+        return [b for b in self.getBlocks(batch) if b]
+
+    def add_blocks(self, numbers, progress=False):
+        """
+        Add several blocks to mongo through a pipeline.
+
+        Description:
+        ------------
+        Batches of self.batch_size blocks are fetched and decoded on
+        self.workers threads while this thread writes finished batches to
+        mongo. At most self.max_in_flight batches are outstanding at once;
+        a new batch is only submitted once the oldest one has been written,
+        so blocks are always saved in the order they are given. Blocks are
+        written with buffered bulk inserts (see BlockWriter), and the
+        buffer is flushed before returning.
+
+        Params:
+        -------
+        numbers <iterable of int>
+        progress <bool>, default False: show a progress bar over batches
+        """
+        numbers = list(numbers)
+        batches = [
+            numbers[i:i + self.batch_size]
+            for i in range(0, len(numbers), self.batch_size)
+        ]
+        if progress:
+            bar = tqdm.tqdm(total=len(batches))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = deque()
+            for batch in batches:
+                # Backpressure: wait on the writer before fetching more
+                if len(in_flight) >= self.max_in_flight:
+                    self._writeBatch(in_flight.popleft().result())
+                    if progress:
+                        bar.update(1)
+                in_flight.append(pool.submit(self._fetchBatch, batch))
+            while in_flight:
+                self._writeBatch(in_flight.popleft().result())
+                if progress:
+                    bar.update(1)
+        self.flushBlocks()
+
+        if progress:
+            bar.close()
+
+    def _writeBatch(self, blocks):
+        """Save a batch of parsed blocks in order (the single writer)."""
+        for b in blocks:
+            e = self.writer.add(b)
+            self.insertion_errors.extend(e)
+
+    def flushBlocks(self):
+        """Write any blocks still buffered by add_blocks to mongo."""
+        if self.archive:
+            self.archive.flush()
+        e = self.writer.flush()
+        self.insertion_errors.extend(e)
+
+    def redecode(self, start=1, end=None):
+        """
+        Decode archived blocks in [start, end) again and overwrite them.
+
+        Description:
+        ------------
+        Reads the archived blocks from the RawArchive (no RPC calls), decodes
+        them with the current decoder and replaces the stored blocks, one
+        flush_size batch at a time.
+
+        Returns:
+        --------
+        <int> the number of blocks rewritten
+        """
+        assert self.archive, "redecode needs a Crawler with an archive_path"
+        batch = list()
+        count = 0
+        for n, raw in self.archive.iterate(start, end):
+            b = self._decode(n, raw)
+            if b:
+                batch.append(b)
+            if len(batch) >= self.writer.max_docs:
+                self.store.replace(batch)
+                count += len(batch)
+                batch = list()
+        if batch:
+            self.store.replace(batch)
+            count += len(batch)
+        return count
+
+    def run(self, verify=False):
         """
         Run the process.
 
         Iterate through the blockchain on geth and fill up mongodb
-        with block data.
+        with block data. Missing blocks are looked up in the checkpoint;
+        mongo is only scanned if there is no checkpoint or verify=True.
         """
         logging.debug("Processing geth blockchain:")
         logging.info("Highest block found as: {}".format(self.max_block_geth))
-        logging.info("Number of blocks to process: {}".format(
-            len(self.block_queue)))
 
         # Make sure the database isn't missing any blocks up to this point
         logging.debug("Verifying that mongo isn't missing any blocks...")
-        self.max_block_mongo = 1
-        if len(self.block_queue) > 0:
-            print("Looking for missing blocks...")
-            self.max_block_mongo = self.block_queue.pop()
-            for n in tqdm.tqdm(range(1, self.max_block_mongo)):
-                if len(self.block_queue) == 0:
-                    # If we have reached the max index of the queue,
-                    # break the loop
-                    break
-                else:
-                    # -If a block with number = current index is not in
-                    # the queue, add it to mongo.
-                    # -If the lowest block number in the queue (_n) is
-                    # not the current running index (n), then _n > n
-                    # and we must add block n to mongo. After doing so,
-                    # we will add _n back to the queue.
-                    _n = self.block_queue.popleft()
-                    if n != _n:
-                        self.add_block(n)
-                        self.block_queue.appendleft(_n)
-                        logging.info("Added block {}".format(n))
+        self.max_block_mongo = max(self.highestBlockMongo(), 1)
+        print("Looking for missing blocks...")
+        if verify or not self.checkpoint_loaded:
+            # One scan of mongo, which also rebuilds the checkpoint
+            gaps = self.verifyCheckpoint()
+        else:
+            gaps = self.findGaps(1, self.max_block_mongo)
+        missing = sum(b - a for a, b in gaps)
+        logging.info("Number of missing blocks: {}".format(missing))
+        for a, b in gaps:
+            self.add_blocks(range(a, b))
+        if missing:
+            logging.info("Added {} missing blocks".format(missing))
 
         # Get all new blocks
         print("Processing remainder of the blockchain...")
-        for n in tqdm.tqdm(range(self.max_block_mongo, self.max_block_geth)):
-            self.add_block(n)
+        self.add_blocks(
+            range(self.max_block_mongo, self.max_block_geth), progress=True)
 
         print("Done!\n")
+
+    def sync(self):
+        """
+        Catch mongo up with geth once.
+
+        Missing blocks below the highest stored block are filled in first,
+        then everything up to the head of geth is added in one pipelined
+        add_blocks call.
+        """
+        gethBlock = self.highestBlockEth()
+        mongoBlock = self.highestBlockMongo()
+        # Fill in any holes below the highest block first
+        for a, b in self.findGaps(1, mongoBlock):
+            print("Filling missing blocks {} to {}...".format(a, b - 1))
+            self.add_blocks(range(a, b))
+        if gethBlock > mongoBlock:
+            print("Syncing Mongo...")
+            # mongoBlock is already stored; sync through gethBlock inclusive.
+            # One call keeps up to max_in_flight batches fetching at once.
+            self.add_blocks(
+                range(mongoBlock + 1, gethBlock + 1), progress=True)
+
+    def _newBlockFilter(self):
+        """Install a new block filter in geth. Returns None if unsupported."""
+        try:
+            return self._rpcRequest("eth_newBlockFilter", [], "result")
+        except KeyError:
+            logging.warning("eth_newBlockFilter unsupported; polling instead")
+            return None
+
+    def _waitForHead(self, last, filter_id, poll_interval):
+        """
+        Sleep until geth has a block above last. Returns (head, filter_id).
+
+        Each check is a single cheap call (eth_getFilterChanges, or
+        eth_blockNumber without a filter) followed by a sleep, so waiting
+        costs next to no CPU.
+        """
+        while True:
+            if filter_id is not None:
+                try:
+                    changes = self._rpcRequest(
+                        "eth_getFilterChanges", [filter_id], "result")
+                except KeyError:
+                    # Geth drops filters that are not polled for a while
+                    # (or when it restarts); install a new one
+                    changes = None
+                if changes is None:
+                    filter_id = self._newBlockFilter()
+                    changes = True
+                if changes:
+                    head = self.highestBlockEth()
+                    if head > last:
+                        return head, filter_id
+            else:
+                head = self.highestBlockEth()
+                if head > last:
+                    return head, filter_id
+            time.sleep(poll_interval)
+
+    def onReorg(self, callback):
+        """
+        Register callback(n) to be called when follow() rewrites blocks.
+
+        n is the lowest block that was rewritten; every stored block from n
+        up has been replaced, so anything built from those blocks (e.g. a
+        TxnGraph whose end_block is above n) is stale.
+        """
+        self.reorg_listeners.append(callback)
+
+    def _rewind(self, tail, n):
+        """
+        Rewrite stored blocks from n down to where geth's chain agrees.
+
+        Returns the lowest rewritten block number (n + 1 if none were).
+        """
+        replaced = list()
+        m = n
+        while m >= 1:
+            stored = tail.hashOf(m)
+            if stored is None:
+                # Outside the window: assume it matches
+                break
+            canon = self.getBlock(m)
+            if canon is None or canon["hash"] == stored:
+                break
+            replaced.append(canon)
+            m -= 1
+        fork = m + 1
+        if replaced and tail.lowest() is not None and fork <= tail.lowest():
+            logging.error("Reorg is deeper than the {} block window; blocks "
+                "below {} may be stale".format(tail.depth, fork))
+        replaced.reverse()
+        tail.rollback(fork)
+        for b in replaced:
+            tail.push(b)
+        if replaced:
+            logging.warning("Reorg: rewriting blocks {}-{}".format(fork, n))
+            self.store.replace(replaced)
+            for callback in self.reorg_listeners:
+                callback(fork)
+        return fork
+
+    def _addHead(self, tail, last, head):
+        """
+        Add blocks last+1 to head, checking each one against the tail.
+
+        Returns the highest block that is now stored. This is below head if
+        a block could not be decoded or the chain changed mid-way; the rest
+        is picked up on the next call.
+        """
+        for i in range(last + 1, head + 1, self.batch_size):
+            numbers = list(range(i, min(i + self.batch_size, head + 1)))
+            for n, b in zip(numbers, self.getBlocks(numbers)):
+                if b is None:
+                    self.flushBlocks()
+                    return n - 1
+                if not tail.extends(b):
+                    self.flushBlocks()
+                    self._rewind(tail, n - 1)
+                    if not tail.extends(b):
+                        # The chain moved again while rewinding
+                        return n - 1
+                tail.push(b)
+                self._writeBatch([b])
+        self.flushBlocks()
+        return head
+
+    def follow(self, poll_interval=0.5, reorg_depth=64):
+        """
+        Follow the head of the chain, adding each new block to mongo.
+
+        Description:
+        ------------
+        Catches mongo up to geth, then waits for new blocks using a geth
+        block filter (eth_newBlockFilter/eth_getFilterChanges), falling back
+        to polling eth_blockNumber. New blocks are stored within roughly
+        poll_interval seconds of geth seeing them. This is a generator: it
+        yields the new highest stored block after each update, and runs
+        until the caller stops iterating.
+
+        The hashes of the last reorg_depth blocks are kept in a ReorgBuffer.
+        If a new block does not build on the stored chain, the orphaned
+        blocks are rewritten from geth and the listeners registered with
+        onReorg() are told the lowest block that changed.
+
+        Parameters:
+        -----------
+        poll_interval <float>, default 0.5: seconds between checks for
+            new blocks
+        reorg_depth <int>, default 64: the number of recent blocks checked
+            for reorgs
+        """
+        tail = ReorgBuffer(reorg_depth)
+        tail.load(self.store)
+        filter_id = self._newBlockFilter()
+        last = self.highestBlockMongo()
+        head = self.highestBlockEth()
+        while True:
+            if head > last:
+                # Blocks well below the head cannot be reorged; bulk add them
+                safe = head - reorg_depth
+                if safe > last:
+                    self.add_blocks(range(last + 1, safe + 1))
+                    tail.load(self.store)
+                    last = safe
+                stored = self._addHead(tail, last, head)
+                if stored == last:
+                    time.sleep(poll_interval)
+                else:
+                    last = stored
+                    self.max_block_mongo = last
+                    yield last
+            head, filter_id = self._waitForHead(last, filter_id, poll_interval)
+
+    def runParallel(self, start=1, end=None, processes=4, max_restarts=3):
+        """
+        Backfill [start, end) using several worker processes.
+
+        Description:
+        ------------
+        The range is split into one contiguous block range per process.
+        Each worker builds its own Crawler (and so its own RPC and mongo
+        connections), fetches only the blocks of its range that are missing
+        from mongo, and reports every committed chunk back to this process,
+        which shows the aggregate progress. If a worker dies it is started
+        again on the same range; since it looks for gaps first, only the
+        unfinished part of the range is fetched again. Workers build their
+        own MongoStore from the options, and all append to the same
+        RawArchive if there is one.
+
+        Parameters:
+        -----------
+        start <int>, default 1
+        end <int>, default the highest block in geth
+        processes <int>, default 4: the number of worker processes
+        max_restarts <int>, default 3: restarts allowed per range
+
+        Returns:
+        --------
+        <list of tuple> (a, b) ranges whose worker kept failing
+        """
+        assert isinstance(self.store, MongoStore), \
+            "runParallel workers write to mongo (db_name); use a MongoStore"
+        if end is None:
+            end = self.highestBlockEth()
+        if end <= start:
+            return list()
+        ctx = multiprocessing.get_context("spawn")
+        progress = ctx.Queue()
+
+        step = max(-(-(end - start) // max(int(processes), 1)), 1)
+        ranges = [(a, min(a + step, end)) for a in range(start, end, step)]
+        total = sum(
+            b - a for r in ranges for a, b in self.findGaps(r[0], r[1]))
+
+        procs = dict()
+        restarts = {r: 0 for r in ranges}
+        failed = list()
+
+        def _spawn(r):
+            p = ctx.Process(
+                target=_rangeWorker,
+                args=(self.options, r[0], r[1], progress))
+            p.start()
+            procs[r] = p
+
+        for r in ranges:
+            _spawn(r)
+
+        bar = tqdm.tqdm(total=total)
+        while procs:
+            try:
+                bar.update(progress.get(timeout=1))
+            except queue.Empty:
+                pass
+            for r, p in list(procs.items()):
+                if p.is_alive():
+                    continue
+                p.join()
+                del procs[r]
+                if p.exitcode == 0:
+                    continue
+                if restarts[r] < max_restarts:
+                    restarts[r] += 1
+                    logging.warning("Worker for blocks {}-{} died ({}), "
+                        "restarting".format(r[0], r[1], p.exitcode))
+                    _spawn(r)
+                else:
+                    logging.error("Giving up on blocks {}-{}".format(*r))
+                    failed.append(r)
+
+        # Count anything reported after the last check
+        while True:
+            try:
+                bar.update(progress.get_nowait())
+            except queue.Empty:
+                break
+        bar.close()
+
+        # The workers do not share our checkpoint, so bring it up to date
+        if self.checkpoint:
+            self.verifyCheckpoint()
+        return failed
+
+
+    def runDistributed(self, start=1, end=None, lease_blocks=10000, ttl=60):
+        """
+        Backfill [start, end) together with other crawlers sharing mongo.
+
+        Description:
+        ------------
+        Block ranges are claimed from a LeaseManager until none are left.
+        While a range is being crawled its lease is renewed in the
+        background; if the lease is lost (e.g. this process stalled past
+        ttl and another crawler took over) the range is abandoned after the
+        current chunk. Ranges are only marked done once every block in them
+        is in mongo. Start as many of these as you like, on as many hosts as
+        you like. The crawler's checkpoint is not updated meanwhile (and is
+        rebuilt by the next run()).
+
+        Parameters:
+        -----------
+        start <int>, default 1
+        end <int>, default the highest block in geth
+        lease_blocks <int>, default 10000: blocks per lease
+        ttl <float>, default 60: seconds before an abandoned lease expires
+
+        Returns:
+        --------
+        <int> the number of ranges this crawler completed
+        """
+        if end is None:
+            end = self.highestBlockEth()
+        leases = LeaseManager(
+            self.mongo_client.database, lease_blocks=lease_blocks, ttl=ttl)
+        leases.ensureRanges(start, end)
+        step = self.writer.max_docs
+        completed = 0
+
+        # Other crawlers write to the same mongo, so a checkpoint of the
+        # blocks this process stored would be wrong (and processes on one
+        # host would all write its file). The next run() rebuilds it.
+        self.checkpoint_loaded = False
+        on_flush, self.writer.on_flush = self.writer.on_flush, None
+        try:
+            lease = leases.claim()
+            while lease:
+                a, b = max(lease["_id"], start), lease["end"]
+                logging.info("Claimed blocks {}-{}".format(a, b))
+                with leases.heartbeat(lease) as hb:
+                    # Other crawlers write too, so always ask mongo
+                    for gap_a, gap_b in self.findGaps(a, b, verify=True):
+                        for i in range(gap_a, gap_b, step):
+                            if hb.lost:
+                                break
+                            self.add_blocks(range(i, min(i + step, gap_b)))
+                        if hb.lost:
+                            break
+                if hb.lost:
+                    logging.warning("Abandoning blocks {}-{}".format(a, b))
+                elif not self.findGaps(a, b, verify=True):
+                    if leases.complete(lease):
+                        completed += 1
+                else:
+                    # Leave the lease to expire so the range is retried later
+                    # rather than claimed straight back by this crawler
+                    logging.error("Blocks {}-{} still incomplete: {}".format(
+                        a, b, self.insertion_errors[-1:]))
+                lease = leases.claim()
+        finally:
+            self.writer.on_flush = on_flush
+        return completed
+
+
+def checkpointPath(store, db_name=crawler_util.DB_NAME):
+    """
+    The default checkpoint file of a Crawler writing to store.
+
+    Each store gets its own file, since a checkpoint only describes the
+    blocks of one store: <store path>/crawler_checkpoint.json for stores
+    kept in a directory (ColumnarStore), DIR/crawler_checkpoint.json for
+    the default mongo database and DIR/crawler_checkpoint_<db>.json for
+    any other.
+    """
+    if getattr(store, "path", None):
+        return os.path.join(store.path, "crawler_checkpoint.json")
+    if isinstance(store, MongoStore):
+        db_name = store.client.database.name
+    if db_name == crawler_util.DB_NAME:
+        return os.path.join(DIR, "crawler_checkpoint.json")
+    return os.path.join(DIR, "crawler_checkpoint_{}.json".format(db_name))
+
+
+def _rangeWorker(options, start, end, progress):
+    """Backfill the missing blocks in [start, end) (runs in a subprocess)."""
+    # Only the parent process keeps a checkpoint
+    options = dict(options, checkpoint_path=None)
+    c = Crawler(start=False, **options)
+    step = c.writer.max_docs
+    for a, b in c.findGaps(start, end):
+        for i in range(a, b, step):
+            chunk = range(i, min(i + step, b))
+            # add_blocks flushes before returning, so the chunk is committed
+            c.add_blocks(chunk)
+            progress.put(len(chunk))
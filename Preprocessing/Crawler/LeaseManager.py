@@ -0,0 +1,157 @@
+"""Coordinate several crawlers through block-range leases stored in mongo."""
+
+import pymongo
+from pymongo import ReturnDocument
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_COLLECTION = "crawl_leases"
+
+
+class LeaseManager(object):
+    """
+    Hand out block ranges to crawler processes that share a mongo database.
+
+    Description:
+    ------------
+    The block chain is cut into ranges of lease_blocks blocks, aligned to
+    multiples of lease_blocks so every process agrees on the boundaries.
+    Each range is a document in the crawl_leases collection. A crawler
+    claims a range by atomically setting itself as the owner with an expiry
+    time, keeps the lease alive with heartbeats, and marks it done when
+    every block in the range is stored. A lease whose owner stops sending
+    heartbeats expires and can be claimed by another crawler.
+
+    Expiry times use the local wall clock, so hosts should be kept in sync
+    (e.g. with NTP) to well within ttl.
+
+    Parameters:
+    -----------
+    db <mongodb Database>             # Database holding the leases
+    owner <str> default None          # Unique name (defaults to host:pid:id)
+    lease_blocks <int> default 10000  # Blocks per range
+    ttl <float> default 60            # Seconds a lease lives without renewal
+
+    Usage:
+    ------
+        leases = LeaseManager(mongo_client.database)
+        leases.ensureRanges(1, 4000000)
+        lease = leases.claim()
+        with leases.heartbeat(lease) as hb:
+            ...  # crawl lease["_id"] to lease["end"], checking hb.lost
+        leases.complete(lease)
+    """
+
+    def __init__(self, db, owner=None, lease_blocks=10000, ttl=60):
+        """Initialize the lease collection."""
+        self.collection = db[LEASE_COLLECTION]
+        self.collection.create_index(
+            [("done", pymongo.ASCENDING), ("expires", pymongo.ASCENDING)])
+        self.owner = owner or "{}:{}:{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease_blocks = max(int(lease_blocks), 1)
+        self.ttl = ttl
+
+    def ensureRanges(self, start, end):
+        """
+        Make sure a lease document exists for every range in [start, end).
+
+        Safe to call from several processes at once. If the last range was
+        created with a smaller end (the chain has grown since), it is
+        extended and reopened.
+        """
+        first = (start // self.lease_blocks) * self.lease_blocks
+        for a in range(first, end, self.lease_blocks):
+            b = min(a + self.lease_blocks, end)
+            try:
+                self.collection.update_one(
+                    {"_id": a},
+                    {"$setOnInsert": {
+                        "end": b,
+                        "owner": None,
+                        "expires": 0,
+                        "done": False
+                    }},
+                    upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                # Another process inserted it first
+                pass
+            self.collection.update_one(
+                {"_id": a, "end": {"$lt": b}},
+                {"$set": {"end": b, "done": False}})
+
+    def claim(self):
+        """
+        Claim the lowest range that is not done and not actively leased.
+
+        Returns:
+        --------
+        <dict> the lease document, or None if there is no work left
+        """
+        now = time.time()
+        return self.collection.find_one_and_update(
+            {"done": False, "expires": {"$lt": now}},
+            {"$set": {"owner": self.owner, "expires": now + self.ttl}},
+            sort=[("_id", pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def renew(self, lease):
+        """Extend a lease. Returns False if it was lost to another crawler."""
+        res = self.collection.update_one(
+            {"_id": lease["_id"], "owner": self.owner},
+            {"$set": {"expires": time.time() + self.ttl}})
+        return res.matched_count == 1
+
+    def complete(self, lease):
+        """Mark a leased range as fully stored."""
+        res = self.collection.update_one(
+            {"_id": lease["_id"], "owner": self.owner},
+            {"$set": {"done": True, "owner": None, "expires": 0}})
+        return res.matched_count == 1
+
+    def release(self, lease):
+        """Give up a lease so another crawler can claim it right away."""
+        self.collection.update_one(
+            {"_id": lease["_id"], "owner": self.owner},
+            {"$set": {"owner": None, "expires": 0}})
+
+    def heartbeat(self, lease):
+        """Return a context manager that renews lease in the background."""
+        return _Heartbeat(self, lease)
+
+
+class _Heartbeat(object):
+    """Renew a lease every ttl/3 seconds until the context exits."""
+
+    def __init__(self, manager, lease):
+        self.manager = manager
+        self.lease = lease
+        # Set once a renewal fails; the holder should stop working
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.manager.ttl / 3.):
+            try:
+                if not self.manager.renew(self.lease):
+                    self.lost = True
+                    logging.warning("Lost lease on blocks {}-{}".format(
+                        self.lease["_id"], self.lease["end"]))
+                    return
+            except Exception as err:
+                # Keep trying; the lease only lapses after ttl
+                logging.error("Lease renewal failed: {}".format(err))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        return False
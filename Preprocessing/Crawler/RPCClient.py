@@ -0,0 +1,297 @@
+"""A pooled JSON-RPC client for talking to geth."""
+
+import requests
+from requests.adapters import HTTPAdapter
+from crawler_util import fast_loads
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of concurrent requests to geth.
+
+    Description:
+    ------------
+    The limit grows additively while requests succeed quickly and shrinks
+    multiplicatively when they fail or when latency rises well above the
+    fastest latency seen so far (i.e. geth is queueing work). Callers block
+    in acquire() until a slot is free.
+
+    Latency is compared per request: a payload of n requests is counted as
+    its latency divided by n, against the fastest seen for the same key
+    (e.g. the method). So a batch of 100 eth_getBlockByNumber calls is not
+    judged against a cheap eth_blockNumber.
+
+    Parameters:
+    -----------
+    initial <int> default 4         # Starting concurrency limit
+    minimum <int> default 1         # Never go below this many requests
+    maximum <int> default 64        # Never go above this many requests
+    tolerance <float> default 3.0   # Latency (as a multiple of the fastest
+                                    # observed latency for the same key)
+                                    # considered overload
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, tolerance=3.0):
+        """Initialize the limiter."""
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.tolerance = tolerance
+        self.in_flight = 0
+        # key --> the fastest latency per request seen so far. It drifts up
+        # slowly so a single lucky request does not pin the baseline forever.
+        self.best_latency = dict()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request slot is available and take it."""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, error=False, key=None, size=1):
+        """
+        Give back a slot and adjust the limit from the outcome.
+
+        Params:
+        -------
+        latency <float> default None: seconds the payload took
+        error <bool> default False: the payload failed
+        key <hashable> default None: what kind of payload it was
+        size <int> default 1: the number of requests in the payload
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if error:
+                self.limit = max(self.minimum, self.limit / 2.)
+            elif latency is not None:
+                latency = latency / max(size, 1)
+                best = self.best_latency.get(key)
+                best = latency if best is None else min(best*1.001, latency)
+                self.best_latency[key] = best
+                if latency > self.tolerance*best:
+                    self.limit = max(self.minimum, self.limit*0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1./self.limit)
+            self._cond.notify_all()
+
+
+class HTTPTransport(object):
+    """Send JSON-RPC payloads over HTTP with pooled keep-alive connections."""
+
+    # Errors worth retrying
+    retry_errors = (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.HTTPError
+    )
+
+    def __init__(self, url, pool_size=16, timeout=30):
+        """Initialize the session."""
+        self.url = url
+        self.timeout = timeout
+        self.headers = {"content-type": "application/json"}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def send(self, data):
+        """POST an encoded payload and return the decoded response."""
+        res = self.session.post(
+            self.url,
+            data=data,
+            headers=self.headers,
+            timeout=self.timeout)
+        if res.status_code >= 500:
+            raise requests.HTTPError("{} from geth".format(res.status_code))
+        return fast_loads(res.content)
+
+
+class IPCTransport(object):
+    """
+    Send JSON-RPC payloads over geth's unix domain socket (geth.ipc).
+
+    Geth answers each request (single or batch) with one JSON value on the
+    same connection, so a connection is used by one request at a time.
+    Idle connections are kept for reuse, up to pool_size of them.
+    """
+
+    # Errors worth retrying (covers resets, refusals and timeouts)
+    retry_errors = (OSError,)
+
+    def __init__(self, path, pool_size=16, timeout=30):
+        """Initialize an empty connection pool."""
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def _read(self, sock):
+        """Read from sock until a complete JSON value has arrived."""
+        buf = bytearray()
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                raise ConnectionError("geth closed the IPC connection")
+            buf += chunk
+            # Only try to parse once the data could be a complete value
+            if chunk.rstrip()[-1:] not in (b"}", b"]"):
+                continue
+            try:
+                return fast_loads(bytes(buf))
+            except ValueError:
+                continue
+
+    def send(self, data):
+        """Write an encoded payload and return the decoded response."""
+        try:
+            sock = self._idle.get_nowait()
+        except queue.Empty:
+            sock = self._connect()
+        try:
+            sock.sendall(data.encode() if isinstance(data, str) else data)
+            out = self._read(sock)
+        except Exception:
+            sock.close()
+            raise
+        if self._idle.qsize() < self.pool_size:
+            self._idle.put(sock)
+        else:
+            sock.close()
+        return out
+
+
+class RPCClient(object):
+    """
+    A JSON-RPC client with keep-alive connections, retries and rate control.
+
+    Description:
+    ------------
+    Requests go over HTTP through one requests.Session, so TCP connections
+    to geth are reused instead of opened per call, or, if ipc_path is given,
+    over geth's unix domain socket. Transport errors (connection
+    resets, timeouts, 5xx responses) are retried with exponential backoff,
+    and the number of concurrent requests is governed by an AdaptiveLimiter.
+    A single instance is safe to share between threads.
+
+    Parameters:
+    -----------
+    url <str> default "http://localhost:8545"   # The geth RPC endpoint
+    pool_size <int> default 16                  # Max pooled connections
+    retries <int> default 5                     # Attempts per request
+    backoff <float> default 0.1                 # First retry delay (seconds)
+    timeout <float> default 30                  # Per request timeout
+    limiter <AdaptiveLimiter> default None      # Shared limiter (optional)
+    ipc_path <str> default None                 # Use this geth.ipc socket
+                                                # instead of url
+
+    Usage:
+    ------
+        rpc = RPCClient("http://localhost:8545")
+        n = int(rpc.request("eth_blockNumber", []), 16)
+        blocks = rpc.batch([("eth_getBlockByNumber", [hex(1), True])])
+
+        # Talk to a geth on the same host over IPC
+        rpc = RPCClient(ipc_path="/home/me/.ethereum/geth.ipc")
+    """
+
+    def __init__(self,
+                url="http://localhost:8545",
+                pool_size=16,
+                retries=5,
+                backoff=0.1,
+                timeout=30,
+                limiter=None,
+                ipc_path=None):
+        """Initialize the transport and the limiter."""
+        self.url = url
+        self.ipc_path = ipc_path
+        self.retries = max(int(retries), 1)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = limiter or AdaptiveLimiter(maximum=pool_size)
+
+        if ipc_path:
+            self.transport = IPCTransport(ipc_path, pool_size, timeout)
+        else:
+            self.transport = HTTPTransport(url, pool_size, timeout)
+
+    def _post(self, payload):
+        """Send a payload, retrying transport errors with backoff."""
+        data = json.dumps(payload).encode()
+        # Latency is judged per request against payloads of the same methods
+        calls = payload if isinstance(payload, list) else [payload]
+        key = ",".join(sorted(set(c["method"] for c in calls)))
+        for attempt in range(self.retries):
+            self.limiter.acquire()
+            t0 = time.time()
+            try:
+                out = self.transport.send(data)
+            except self.transport.retry_errors as err:
+                self.limiter.release(error=True)
+                if attempt == self.retries - 1:
+                    raise
+                delay = self.backoff * 2**attempt
+                logging.warning("RPC error ({}), retrying in {}s".format(
+                    err, delay))
+                time.sleep(delay)
+                continue
+            except Exception:
+                self.limiter.release(error=True)
+                raise
+            self.limiter.release(
+                latency=time.time() - t0, key=key, size=len(calls))
+            return out
+
+    def request(self, method, params, key="result"):
+        """Make a single RPC request and return the given response field."""
+        payload = {
+            "method": method,
+            "params": params,
+            "jsonrpc": "2.0",
+            "id": 0
+        }
+        return self._post(payload)[key]
+
+    def batch(self, calls, key="result"):
+        """
+        Make a batch of RPC requests in a single round trip.
+
+        Params:
+        -------
+        calls <list>: (method, params) tuples
+        key <str>: the field to pull out of each response
+
+        Returns:
+        --------
+        <list> of values in the same order as calls (None if missing)
+        """
+        if not calls:
+            return list()
+        payload = [
+            {
+                "method": method,
+                "params": params,
+                "jsonrpc": "2.0",
+                "id": i
+            }
+            for i, (method, params) in enumerate(calls)
+        ]
+        res = self._post(payload)
+        # Geth may answer a batch in any order, so match on the id
+        by_id = {r.get("id"): r for r in res}
+        return [by_id.get(i, {}).get(key) for i in range(len(calls))]
@@ -0,0 +1,220 @@
+"""An append-only archive of the blocks eth_getBlockByNumber returned."""
+
+import contextlib
+import fcntl
+import glob
+import mmap
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+
+# Index record: block number, segment number, offset, compressed length
+INDEX_RECORD = struct.Struct("<QIQI")
+INDEX_DTYPE = np.dtype([
+    ("number", "<u8"),
+    ("segment", "<u4"),
+    ("offset", "<u8"),
+    ("length", "<u4")
+])
+
+
+class RawArchive(object):
+    """
+    Keep every block geth sent so it can be decoded again.
+
+    Description:
+    ------------
+    The Crawler archives the block object of each response as JSON. The
+    transports parse whole (batch) responses, so this is the parsed object
+    serialized again rather than the bytes geth wrote: every field and
+    value is kept as geth sent it, but key order and whitespace may
+    differ. append() stores whatever bytes it is given.
+
+    Responses are zlib-compressed and appended to segment files
+    (seg-000000.dat, seg-000001.dat, ...) of up to segment_bytes each. An
+    index file holds one fixed-size record per block (number, segment,
+    offset, length). Reads go through mmap, so re-decoding the chain runs
+    at disk speed instead of RPC speed. If a block is archived twice the
+    latest copy wins.
+
+    Several processes may append to one archive (e.g. runParallel
+    workers): appends take an exclusive lock on path/lock and write at the
+    current end of the newest segment, and the index records of a process
+    are only written by flush(), after its data is on disk.
+
+    Parameters:
+    -----------
+    path <str>                                # Directory of the archive
+    segment_bytes <int> default 256MB         # Start a new segment after
+    level <int> default 1                     # zlib compression level
+
+    Usage:
+    ------
+        archive = RawArchive("/data/raw")
+        archive.append(n, json_bytes)
+        archive.flush()
+        raw = archive.get(n)
+        for n, raw in archive.iterate(1, 100000):
+            ...
+    """
+
+    def __init__(self, path, segment_bytes=256*1024*1024, level=1):
+        """Open (or create) the archive."""
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_file = os.path.join(path, "index.dat")
+        self._lock_file = os.path.join(path, "lock")
+
+        with self._flock():
+            # Drop a partially written final index record (e.g. after a
+            # crash) so that new records stay aligned
+            if os.path.isfile(self._index_file):
+                size = os.path.getsize(self._index_file)
+                if size % INDEX_RECORD.size:
+                    with open(self._index_file, "r+b") as f:
+                        f.truncate(size - size % INDEX_RECORD.size)
+
+            segments = sorted(glob.glob(os.path.join(path, "seg-*.dat")))
+            self._segment = len(segments) - 1 if segments else 0
+            self._writer = open(self._segmentPath(self._segment), "ab")
+        self._index_writer = open(self._index_file, "ab")
+        # Index records of appends that were not flushed yet
+        self._pending = list()
+
+        # Lookup tables, rebuilt lazily after writes
+        self._numbers = None
+        self._records = None
+        self._maps = dict()
+
+    def _segmentPath(self, i):
+        return os.path.join(self.path, "seg-{:06d}.dat".format(i))
+
+    @contextlib.contextmanager
+    def _flock(self):
+        """Hold the archive's lock, shared with other processes."""
+        with open(self._lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _openSegment(self, i):
+        """Switch the writer to segment i (the old one is synced first)."""
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self._segment = i
+        self._writer = open(self._segmentPath(i), "ab")
+
+    def append(self, number, raw):
+        """Archive a response (bytes or str) for block number."""
+        if isinstance(raw, str):
+            raw = raw.encode()
+        data = zlib.compress(raw, self.level)
+        with self._lock, self._flock():
+            # Another process may have started a newer segment
+            i = self._segment
+            while os.path.exists(self._segmentPath(i + 1)):
+                i += 1
+            if i != self._segment:
+                self._openSegment(i)
+            self._writer.seek(0, os.SEEK_END)
+            offset = self._writer.tell()
+            if offset + len(data) > self.segment_bytes and offset > 0:
+                self._openSegment(self._segment + 1)
+                offset = 0
+            self._writer.write(data)
+            # Other processes append after this, so it must leave our buffer
+            self._writer.flush()
+            self._pending.append(INDEX_RECORD.pack(
+                number, self._segment, offset, len(data)))
+
+    def flush(self):
+        """Make everything appended so far durable and readable."""
+        with self._lock:
+            # Data goes to disk before the index entries that point at it
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            with self._flock():
+                self._index_writer.write(b"".join(self._pending))
+                self._index_writer.flush()
+                os.fsync(self._index_writer.fileno())
+            self._pending = list()
+            self._numbers = None
+
+    def close(self):
+        """Flush and close the archive."""
+        self.flush()
+        self._writer.close()
+        self._index_writer.close()
+        for m in self._maps.values():
+            m.close()
+
+    def _loadIndex(self):
+        """Build a sorted lookup table from the index file."""
+        n = os.path.getsize(self._index_file) // INDEX_DTYPE.itemsize
+        if n == 0:
+            records = np.zeros(0, dtype=INDEX_DTYPE)
+        else:
+            records = np.memmap(
+                self._index_file, dtype=INDEX_DTYPE, mode="r", shape=(n,))
+        # Stable sort, then keep the last record for each block number
+        order = np.argsort(records["number"], kind="stable")
+        records = np.asarray(records[order])
+        if len(records):
+            last = np.append(
+                records["number"][1:] != records["number"][:-1], True)
+            records = records[last]
+        self._records = records
+        self._numbers = records["number"]
+
+    def _map(self, segment, size):
+        """An mmap of a segment covering at least size bytes."""
+        m = self._maps.get(segment)
+        if m is None or len(m) < size:
+            # The current segment grows, so it may need mapping again
+            if m is not None:
+                m.close()
+            with open(self._segmentPath(segment), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = m
+        return m
+
+    def _read(self, record):
+        offset = int(record["offset"])
+        end = offset + int(record["length"])
+        m = self._map(int(record["segment"]), end)
+        return zlib.decompress(m[offset:end])
+
+    def numbers(self):
+        """The sorted block numbers in the archive (a numpy array)."""
+        if self._numbers is None:
+            self._loadIndex()
+        return self._numbers
+
+    def __contains__(self, number):
+        numbers = self.numbers()
+        i = np.searchsorted(numbers, number)
+        return i < len(numbers) and numbers[i] == number
+
+    def get(self, number):
+        """The archived response for block number (bytes), or None."""
+        numbers = self.numbers()
+        i = np.searchsorted(numbers, number)
+        if i == len(numbers) or numbers[i] != number:
+            return None
+        return self._read(self._records[i])
+
+    def iterate(self, start=0, end=None):
+        """Yield (number, bytes) for archived blocks in [start, end)."""
+        numbers = self.numbers()
+        a = np.searchsorted(numbers, start)
+        b = len(numbers) if end is None else np.searchsorted(numbers, end)
+        for r in self._records[a:b]:
+            yield int(r["number"]), self._read(r)
@@ -0,0 +1,64 @@
+"""Remember the hashes of recent blocks so reorgs can be detected."""
+
+from collections import OrderedDict
+
+
+class ReorgBuffer(object):
+    """
+    A window of the hashes of the most recently stored blocks.
+
+    Description:
+    ------------
+    A new block belongs on top of the stored chain if its parentHash is the
+    hash we stored for the block before it. When it is not, the chain has
+    been reorganized and stored blocks need to be rewritten (see
+    Crawler.follow). Blocks stored without a hash (e.g. before hashes were
+    kept) are assumed to match.
+
+    Parameters:
+    -----------
+    depth <int> default 64  # The number of recent blocks to remember
+
+    Usage:
+    ------
+        tail = ReorgBuffer()
+        tail.load(store)
+        if tail.extends(block):
+            tail.push(block)
+    """
+
+    def __init__(self, depth=64):
+        """Initialize an empty window."""
+        self.depth = max(int(depth), 1)
+        # Block number --> block hash, oldest first
+        self.hashes = OrderedDict()
+
+    def load(self, store):
+        """Fill the window from the most recent blocks in a BlockStore."""
+        self.hashes = OrderedDict()
+        for d in store.recentBlocks(self.depth):
+            self.push(d)
+
+    def lowest(self):
+        """The lowest block number in the window (None if empty)."""
+        return next(iter(self.hashes), None)
+
+    def hashOf(self, n):
+        """The stored hash of block n, or None if it is unknown."""
+        return self.hashes.get(n)
+
+    def extends(self, block):
+        """Whether block can sit on top of the blocks in the window."""
+        parent = self.hashes.get(block["number"] - 1)
+        return parent is None or block.get("parentHash") in (None, parent)
+
+    def push(self, block):
+        """Add a block to the top of the window."""
+        self.hashes[block["number"]] = block.get("hash")
+        while len(self.hashes) > self.depth:
+            self.hashes.popitem(last=False)
+
+    def rollback(self, n):
+        """Forget block n and every block above it."""
+        for k in [k for k in self.hashes if k >= n]:
+            del self.hashes[k]
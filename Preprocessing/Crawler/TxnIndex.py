@@ -0,0 +1,225 @@
+"""A flat, indexed collection of transactions for per-address lookups."""
+
+import crawler_util
+import pymongo
+import pymongo.errors
+
+TXN_COLLECTION = "txns"
+
+
+class TxnIndex(object):
+    """
+    Keep one mongo document per transaction, indexed by address and block.
+
+    Description:
+    ------------
+    Block documents hold their transactions as an embedded array, so any
+    question about an address needs a scan of the whole collection. This
+    collection holds the same transactions flattened:
+
+        {"block", "i", "timestamp", "from", "to", "value", "data", ...}
+
+    where i is the position of the transaction in its block. It is indexed
+    on (from, block), (to, block) and (block, i); the last is unique, so
+    writing the same block twice is harmless, and also serves block range
+    scans. Addresses are stored as geth returns them (lowercase hex).
+
+    The crawler writes to it through MongoStore (see Crawler's txn_index
+    option); backfill() indexes blocks that were stored before.
+
+    Parameters:
+    -----------
+    db <mongodb Database>  # Database holding the collection
+
+    Usage:
+    ------
+        index = TxnIndex(MongoClient()[crawler_util.DB_NAME])
+        for t in index.history("0x...", start=1000000):
+            ...
+        for t in index.blockRange(1000000, 1000100, ["from", "to", "value"]):
+            ...
+    """
+
+    def __init__(self, db):
+        """Initialize the collection and its indexes."""
+        self.collection = db[TXN_COLLECTION]
+        self.collection.create_index(
+            [("block", pymongo.ASCENDING), ("i", pymongo.ASCENDING)],
+            unique=True)
+        self.collection.create_index(
+            [("from", pymongo.ASCENDING), ("block", pymongo.ASCENDING)])
+        self.collection.create_index(
+            [("to", pymongo.ASCENDING), ("block", pymongo.ASCENDING)])
+
+    # PRIVATE
+
+    def _flatten(self, blocks):
+        """The transaction documents for a list of (regular schema) blocks."""
+        docs = list()
+        for b in blocks:
+            for i, t in enumerate(b["transactions"]):
+                d = dict(t)
+                d["block"] = b["number"]
+                d["i"] = i
+                d["timestamp"] = b["timestamp"]
+                docs.append(d)
+        return docs
+
+    def _range(self, start, end):
+        """A query on the block number for [start, end)."""
+        q = dict()
+        if start is not None:
+            q["$gte"] = start
+        if end is not None:
+            q["$lt"] = end
+        return q
+
+    def _find(self, query, start, end, columns, limit, sort):
+        block = self._range(start, end)
+        if block:
+            query["block"] = block
+        projection = {"_id": 0}
+        if columns:
+            projection = dict(projection, **{c: 1 for c in columns})
+        cursor = self.collection.find(query, projection, sort=sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    # PUBLIC
+
+    def insert(self, blocks):
+        """
+        Index the transactions of blocks, skipping ones already indexed.
+
+        Returns:
+        --------
+        <list of str> errors (duplicates are not errors)
+        """
+        docs = self._flatten(blocks)
+        if not docs:
+            return list()
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            return [
+                "block {}: {}".format(e.get("op", {}).get("block"),
+                    e.get("errmsg"))
+                for e in err.details.get("writeErrors", [])
+                if e.get("code") != 11000
+            ]
+        return list()
+
+    def replace(self, blocks):
+        """Drop the indexed transactions of blocks and index them again."""
+        self.collection.delete_many(
+            {"block": {"$in": [b["number"] for b in blocks]}})
+        return self.insert(blocks)
+
+    def backfill(self, client, start=1, end=None, batch=1000):
+        """
+        Index the blocks in [start, end) of a block collection.
+
+        Params:
+        -------
+        client <mongodb Client>: the collection returned by initMongo
+        start <int> default 1
+        end <int> default None (everything above start)
+        batch <int> default 1000: blocks per bulk insert
+
+        Returns:
+        --------
+        <list of str> errors
+        """
+        errors = list()
+        blocks = list()
+        # Blocks stored without their transactions are indexed already
+        cursor = client.find(
+            {"number": self._range(start, end),
+             "transactions": {"$exists": True}},
+            sort=[("number", pymongo.ASCENDING)])
+        for b in cursor:
+            blocks.append(crawler_util.expandBlock(b))
+            if len(blocks) >= batch:
+                errors.extend(self.insert(blocks))
+                blocks = list()
+        errors.extend(self.insert(blocks))
+        return errors
+
+    def sent(self, address, start=None, end=None, columns=None, limit=None):
+        """Transactions from address in [start, end), in block order."""
+        return self._find({"from": address}, start, end, columns, limit,
+            [("block", pymongo.ASCENDING)])
+
+    def received(self, address, start=None, end=None, columns=None,
+            limit=None):
+        """Transactions to address in [start, end), in block order."""
+        return self._find({"to": address}, start, end, columns, limit,
+            [("block", pymongo.ASCENDING)])
+
+    def history(self, address, start=None, end=None, columns=None,
+            limit=None):
+        """
+        Every transaction from or to address in [start, end).
+
+        Params:
+        -------
+        address <str>: lowercase hex address
+        start <int> default None: first block (inclusive)
+        end <int> default None: last block (exclusive)
+        columns <list of str> default None (all fields)
+        limit <int> default None
+
+        Returns:
+        --------
+        <pymongo Cursor> of transaction documents, in block order
+        """
+        # The block range goes in each branch so each can use its index
+        block = self._range(start, end)
+        branches = [{"from": address}, {"to": address}]
+        if block:
+            for b in branches:
+                b["block"] = block
+        return self._find(
+            {"$or": branches}, None, None, columns, limit,
+            [("block", pymongo.ASCENDING), ("i", pymongo.ASCENDING)])
+
+    def blockRange(self, start, end, columns=None):
+        """Every transaction in blocks [start, end), in chain order."""
+        return self._find(dict(), start, end, columns, None,
+            [("block", pymongo.ASCENDING), ("i", pymongo.ASCENDING)])
+
+    def fill(self, blocks, columns=None):
+        """
+        Put the transactions back into blocks stored without them.
+
+        Description:
+        ------------
+        MongoStore(embed=False) keeps transactions only in this collection.
+        Blocks with no "transactions" get theirs from one blockRange()
+        query over the blocks given; other blocks are left alone.
+
+        Params:
+        -------
+        blocks <list of dict>: regular schema blocks, changed in place
+        columns <list of str> default None (all fields)
+
+        Returns:
+        --------
+        <list of dict> blocks
+        """
+        missing = {b["number"]: b for b in blocks if "transactions" not in b}
+        if not missing:
+            return blocks
+        for b in missing.values():
+            b["transactions"] = list()
+        if columns:
+            columns = list(columns) + ["block"]
+        txns = self.blockRange(min(missing), max(missing) + 1, columns)
+        for t in txns:
+            b = missing.get(t.pop("block"))
+            if b is not None:
+                t.pop("i", None)
+                t.pop("timestamp", None)
+                b["transactions"].append(t)
+        return blocks
@@ -0,0 +1,16 @@
+"""
+Backfill mongo from geth as one of several cooperating crawler processes.
+
+Start as many copies as you like (on one host or several hosts sharing the
+same mongo); block ranges are divided between them with leases.
+"""
+import sys
+sys.path.append("./../Preprocessing/Crawler")
+from Crawler import Crawler
+
+
+if __name__ == "__main__":
+    # Other workers write to the same mongo, so no checkpoint of our own
+    c = Crawler(start=False, checkpoint_path=None)
+    n = c.runDistributed()
+    print("Completed {} block ranges.".format(n))
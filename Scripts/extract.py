@@ -6,6 +6,7 @@ sys.path.append("./../Analysis")
 import os
 os.environ['ETH_BLOCKCHAIN_ANALYSIS_DIR'] = './../Analysis/'
 from ParsedBlocks import ParsedBlocks
+from ContractMap import ContractMap
 from TxnGraph import TxnGraph
 import tqdm
 
@@ -34,12 +35,14 @@ if __name__ == "__main__":
         prev_max_block = syncCSV(CSVFILE)
 
     # Always start at block 1 because the data is cumulative.
-    # Resume at previous block + 1000
-    t = TxnGraph(1, prev_max_block + STEP)
+    # Resume at previous block + 1000, from the latest checkpoint
+    t = TxnGraph(1, prev_max_block + STEP, resume=True)
+    # One map for every snapshot, so contracts are looked up once
+    contract_map = ContractMap(load=True)
     for i in tqdm.tqdm(range(max_block//resolution)):
 
         if t.end_block > prev_max_block:
-            blocks = ParsedBlocks(t)
+            blocks = ParsedBlocks(t, contract_map=contract_map)
             t.extend(STEP)
         else:
             t.end_block += STEP
@@ -0,0 +1,54 @@
+"""
+Convert the blocks in mongo to the compact (binary) schema in bulk.
+
+Blocks already in the compact schema are skipped, so the migration can be
+stopped and started again at any point. Readers (TxnGraph, ContractMap)
+handle both schemas, so it can run while they are in use. Afterwards, run
+the crawler with Crawler(compact=True) so new blocks are compact too.
+
+    python3 migrate_compact.py [--keep-data] [--batch 1000]
+"""
+import argparse
+import sys
+sys.path.append("./../Preprocessing/Crawler")
+import crawler_util
+import pymongo
+import tqdm
+
+
+def migrate(client, keep_data=False, batch=1000):
+    """Rewrite every non-compact block in the collection. Returns a count."""
+    # Blocks stored without their transactions (in the TxnIndex only) have
+    # nothing to convert
+    query = {
+        "compact": {"$exists": False},
+        "transactions": {"$exists": True}
+    }
+    total = client.count_documents(query)
+    cursor = client.find(query, sort=[("number", pymongo.ASCENDING)])
+    ops = list()
+    count = 0
+    for doc in tqdm.tqdm(cursor, total=total):
+        ops.append(pymongo.ReplaceOne(
+            {"_id": doc["_id"]},
+            crawler_util.compactBlock(doc, keep_data=keep_data)))
+        if len(ops) >= batch:
+            client.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = list()
+    if ops:
+        client.bulk_write(ops, ordered=False)
+        count += len(ops)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keep-data", action="store_true",
+        help="store full input data instead of the 4-byte selector")
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    client = crawler_util.initMongo(pymongo.MongoClient())
+    n = migrate(client, args.keep_data, args.batch)
+    print("Converted {} blocks.".format(n))
@@ -6,33 +6,19 @@ from Crawler import Crawler
 sys.path.append("Analysis")
 from TxnGraph import TxnGraph
 from ParsedBlocks import ParsedBlocks
+from ContractMap import ContractMap
 sys.path.append("Scripts")
 from extract import syncCSV
 import tqdm
 
 
-def syncMongo(c):
-    """Sync mongo with geth blocks."""
-    gethBlock = c.highestBlockEth()
-    mongoBlock = c.highestBlockMongo()
-    counter = 0
-    if gethBlock > mongoBlock:
-        print("Syncing Mongo...")
-        for i in range(gethBlock-mongoBlock):
-            c.add_block(mongoBlock+i)
-        counter += 1
-        if counter >= 100:
-            print("Successfully parsed {} blocks.".format(counter))
-            print("Currently at block {} of {}".format(mongoBlock, gethBlock))
-            counter = 0
-
 if __name__ == "__main__":
     # Print success every N iterations
     n = 100
 
     # Initialize a crawler that will catch the mongodb up
     c = Crawler()
-    syncMongo(c)
+    c.sync()
 
     # Initialize a TxnGraph and save it every N blocks
     N = 1000
@@ -50,24 +36,42 @@ if __name__ == "__main__":
     _highestBlockMongo = c.highestBlockMongo()
 
     if prev_max_block + STEP <= _highestBlockMongo:
-        t = TxnGraph(1, prev_max_block+STEP)
+        t = TxnGraph(1, prev_max_block+STEP, resume=True)
+        # One map for every snapshot, so contracts are looked up once
+        contract_map = ContractMap(load=True)
         for i in tqdm.tqdm(range(_highestBlockMongo//STEP)):
             if t.end_block > prev_max_block:
-                blocks = ParsedBlocks(t)
+                blocks = ParsedBlocks(t, contract_map=contract_map)
                 t.extend(STEP)
             else:
                 t.end_block += STEP
 
-    while True:
-        # Sync
-        syncMongo(c)
+    # Hear about blocks rewritten after a chain reorganization
+    reorgs = list()
+    c.onReorg(reorgs.append)
+
+    # Wait for new blocks from geth and add them as they arrive
+    for head in c.follow():
+        # Roll the TxnGraph back if blocks it was built from were replaced
+        if reorgs:
+            fork = min(reorgs)
+            del reorgs[:]
+            if t and fork < t.end_block:
+                # Go back to the last checkpoint before the fork (dropping
+                # the ones built from orphaned blocks) and build forward
+                # again in the same steps
+                print("Reorg at block {}, rolling back graph".format(fork))
+                end = t.end_block
+                t.rewind(fork)
+                while t.end_block < end:
+                    t.extend(min(STEP, end - t.end_block))
 
         # Initialize TxnGraph if it doesn't exist yet
         if not t:
-            t = TxnGraph(1, c.highestBlockMongo())
+            t = TxnGraph(1, head, resume=True)
 
         # Do the next iteration of the TxnGraph if applciable
-        if t.end_block + STEP <= c.highestBlockMongo():
+        if t.end_block + STEP <= head:
             t.extend(STEP)
 
         # Print an update at a certain resolution
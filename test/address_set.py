@@ -0,0 +1,83 @@
+"""Test the memory-mapped address sets behind ContractMap."""
+import os
+import sys
+sys.path.append("../Analysis")
+from AddressSet import AddressSet
+
+# Trailing zero bytes are dropped by numpy's S20 and must survive anyway
+ZEROS = "0x" + "ab"*10 + "00"*10
+ADDRESSES = ["0x%040x" % (i*7919) for i in range(1, 50)] + [ZEROS]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "contracts")
+    s = AddressSet(path)
+    for a in ADDRESSES:
+        s.add(a)
+    s.add(ADDRESSES[0])
+    s.add(None)
+    s.add("0x1234")
+    assert len(s) == len(ADDRESSES)
+    s.save()
+
+    t = AddressSet(path)
+    assert len(t) == len(ADDRESSES)
+    assert all(a in t and t[a] == 1 for a in ADDRESSES)
+    assert "0x" + "ab"*10 + "00"*9 + "01" not in t
+    assert None not in t and t["0x" + "ab"*10] == 0
+    assert sorted(t) == sorted(ADDRESSES)
+
+
+def test_log_merge(tmp_path):
+    path = str(tmp_path / "contracts")
+    s = AddressSet(path, min_compact=10)
+    for a in ADDRESSES[:5]:
+        s.add(a)
+    s.save()
+    # Small saves only append to the log
+    assert os.path.getsize(s.log_path) == 5*20
+    assert not os.path.exists(path)
+
+    for a in ADDRESSES[5:]:
+        s.add(a)
+    s.save()
+    # Past min_compact the log is merged into the sorted file
+    assert os.path.getsize(s.log_path) == 0
+    assert os.path.getsize(path) == len(ADDRESSES)*20
+
+    t = AddressSet(path, min_compact=10)
+    assert sorted(t) == sorted(ADDRESSES)
+    t.add(ADDRESSES[-1])
+    assert not t._new
+    assert all(a in t for a in ADDRESSES)
+
+
+def test_truncated_log(tmp_path):
+    """A record cut short by a crash is dropped; the rest are kept."""
+    path = str(tmp_path / "contracts")
+    s = AddressSet(path)
+    for a in ADDRESSES[:3]:
+        s.add(a)
+    s.save()
+    with open(s.log_path, "ab") as f:
+        f.write(bytes.fromhex(ADDRESSES[3][2:])[:11])
+
+    t = AddressSet(path)
+    assert len(t) == 3 and ADDRESSES[3] not in t
+    assert all(a in t for a in ADDRESSES[:3])
+    # Later saves are not misaligned by it
+    t.add(ADDRESSES[4])
+    t.save()
+    assert sorted(AddressSet(path)) == sorted(ADDRESSES[:3] + ADDRESSES[4:5])
+
+
+def test_replace(tmp_path):
+    path = str(tmp_path / "contracts")
+    s = AddressSet(path)
+    s.add(ADDRESSES[0])
+    s.save()
+    # load=False starts empty and replaces the saved set
+    s = AddressSet(path, load=False)
+    s.add(ADDRESSES[1])
+    s.save()
+    assert list(AddressSet(path)) == [ADDRESSES[1]]
@@ -0,0 +1,71 @@
+"""Test the shared address --> id table."""
+import os
+import pickle
+import sys
+sys.path.append("../Preprocessing/Crawler")
+import numpy as np
+from AddressTable import AddressTable
+
+ZEROS = "0x" + "ab"*10 + "00"*10
+ADDRESSES = ["0x%040x" % (i*7919) for i in range(1, 50)] + [ZEROS]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "table")
+    table = AddressTable(path)
+    ids = table.intern(ADDRESSES[:10] + [None] + ADDRESSES[:3])
+    assert ids.tolist() == list(range(10)) + [-1, 0, 1, 2]
+    ids = table.intern(ADDRESSES)
+    assert ids.tolist() == list(range(len(ADDRESSES)))
+    assert table.addresses(ids) == ADDRESSES
+    assert table.address(len(ADDRESSES) - 1) == ZEROS
+    assert table.lookup(["0x" + "ab"*10 + "00"*9 + "01", None]).tolist() == \
+        [-1, -1]
+
+    # Ids are the same when reopened, and for raw 20-byte keys
+    other = AddressTable(path)
+    assert other.lookup(ADDRESSES).tolist() == ids.tolist()
+    keys = np.array([bytes.fromhex(a[2:]) for a in ADDRESSES], dtype="S20")
+    assert other.lookup(keys).tolist() == ids.tolist()
+    assert pickle.loads(pickle.dumps(other)).lookup([ZEROS]).tolist() == \
+        [len(ADDRESSES) - 1]
+
+
+def test_reindex(tmp_path):
+    """Ids do not change when the index is rebuilt over new records."""
+    path = str(tmp_path / "table")
+    table = AddressTable(path, reindex_ratio=0, min_reindex=10)
+    table.intern(ADDRESSES[:5])
+    assert len(table._tail) == 5
+    ids = table.intern(ADDRESSES)
+    # Past min_reindex every record moved into the sorted index
+    assert len(table._tail) == 0 and len(table._sorted) == len(ADDRESSES)
+    assert ids.tolist() == list(range(len(ADDRESSES)))
+    assert AddressTable(path).lookup(ADDRESSES[::-1]).tolist() == \
+        ids.tolist()[::-1]
+
+
+def test_shared(tmp_path):
+    """Records appended by another instance are seen on lookup."""
+    path = str(tmp_path / "table")
+    a = AddressTable(path)
+    b = AddressTable(path)
+    a.intern(ADDRESSES[:5])
+    assert b.lookup([ADDRESSES[4]]).tolist() == [4]
+    assert b.intern(ADDRESSES[3:8]).tolist() == [3, 4, 5, 6, 7]
+    assert a.addresses([7]) == [ADDRESSES[7]]
+
+
+def test_truncated_record(tmp_path):
+    """A record cut short by a crash is ignored and then overwritten."""
+    path = str(tmp_path / "table")
+    table = AddressTable(path)
+    table.intern(ADDRESSES[:3])
+    with open(os.path.join(path, "records.dat"), "ab") as f:
+        f.write(bytes.fromhex(ADDRESSES[3][2:])[:7])
+
+    table = AddressTable(path)
+    assert len(table) == 3
+    assert table.lookup([ADDRESSES[3]]).tolist() == [-1]
+    assert table.intern(ADDRESSES[3:5]).tolist() == [3, 4]
+    assert AddressTable(path).addresses(range(5)) == ADDRESSES[:5]
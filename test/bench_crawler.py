@@ -0,0 +1,76 @@
+"""
+Measure ingest throughput against a mock geth node.
+
+Needs a running mongod. Blocks are written to a scratch database
+("blockchain_benchmark"), which is dropped afterwards.
+
+    python3 bench_crawler.py --blocks 2000 --txns 50 --latency 0.002
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+os.environ.setdefault("BLOCKCHAIN_MONGO_DATA_DIR", ".")
+sys.path.append("../Preprocessing/Crawler")
+sys.path.append("../Analysis")
+from Crawler import Crawler
+from ContractMap import ContractMap
+from mock_geth import MockGeth
+
+DB = "blockchain_benchmark"
+
+
+def _runNode(ports, blocks, txns, latency):
+    """Serve a MockGeth from a separate process so it has its own GIL."""
+    server = MockGeth(blocks, txns, latency).serve(port=0)
+    ports.put(server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+
+def _report(label, dt, blocks, txns):
+    print("{:<16} {:9.1f} blocks/s {:11.1f} txns/s   ({:.2f}s)".format(
+        label, blocks/dt, blocks*txns/dt, dt))
+
+
+def benchmark(blocks, txns, latency):
+    """Time Crawler.run, Crawler.sync and ContractMap.find."""
+    ports = multiprocessing.Queue()
+    node = multiprocessing.Process(
+        target=_runNode, args=(ports, blocks, txns, latency), daemon=True)
+    node.start()
+    port = ports.get(timeout=30)
+
+    # The collection is emptied between runs, so no checkpoint
+    c = Crawler(start=False, rpc_port=port, db_name=DB, checkpoint_path=None)
+    try:
+        c.mongo_client.delete_many({})
+        c.max_block_geth = c.highestBlockEth()
+        t0 = time.time()
+        c.run()
+        # run() covers blocks 1 to max_block_geth - 1
+        _report("Crawler.run", time.time() - t0, blocks - 1, txns)
+
+        c.mongo_client.delete_many({})
+        t0 = time.time()
+        c.sync()
+        _report("Crawler.sync", time.time() - t0, blocks, txns)
+
+        t0 = time.time()
+        fil = os.path.join(tempfile.mkdtemp(), "contracts.p")
+        ContractMap(c.mongo_client, filepath=fil, rpc=c.rpc)
+        _report("ContractMap.find", time.time() - t0, blocks, txns)
+    finally:
+        c.mongo_client.database.client.drop_database(DB)
+        node.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--txns", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    benchmark(args.blocks, args.txns, args.latency)
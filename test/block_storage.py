@@ -0,0 +1,77 @@
+"""Test that readers see the same blocks whichever way they were stored."""
+import sys
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import crawler_util
+from BlockStore import MongoStore
+from TxnIndex import TxnIndex
+from mock_geth import MockGeth
+
+
+def _blocks(n, txns=4):
+    node = MockGeth(blocks=n, txns=txns, create_every=7)
+    return [
+        crawler_util.decodeBlock({"result": node.block(i)})
+        for i in range(1, n + 1)
+    ]
+
+
+def _store(**options):
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    if not options.get("embed", True):
+        options["txn_index"] = TxnIndex(client.database)
+    MongoStore(client, **options).insertMany(_blocks(30))
+    return client
+
+
+def _read(client, columns=None):
+    cursor = client.find({}, {"_id": 0}, sort=[("number", 1)])
+    return list(crawler_util.readBlocks(
+        cursor, client.database, columns, batch=7))
+
+
+def test_layouts_agree():
+    expected = _read(_store())
+    assert len(expected) == 30
+    for options in ({"compact": True}, {"embed": False}):
+        blocks = _read(_store(**options))
+        assert [b["number"] for b in blocks] == list(range(1, 31))
+        for a, b in zip(expected, blocks):
+            got = [(t["from"], t["to"], t["value"]) for t in b["transactions"]]
+            assert got == [
+                (t["from"], t["to"], t["value"]) for t in a["transactions"]]
+
+
+def test_unembedded_blocks():
+    client = _store(embed=False)
+    doc = client.find_one({"number": 5})
+    assert "transactions" not in doc and doc["n_txns"] == 4
+    # Nothing to compact or expand
+    assert crawler_util.compactBlock(doc) is doc
+    assert crawler_util.expandBlock(doc) is doc
+
+    blocks = _read(client, ["to", "value"])
+    assert all(len(b["transactions"]) == 4 for b in blocks)
+    assert set(blocks[0]["transactions"][0]) == {"to", "value"}
+
+
+def test_compact_wei():
+    """The exact value in wei is kept, but only stored when it is needed."""
+    node = MockGeth(blocks=3, txns=6)
+    raw = node.block(2)
+    raw["transactions"][0]["value"] = hex(15 * 10**17)
+    raw["transactions"][1]["value"] = hex(10**24 + 1)
+    raw["transactions"][2]["value"] = "0x0"
+    block = crawler_util.decodeBlockFast({"result": raw})
+    compact = crawler_util.compactBlock(block)
+    assert ["w" in t for t in compact["transactions"][:3]] == \
+        [False, True, False]
+    expanded = crawler_util.expandBlock(compact)
+    for a, b in zip(block["transactions"], expanded["transactions"]):
+        assert int(a["value_wei"], 0) == int(b["value_wei"], 0)
+        assert a["value"] == b["value"]
+    # Blocks decoded without the exact value do not gain one
+    old = crawler_util.decodeBlock({"result": raw})
+    expanded = crawler_util.expandBlock(crawler_util.compactBlock(old))
+    assert not any("value_wei" in t for t in expanded["transactions"])
+
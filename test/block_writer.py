@@ -0,0 +1,93 @@
+"""Test the buffered bulk writes of parsed blocks."""
+import sys
+import time
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import pytest
+import crawler_util
+from BlockStore import ColumnarStore, MongoStore
+from BlockWriter import BlockWriter
+
+
+def _block(n, value=1.0):
+    return {"number": n, "timestamp": 1000 + n, "transactions": [
+        {"from": "0x%040x" % n, "to": "0x%040x" % (n + 1), "value": value,
+         "data": "0x"}]}
+
+
+def _stored(client):
+    return sorted(d["number"] for d in client.find({}, {"number": 1}))
+
+
+def _writer(client, flushed, **options):
+    return BlockWriter(MongoStore(client), on_flush=flushed.append, **options)
+
+
+def test_flush_by_count():
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    flushed = list()
+    writer = _writer(client, flushed, max_docs=4, max_delay=3600)
+    for n in range(1, 4):
+        assert writer.add(_block(n)) == []
+    assert _stored(client) == [] and flushed == []
+    writer.add(_block(4))
+    assert _stored(client) == [1, 2, 3, 4] and flushed == [[1, 2, 3, 4]]
+    assert writer.buffer == []
+
+    for n in range(5, 11):
+        writer.add(_block(n))
+    assert flushed == [[1, 2, 3, 4], [5, 6, 7, 8]]
+    writer.flush()
+    assert _stored(client) == list(range(1, 11))
+    assert flushed[-1] == [9, 10] and writer.inserted == 10
+    # Nothing buffered, nothing written
+    writer.flush()
+    assert len(flushed) == 3
+
+
+def test_flush_by_time():
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    flushed = list()
+    writer = _writer(client, flushed, max_docs=100, max_delay=0.2)
+    writer.add(_block(1))
+    assert _stored(client) == []
+    time.sleep(0.25)
+    # The next block finds the buffer stale
+    writer.add(_block(2))
+    assert _stored(client) == [1, 2] and flushed == [[1, 2]]
+    writer.add(_block(3))
+    assert flushed == [[1, 2]]
+
+
+def test_duplicates():
+    """Blocks stored already are skipped, and still count as stored."""
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    client.insert_many([_block(2), _block(3)])
+    flushed = list()
+    writer = _writer(client, flushed, max_docs=5)
+    for n in range(1, 6):
+        writer.add(_block(n))
+    assert (writer.inserted, writer.duplicates, writer.errors) == (3, 2, [])
+    assert flushed == [[1, 2, 3, 4, 5]]
+
+
+def test_failed_blocks(tmp_path):
+    """Blocks that could not be written are left out of on_flush."""
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    flushed = list()
+    writer = _writer(client, flushed, max_docs=3)
+    bad = dict(_block(2), **{"$bad": 1})
+    errors = writer.add(_block(1)) + writer.add(bad) + writer.add(_block(3))
+    assert errors and writer.errors == errors
+    # Mongo rejects the whole batch here
+    assert flushed == [[]] and writer.inserted == 0
+
+    # A store that fails part of a batch (one partition of a ColumnarStore)
+    pytest.importorskip("pyarrow")
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    flushed = list()
+    writer = BlockWriter(store, max_docs=4, on_flush=flushed.append)
+    for b in (_block(1), _block(12, value="bad"), _block(13), _block(2)):
+        writer.add(b)
+    assert len(writer.errors) == 1
+    assert flushed == [[1, 2]] and store.findGaps(1, 14) == [(3, 14)]
@@ -0,0 +1,140 @@
+"""Test the crawler's record of stored blocks."""
+import json
+import os
+import sys
+import threading
+os.environ.setdefault("BLOCKCHAIN_MONGO_DATA_DIR", ".")
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import crawler_util
+from BlockStore import ColumnarStore, MongoStore
+from Checkpoint import Checkpoint
+from Crawler import DIR, checkpointPath
+
+
+def _missing(cp, start, end):
+    """The blocks in [start, end) the checkpoint says are not stored."""
+    return [n for a, b in cp.gaps(start, end) for n in range(a, b)]
+
+
+def test_commit_in_order(tmp_path):
+    cp = Checkpoint(str(tmp_path / "cp.json"))
+    cp.commit(range(1, 11))
+    assert (cp.high_water, cp.highest, cp.holes) == (10, 10, [])
+    cp.commit([11, 12])
+    assert (cp.high_water, cp.highest, cp.holes) == (12, 12, [])
+    assert cp.gaps(1, 20) == [(13, 20)]
+
+
+def test_commit_cuts_holes(tmp_path):
+    cp = Checkpoint(str(tmp_path / "cp.json"))
+    # Out of order batches leave holes below the highest block
+    cp.commit([5, 6, 9])
+    assert cp.highest == 9 and cp.high_water == 0
+    assert cp.holes == [(1, 5), (7, 9)]
+    # Cutting from the start, middle and end of holes
+    cp.commit([1, 3, 8])
+    assert cp.holes == [(2, 3), (4, 5), (7, 8)]
+    assert cp.high_water == 1
+    cp.commit([2, 4, 7])
+    assert cp.holes == [] and cp.high_water == 9
+
+    # Committing stored blocks again changes nothing
+    cp.commit([3, 9])
+    assert (cp.high_water, cp.highest, cp.holes) == (9, 9, [])
+
+
+def test_gaps(tmp_path):
+    cp = Checkpoint(str(tmp_path / "cp.json"))
+    cp.reset(20, [(1, 3), (8, 10), (15, 21), (30, 40)])
+    # Holes above highest are dropped, and the last one runs to the end
+    assert cp.holes == [(1, 3), (8, 10), (15, 21)]
+    assert cp.high_water == 0
+    assert cp.gaps(1, 30) == [(1, 3), (8, 10), (15, 30)]
+    assert cp.gaps(9, 16) == [(9, 10), (15, 16)]
+    assert cp.gaps(3, 8) == []
+    assert _missing(cp, 1, 25) == [1, 2, 8, 9] + list(range(15, 25))
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "cp.json")
+    cp = Checkpoint(path)
+    assert not cp.load()
+    cp.commit([1, 2, 4, 7])
+
+    other = Checkpoint(path)
+    assert other.load()
+    assert (other.high_water, other.highest, other.holes) == \
+        (2, 7, [(3, 4), (5, 7)])
+    assert other.gaps(1, 10) == cp.gaps(1, 10)
+    # The record is replaced, not written in place
+    assert os.listdir(str(tmp_path)) == ["cp.json"]
+
+
+def test_torn_write_keeps_old_record(tmp_path):
+    """A crash while writing the new record leaves the old one intact."""
+    path = str(tmp_path / "cp.json")
+    cp = Checkpoint(path)
+    cp.commit([1, 2, 3])
+    with open(path + ".tmp", "w") as f:
+        f.write('{"high_water": 9, "hig')
+
+    other = Checkpoint(path)
+    assert other.load()
+    assert (other.high_water, other.highest) == (3, 3)
+    # Saves write their own temporary file and never read the leftover
+    other.commit([4])
+    with open(path) as f:
+        assert json.load(f)["high_water"] == 4
+    assert sorted(os.listdir(str(tmp_path))) == ["cp.json", "cp.json.tmp"]
+
+
+def test_unreadable_record(tmp_path):
+    """A record that cannot be parsed counts as no record at all."""
+    path = str(tmp_path / "cp.json")
+    for data in ('{"high_water": 9, "hig', '{"high_water": 1}', "[]", ""):
+        with open(path, "w") as f:
+            f.write(data)
+        cp = Checkpoint(path)
+        assert not cp.load()
+        assert (cp.high_water, cp.highest, cp.holes) == (0, 0, [])
+
+
+def test_concurrent_saves(tmp_path):
+    """Processes saving one record at once never leave it torn."""
+    path = str(tmp_path / "cp.json")
+    cps = [Checkpoint(path) for _ in range(4)]
+    errors = list()
+
+    def _commit(cp, first):
+        try:
+            for n in range(first, first + 200):
+                cp.commit([n])
+        except Exception as err:
+            errors.append(err)
+
+    threads = [
+        threading.Thread(target=_commit, args=(cp, 1 + 1000*i))
+        for i, cp in enumerate(cps)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert Checkpoint(path).load()
+    assert os.listdir(str(tmp_path)) == ["cp.json"]
+
+
+def test_default_paths(tmp_path):
+    """Each store gets its own checkpoint file."""
+    client = mongomock.MongoClient()
+    default = MongoStore(crawler_util.initMongo(client))
+    other = MongoStore(crawler_util.initMongo(client, "blockchain_test"))
+    columns = ColumnarStore(str(tmp_path / "columns"))
+    assert checkpointPath(default) == os.path.join(
+        DIR, "crawler_checkpoint.json")
+    assert checkpointPath(other) == os.path.join(
+        DIR, "crawler_checkpoint_blockchain_test.json")
+    assert checkpointPath(columns) == str(
+        tmp_path / "columns" / "crawler_checkpoint.json")
@@ -0,0 +1,143 @@
+"""Test the Parquet block store."""
+import pickle
+import sys
+sys.path.append("../Preprocessing/Crawler")
+import pytest
+pytest.importorskip("pyarrow")
+import crawler_util
+from BlockStore import ColumnarStore
+from mock_geth import MockGeth
+
+
+def _blocks(n, txns=3):
+    """Decoded blocks 1 to n; every 4th one has no transactions."""
+    node = MockGeth(blocks=n, txns=txns, create_every=5)
+    blocks = [
+        crawler_util.decodeBlockFast({"result": node.block(i)})
+        for i in range(1, n + 1)
+    ]
+    for b in blocks[3::4]:
+        b["transactions"] = list()
+    return blocks
+
+
+def _fork(blocks):
+    """Other blocks with the same numbers, as after a reorg."""
+    fork = list()
+    for b in blocks:
+        b = dict(b, hash=b["hash"][:-4] + "beef")
+        b["transactions"] = [
+            dict(t, value=t["value"] + 1) for t in b["transactions"][:2]]
+        fork.append(b)
+    return fork
+
+
+def _rows(store, start=None, end=None):
+    """(block, from, value) of the stored transactions, sorted."""
+    t = store.scanTransactions(["block", "from", "value"], start, end)
+    return sorted(zip(*[t[c].to_pylist() for c in t.column_names]))
+
+
+def _expected(blocks):
+    return sorted(
+        (b["number"], t["from"], t["value"])
+        for b in blocks for t in b["transactions"])
+
+
+def test_insert_and_duplicates(tmp_path):
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    blocks = _blocks(25)
+    assert store.insertMany(blocks[:12]) == (12, 0, [], [])
+    # Stored blocks, and a block repeated within the batch, are skipped
+    assert store.insertMany(blocks[8:20] + [blocks[15]]) == (8, 5, [], [])
+    assert store.insert(blocks[20]) is None
+    assert store.highestBlock() == 21
+    assert store.findGaps(1, 22) == []
+    assert _rows(store) == _expected(blocks[:21])
+
+    t = store.scanTransactions()
+    assert t.column_names == store.txn_schema.names
+    first = blocks[0]["transactions"][0]
+    row = [r for r in t.to_pylist() if r["block"] == 1][0]
+    assert (row["from"], row["to"], row["value"], row["has_data"]) == \
+        (first["from"], first["to"], first["value"], first["data"] != "0x")
+
+
+def test_find_gaps(tmp_path):
+    """Gaps are found within and across partitions."""
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    missing = {1, 2, 9, 10, 11} | set(range(25, 35))
+    store.insertMany(
+        [b for b in _blocks(45) if b["number"] not in missing])
+    assert store.findGaps(1, 46) == [(1, 3), (9, 12), (25, 35)]
+    assert store.findGaps(5, 30) == [(9, 12), (25, 30)]
+    assert store.findGaps(12, 25) == []
+    # Past the highest block, and in partitions with nothing stored
+    assert store.findGaps(40, 60) == [(46, 60)]
+    assert store.findGaps(100, 120) == [(100, 120)]
+
+
+def test_replace(tmp_path):
+    """Replaced blocks keep their numbers but not their old rows."""
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    blocks = _blocks(20)
+    store.insertMany(blocks)
+    # Across the partition boundary at 10
+    fork = _fork(blocks[7:13])
+    store.replace(fork)
+    assert store.highestBlock() == 20
+    assert store.findGaps(1, 21) == []
+    assert _rows(store) == _expected(blocks[:7] + fork + blocks[13:])
+    hashes = {r["number"]: r["hash"] for r in store.recentBlocks(20)}
+    assert [hashes[b["number"]] for b in fork] == [b["hash"] for b in fork]
+
+
+def test_recent_blocks(tmp_path):
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    assert store.recentBlocks(5) == [] and store.highestBlock() == 0
+    blocks = _blocks(23)
+    store.insertMany(blocks)
+    # Across the partition boundary at 20, including empty blocks
+    assert store.recentBlocks(5) == [
+        {"number": b["number"], "hash": b["hash"]} for b in blocks[-5:]]
+    assert len(store.recentBlocks(100)) == 23
+
+
+def test_scan_transactions(tmp_path):
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    blocks = _blocks(30)
+    store.insertMany(blocks)
+    t = store.scanTransactions(["block", "value"], 8, 22)
+    assert t.column_names == ["block", "value"]
+    assert _rows(store, 8, 22) == _expected(blocks[7:21])
+    assert _rows(store, start=25) == _expected(blocks[24:])
+    assert _rows(store, end=3) == _expected(blocks[:2])
+    assert store.scanTransactions(["to"], 100, 200).num_rows == 0
+    empty = ColumnarStore(str(tmp_path / "empty"))
+    assert empty.scanTransactions(["from"]).column_names == ["from"]
+
+
+def test_reopen(tmp_path):
+    """A store reopened on the same directory (or unpickled) sees it all."""
+    blocks = _blocks(25)
+    ColumnarStore(str(tmp_path), partition_blocks=10).insertMany(
+        blocks[:10] + blocks[15:])
+    for store in (ColumnarStore(str(tmp_path), partition_blocks=10),
+            pickle.loads(pickle.dumps(
+                ColumnarStore(str(tmp_path), partition_blocks=10)))):
+        assert store.highestBlock() == 25
+        assert store.findGaps(1, 26) == [(11, 16)]
+        assert _rows(store) == _expected(blocks[:10] + blocks[15:])
+    assert store.insertMany(blocks[5:15]) == (5, 5, [], [])
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    assert store.findGaps(1, 26) == []
+    assert _rows(store) == _expected(blocks)
+
+    # A segment whose blocks file was never written does not count
+    path = tmp_path / "torn"
+    ColumnarStore(str(path), partition_blocks=10).insertMany(blocks[:5])
+    for f in path.glob("*/*.blocks.parquet"):
+        f.unlink()
+    store = ColumnarStore(str(path), partition_blocks=10)
+    assert store.highestBlock() == 0
+    assert store.scanTransactions().num_rows == 0
@@ -0,0 +1,194 @@
+"""Test the map of contract addresses."""
+import pickle
+import sys
+sys.path.append("../Analysis")
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import pytest
+import crawler_util
+from AddressTable import AddressTable
+from ContractMap import ContractMap
+from RPCClient import RPCClient
+from mock_geth import MockGeth
+
+ADDRESSES = ["0x%040x" % (i*7919) for i in range(1, 20)]
+
+
+class CountingRPC(RPCClient):
+    """An RPCClient recording the calls in every batch it sends."""
+
+    def __init__(self, *args, **kwargs):
+        RPCClient.__init__(self, *args, **kwargs)
+        self.batches = list()
+
+    def batch(self, calls, key="result"):
+        self.batches.append(calls)
+        return RPCClient.batch(self, calls, key)
+
+    def calls(self, method):
+        """The first parameter of every call to method."""
+        return [p[0] for b in self.batches for m, p in b if m == method]
+
+
+@pytest.fixture
+def node():
+    """A mock node with 40 blocks, served on a free port."""
+    node = MockGeth(blocks=40, txns=6, n_addresses=100, create_every=9)
+    server = node.serve(port=0)
+    node.url = "http://localhost:{}".format(server.server_address[1])
+    yield node
+    server.shutdown()
+
+
+def _client(node, end, start=1, creates=False):
+    """A mock mongo with blocks [start, end) of node stored."""
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    return _store(client, node, start, end, creates)
+
+
+def _store(client, node, start, end, creates=False):
+    """
+    Store blocks [start, end) of node in client.
+
+    With creates, creations record the contract they made, as a Crawler
+    with discover_contracts=True does.
+    """
+    blocks = [
+        crawler_util.decodeBlockFast({"result": node.block(n)})
+        for n in range(start, end)
+    ]
+    for b in blocks:
+        for t in b["transactions"]:
+            if creates and t["to"] is None:
+                t["creates"] = node.created[t["hash"]]
+    client.insert_many(blocks)
+    return client
+
+
+def _recipients(node, start, end):
+    return {
+        t["to"] for n in range(start, end)
+        for t in node.block(n)["transactions"] if t["to"]
+    }
+
+
+def test_contract_ids(tmp_path):
+    """Contract ids are looked up (not added) and kept until either side grows."""
+    table = AddressTable(str(tmp_path / "addresses"))
+    table.intern(ADDRESSES[10:] + ADDRESSES[:3])
+    cmap = ContractMap(filepath=str(tmp_path / ".contracts.p"))
+    cmap.add(ADDRESSES[:6])
+
+    ids = cmap.ids(table)
+    assert ids.tolist() == sorted(table.lookup(ADDRESSES[:3]).tolist())
+    assert len(table) == 12
+    assert cmap.ids(table) is ids
+
+    # A contract the table learns about, then a new contract
+    table.intern([ADDRESSES[3]])
+    assert cmap.ids(table).tolist() == \
+        sorted(table.lookup(ADDRESSES[:4]).tolist())
+    cmap.add([ADDRESSES[10]])
+    assert cmap.ids(table).tolist() == \
+        sorted(table.lookup(ADDRESSES[:4] + [ADDRESSES[10]]).tolist())
+
+
+def test_code_batches(node, tmp_path):
+    """Recipients are checked once each, in batches per window of blocks."""
+    rpc = CountingRPC(node.url)
+    cmap = ContractMap(_client(node, 31), filepath=str(tmp_path / "c.p"),
+        rpc=rpc, batch_size=7, window_blocks=10)
+    assert cmap.last_block == 30
+    recipients = _recipients(node, 1, 31)
+    assert set(cmap.addresses) == {a for a in recipients if node.isContract(a)}
+    assert set(cmap.eoas) == {a for a in recipients if not node.isContract(a)}
+
+    queried = rpc.calls("eth_getCode")
+    assert sorted(queried) == sorted(recipients)
+    assert all(0 < len(b) <= 7 for b in rpc.batches)
+    # Each window's new recipients go out together: whole batches of 7,
+    # except for the last one of each window
+    windows = [
+        _recipients(node, 1, 11),
+        _recipients(node, 11, 21) - _recipients(node, 1, 11),
+        _recipients(node, 21, 31) - _recipients(node, 1, 21)
+    ]
+    assert len(rpc.batches) == sum((len(w) + 6)//7 for w in windows)
+    assert "eth_getTransactionReceipt" not in {
+        m for b in rpc.batches for m, _ in b}
+
+
+def test_known_addresses(node, tmp_path):
+    """Known contracts and EOAs (also once saved) are not checked again."""
+    client = _client(node, 21)
+    filepath = str(tmp_path / "c.p")
+    ContractMap(client, filepath=filepath, rpc=CountingRPC(node.url))
+    _store(client, node, 21, 41)
+
+    rpc = CountingRPC(node.url)
+    cmap = ContractMap(filepath=filepath, load=True, rpc=rpc)
+    assert cmap.last_block == 20
+    cmap.client = client
+    cmap.find()
+    assert cmap.last_block == 40
+    assert sorted(rpc.calls("eth_getCode")) == \
+        sorted(_recipients(node, 21, 41) - _recipients(node, 1, 21))
+    recipients = _recipients(node, 1, 41)
+    assert set(cmap.addresses) == {a for a in recipients if node.isContract(a)}
+
+    # An EOA that later turns out to be a contract is only found by add()
+    eoa = sorted(cmap.eoas)[0]
+    cmap.add([eoa])
+    assert cmap.addresses[eoa] == 1
+
+
+@pytest.mark.parametrize("creates", [False, True])
+def test_discover(node, tmp_path, creates):
+    """With discover, contracts come from creations, not eth_getCode."""
+    rpc = CountingRPC(node.url)
+    cmap = ContractMap(_client(node, 41, creates=creates),
+        filepath=str(tmp_path / "c.p"), rpc=rpc, batch_size=4,
+        window_blocks=10, discover=True)
+    created = {
+        node.created[t["hash"]] for n in range(1, 41)
+        for t in node.block(n)["transactions"] if t["to"] is None
+    }
+    assert created and set(cmap.addresses) == created
+    assert len(cmap.eoas) == 0
+    assert not rpc.calls("eth_getCode")
+    receipts = rpc.calls("eth_getTransactionReceipt")
+    if creates:
+        # The crawler already recorded them
+        assert receipts == []
+    else:
+        assert len(receipts) == len(created)
+        assert all(len(b) <= 4 for b in rpc.batches)
+
+
+def test_load_old_pickle(tmp_path):
+    """A map pickled in full is read, and converted when saved."""
+    filepath = str(tmp_path / "c.p")
+    contracts = {a: 1 for a in ADDRESSES[:5]}
+    contracts[ADDRESSES[5]] = 0
+    with open(filepath, "wb") as f:
+        pickle.dump((123, contracts, set(ADDRESSES[10:12])), f)
+
+    cmap = ContractMap(filepath=filepath, load=True)
+    assert cmap.last_block == 123
+    assert sorted(cmap.addresses) == sorted(ADDRESSES[:5])
+    assert sorted(cmap.eoas) == sorted(ADDRESSES[10:12])
+    cmap.save()
+    with open(filepath, "rb") as f:
+        assert pickle.load(f) == (123,)
+
+    cmap = ContractMap(filepath=filepath, load=True)
+    assert cmap.last_block == 123
+    assert sorted(cmap.addresses) == sorted(ADDRESSES[:5])
+    assert cmap.addresses[ADDRESSES[5]] == 0
+    assert sorted(cmap.eoas) == sorted(ADDRESSES[10:12])
+
+    # Older still: no EOAs
+    with open(filepath, "wb") as f:
+        pickle.dump((7, contracts), f)
+    cmap = ContractMap(filepath=filepath, load=True)
+    assert cmap.last_block == 7 and len(cmap.eoas) == 0
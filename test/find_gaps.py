@@ -0,0 +1,70 @@
+"""Test finding missing blocks in mongo by bisection."""
+import random
+import sys
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import pytest
+import crawler_util
+
+
+def _client(numbers):
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    if numbers:
+        client.insert_many([{"number": n} for n in numbers])
+    return client
+
+
+def _gaps(numbers, start, end):
+    """The missing ranges, found the slow way."""
+    gaps = list()
+    for n in range(start, end):
+        if n in numbers:
+            continue
+        if gaps and gaps[-1][1] == n:
+            gaps[-1] = (gaps[-1][0], n + 1)
+        else:
+            gaps.append((n, n + 1))
+    return gaps
+
+
+@pytest.mark.parametrize("scan_below", [1, 4, 4096])
+def test_edges(scan_below):
+    """Holes at either end of the range, and ranges past what is stored."""
+    numbers = set(range(1, 200)) - {1, 2, 3, 199}
+    client = _client(numbers)
+    find = lambda a, b: crawler_util.findGaps(client, a, b, scan_below)
+    assert find(1, 200) == [(1, 4), (199, 200)]
+    assert find(4, 199) == []
+    assert find(3, 5) == [(3, 4)]
+    assert find(150, 260) == [(199, 260)]
+    assert find(300, 310) == [(300, 310)]
+
+
+@pytest.mark.parametrize("scan_below", [1, 4, 4096])
+def test_adjacent_holes(scan_below):
+    """Holes split by the bisection come back as one range."""
+    # 64 is the first midpoint of [1, 128), and 32 and 96 the next ones
+    missing = set(range(60, 70)) | set(range(30, 34)) | {95, 96, 97}
+    numbers = set(range(1, 128)) - missing
+    client = _client(numbers)
+    assert crawler_util.findGaps(client, 1, 128, scan_below) == \
+        [(30, 34), (60, 70), (95, 98)]
+
+
+def test_empty():
+    client = _client([])
+    assert crawler_util.findGaps(client, 1, 100, 4) == [(1, 100)]
+    client = _client(range(1, 10))
+    assert crawler_util.findGaps(client, 5, 5) == []
+    assert crawler_util.findGaps(client, 7, 3) == []
+
+
+def test_random():
+    rng = random.Random(5)
+    numbers = set(n for n in range(1, 600) if rng.random() < 0.95)
+    numbers -= set(range(200, 260))
+    client = _client(numbers)
+    for start, end in ((1, 600), (1, 700), (199, 261), (17, 444)):
+        for scan_below in (4, 64, 4096):
+            assert crawler_util.findGaps(client, start, end, scan_below) == \
+                _gaps(numbers, start, end)
@@ -0,0 +1,186 @@
+"""Test following the head of a (mock) chain, with filters and reorgs."""
+import os
+import sys
+import threading
+os.environ.setdefault("BLOCKCHAIN_MONGO_DATA_DIR", ".")
+sys.path.append("../Preprocessing/Crawler")
+import pytest
+pytest.importorskip("pyarrow")
+from BlockStore import ColumnarStore
+from Crawler import Crawler
+from ReorgBuffer import ReorgBuffer
+from mock_geth import MockGeth
+
+
+class NoFilterGeth(MockGeth):
+    """A mock node without block filters (like some light clients)."""
+
+    def __init__(self, *args, **kwargs):
+        MockGeth.__init__(self, *args, **kwargs)
+        del self.methods["eth_newBlockFilter"]
+        del self.methods["eth_getFilterChanges"]
+
+
+def _serve(node):
+    server = node.serve(port=0)
+    node.port = server.server_address[1]
+    return server
+
+
+@pytest.fixture
+def node():
+    """A mock node with 30 blocks, served on a free port."""
+    node = MockGeth(blocks=30, txns=2)
+    server = _serve(node)
+    yield node
+    server.shutdown()
+
+
+def _crawler(node, path):
+    """A Crawler storing blocks in a ColumnarStore at path."""
+    return Crawler(start=False, rpc_port=node.port,
+        store=ColumnarStore(str(path), partition_blocks=10),
+        checkpoint_path=None, batch_size=4, flush_size=5)
+
+
+def _hashes(store):
+    return {r["number"]: r["hash"] for r in store.recentBlocks(10**6)}
+
+
+def _senders(store, start, end):
+    t = store.scanTransactions(["block", "from"], start, end)
+    return sorted(zip(t["block"].to_pylist(), t["from"].to_pylist()))
+
+
+def _mineLater(node, n=2, delay=0.1):
+    """Mine n blocks after a delay, while follow() is waiting."""
+    threading.Timer(delay, node.mine, [n]).start()
+
+
+def test_filter(node, tmp_path):
+    """New blocks are noticed through a block filter."""
+    c = _crawler(node, tmp_path)
+    follow = c.follow(poll_interval=0.01)
+    try:
+        assert next(follow) == 30
+        _mineLater(node)
+        assert next(follow) == 32
+        assert node.calls["eth_newBlockFilter"] == 1
+        assert node.calls["eth_getFilterChanges"] > 1
+        # Waiting costs one filter call per poll, plus eth_blockNumber only
+        # once the filter reports something
+        polled = node.calls["eth_blockNumber"]
+        _mineLater(node, 1, delay=0.2)
+        assert next(follow) == 33
+        assert node.calls["eth_blockNumber"] - polled <= 3
+        assert _hashes(c.store) == {n: node.hashOf(n) for n in range(1, 34)}
+    finally:
+        follow.close()
+
+
+def test_filter_reinstalled(node, tmp_path):
+    """A filter geth has dropped is replaced by a new one."""
+    c = _crawler(node, tmp_path)
+    follow = c.follow(poll_interval=0.01)
+    try:
+        assert next(follow) == 30
+        # As after geth restarts or expires the filter
+        node.filters.clear()
+        _mineLater(node)
+        assert next(follow) == 32
+        assert node.calls["eth_newBlockFilter"] == 2
+        assert len(node.filters) == 1
+        _mineLater(node)
+        assert next(follow) == 34
+        assert node.calls["eth_newBlockFilter"] == 2
+    finally:
+        follow.close()
+
+
+def test_polling(tmp_path):
+    """Without block filters, eth_blockNumber is polled instead."""
+    node = NoFilterGeth(blocks=30, txns=2)
+    server = _serve(node)
+    c = _crawler(node, tmp_path)
+    follow = c.follow(poll_interval=0.01)
+    try:
+        assert next(follow) == 30
+        _mineLater(node)
+        assert next(follow) == 32
+        assert node.calls["eth_newBlockFilter"] == 1
+        assert "eth_getFilterChanges" not in node.calls
+        assert node.calls["eth_blockNumber"] > 2
+        assert _hashes(c.store) == {n: node.hashOf(n) for n in range(1, 33)}
+    finally:
+        follow.close()
+        server.shutdown()
+
+
+def test_reorg(node, tmp_path):
+    """Orphaned blocks are rewritten and the listeners told where."""
+    c = _crawler(node, tmp_path)
+    reorgs = list()
+    c.onReorg(reorgs.append)
+    follow = c.follow(poll_interval=0.01, reorg_depth=8)
+    try:
+        assert next(follow) == 30
+        assert reorgs == []
+
+        node.reorg(27, mine=2)
+        assert next(follow) == 32
+        assert reorgs == [27]
+        assert _hashes(c.store) == {n: node.hashOf(n) for n in range(1, 33)}
+        assert _senders(c.store, 25, 33) == sorted(
+            (n, t["from"]) for n in range(25, 33)
+            for t in node.block(n)["transactions"])
+
+        # Deeper than the window (blocks 25-32): only the window is
+        # rewritten, and blocks below it are left as they were
+        node.reorg(20, mine=1)
+        assert next(follow) == 33
+        assert reorgs == [27, 25]
+        hashes = _hashes(c.store)
+        assert all(hashes[n] == node.hashOf(n) for n in range(25, 34))
+        assert all(hashes[n] != node.hashOf(n) for n in range(20, 25))
+    finally:
+        follow.close()
+
+
+def test_reorg_buffer(tmp_path):
+    """The window of hashes at and around its edges."""
+    def _block(n, parent=True):
+        return {"number": n, "hash": "h{}".format(n),
+            "parentHash": "h{}".format(n - 1) if parent else "x"}
+
+    tail = ReorgBuffer(depth=4)
+    assert tail.lowest() is None and tail.extends(_block(5, False))
+    for n in range(1, 7):
+        tail.push(_block(n))
+    assert list(tail.hashes) == [3, 4, 5, 6] and tail.lowest() == 3
+    assert tail.hashOf(2) is None and tail.hashOf(6) == "h6"
+
+    assert tail.extends(_block(7))
+    assert not tail.extends(_block(7, False))
+    # A block replacing one in the window is checked against its parent
+    assert tail.extends(_block(5)) and not tail.extends(_block(4, False))
+    # Below the window, or without a parent hash, blocks are assumed to fit
+    assert tail.extends(_block(3, False))
+    assert tail.extends({"number": 7, "hash": "h7"})
+
+    tail.rollback(10)
+    assert list(tail.hashes) == [3, 4, 5, 6]
+    tail.rollback(5)
+    assert list(tail.hashes) == [3, 4]
+    assert not tail.extends(_block(5, False))
+    tail.rollback(3)
+    assert tail.lowest() is None and tail.extends(_block(4, False))
+
+    # Loaded from the top of a store
+    store = ColumnarStore(str(tmp_path), partition_blocks=10)
+    store.insertMany([
+        dict(_block(n), timestamp=n, transactions=list())
+        for n in range(1, 13)
+    ])
+    tail.load(store)
+    assert list(tail.hashes) == [9, 10, 11, 12]
+    assert tail.extends(_block(13)) and not tail.extends(_block(13, False))
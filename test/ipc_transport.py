@@ -0,0 +1,91 @@
+"""Test JSON-RPC over a unix socket against a fake geth IPC server."""
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+sys.path.append("../Preprocessing/Crawler")
+from RPCClient import RPCClient
+
+HEAD = 1000
+
+
+def _answer(req):
+    """Answer a single JSON-RPC request like geth would."""
+    if req["method"] == "eth_blockNumber":
+        result = hex(HEAD)
+    elif req["method"] == "eth_getBlockByNumber":
+        result = {
+            "number": req["params"][0],
+            "timestamp": "0x56bfb41a",
+            "transactions": []
+        }
+    else:
+        return {"jsonrpc": "2.0", "id": req["id"],
+            "error": {"code": -32601, "message": "method not found"}}
+    return {"jsonrpc": "2.0", "id": req["id"], "result": result}
+
+
+def _serve(server):
+    """Serve each connection until it closes, replying in small pieces."""
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return
+        threading.Thread(target=_handle, args=(conn,), daemon=True).start()
+
+
+def _handle(conn):
+    decoder = json.JSONDecoder()
+    buf = ""
+    with conn:
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                return
+            buf += data.decode()
+            try:
+                req, end = decoder.raw_decode(buf)
+            except ValueError:
+                continue
+            buf = buf[end:].lstrip()
+            if isinstance(req, list):
+                res = [_answer(r) for r in reversed(req)]
+            else:
+                res = _answer(req)
+            out = (json.dumps(res) + "\n").encode()
+            # Split the reply so the client has to reassemble it
+            for i in range(0, len(out), 100):
+                conn.sendall(out[i:i + 100])
+
+
+def _startServer():
+    path = os.path.join(tempfile.mkdtemp(), "geth.ipc")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    threading.Thread(target=_serve, args=(server,), daemon=True).start()
+    return server, path
+
+
+def test_ipc_requests():
+    """Single and batched requests work (and reuse connections) over IPC."""
+    server, path = _startServer()
+    try:
+        rpc = RPCClient(ipc_path=path)
+        assert int(rpc.request("eth_blockNumber", []), 16) == HEAD
+
+        numbers = list(range(1, 51))
+        calls = [("eth_getBlockByNumber", [hex(n), True]) for n in numbers]
+        blocks = rpc.batch(calls)
+        assert [int(b["number"], 16) for b in blocks] == numbers
+
+        # The connection from the first request was kept and reused
+        assert rpc.transport._idle.qsize() == 1
+
+        # Errors are passed back as missing results
+        assert rpc.batch([("eth_nope", [])]) == [None]
+    finally:
+        server.close()
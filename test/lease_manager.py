@@ -0,0 +1,94 @@
+"""Test lease-based coordination of crawlers on a shared (mock) mongo."""
+import os
+import sys
+import threading
+import time
+os.environ.setdefault("BLOCKCHAIN_MONGO_DATA_DIR", ".")
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import crawler_util
+from Crawler import Crawler
+from LeaseManager import LeaseManager
+from mock_geth import MockGeth
+
+# A block the mock node sends garbage for, so it can never be stored
+BROKEN = 25
+
+
+class BrokenGeth(MockGeth):
+    """A mock node that answers block BROKEN with an empty object."""
+
+    def getBlockByNumber(self, n, full=True):
+        if n != "latest" and int(n, 16) == BROKEN:
+            return {}
+        return MockGeth.getBlockByNumber(self, n, full)
+
+
+def test_claim_expire_steal():
+    db = mongomock.MongoClient()["leases"]
+    a = LeaseManager(db, owner="a", lease_blocks=10, ttl=0.2)
+    b = LeaseManager(db, owner="b", lease_blocks=10, ttl=0.2)
+    a.ensureRanges(1, 30)
+    b.ensureRanges(1, 30)
+    assert db["crawl_leases"].count_documents({}) == 3
+
+    # Live leases are not handed out twice
+    lease_a = a.claim()
+    lease_b = b.claim()
+    assert (lease_a["_id"], lease_b["_id"]) == (0, 10)
+    assert a.renew(lease_a)
+
+    # Once a's lease expires, b takes it over and a can no longer use it
+    time.sleep(0.3)
+    stolen = b.claim()
+    assert stolen["_id"] == 0 and stolen["owner"] == "b"
+    assert not a.renew(lease_a)
+    assert not a.complete(lease_a)
+    assert b.complete(stolen)
+
+    # Released leases can be claimed straight away
+    b.release(lease_b)
+    assert a.claim()["_id"] == 10
+
+    # Growing the chain extends and reopens a partial last range
+    b.complete(b.claim())
+    a.ensureRanges(1, 35)
+    assert b.complete(b.claim())
+    a.ensureRanges(1, 38)
+    last = db["crawl_leases"].find_one({"_id": 30})
+    assert last["end"] == 38 and not last["done"]
+
+
+def test_two_crawlers():
+    """Ranges are only marked done once every block in them is stored."""
+    node = BrokenGeth(blocks=80, txns=3)
+    server = node.serve(port=0)
+    blocks = crawler_util.initMongo(mongomock.MongoClient())
+    try:
+        crawlers = [
+            Crawler(start=False, rpc_port=server.server_address[1],
+                mongo_client=blocks, checkpoint_path=None, flush_size=5)
+            for _ in range(2)
+        ]
+        completed = [0, 0]
+
+        def _run(i):
+            completed[i] = crawlers[i].runDistributed(
+                1, 60, lease_blocks=20, ttl=5)
+
+        threads = [threading.Thread(target=_run, args=(i,)) for i in (0, 1)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        server.shutdown()
+
+    leases = {
+        d["_id"]: d["done"]
+        for d in blocks.database["crawl_leases"].find()
+    }
+    assert leases == {0: True, 20: False, 40: True}
+    assert sum(completed) == 2
+    stored = sorted(d["number"] for d in blocks.find({}, {"number": 1}))
+    assert stored == [n for n in range(1, 60) if n != BROKEN]
@@ -0,0 +1,247 @@
+"""
+A fake geth JSON-RPC node serving deterministic synthetic blocks.
+
+Usage:
+------
+Run a node on port 8546 with 2000 blocks of 50 transactions each and 2ms of
+latency per request:
+
+    python3 mock_geth.py --port 8546 --blocks 2000 --txns 50 --latency 0.002
+
+Or start one from python:
+
+    node = MockGeth(blocks=2000, txns=50)
+    server = node.serve(port=0)     # port=0 picks a free port
+    ...
+    server.shutdown()
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockGeth(object):
+    """
+    Deterministic synthetic chain answering the JSON-RPC calls we use.
+
+    Parameters:
+    -----------
+    blocks <int> default 1000       # Height of the chain (eth_blockNumber)
+    txns <int> default 20           # Transactions per block
+    latency <float> default 0       # Seconds to sleep per HTTP request
+    n_addresses <int> default 5000  # Size of the address pool
+    contract_every <int> default 10 # Every Nth address has code
+    create_every <int> default 0    # Every Nth transaction creates a
+                                    # contract (0 for none)
+
+    Call reorg(n) to replace block n and the blocks above it with other
+    blocks (different hashes and transactions), as in a chain
+    reorganization.
+    """
+
+    def __init__(self, blocks=1000, txns=20, latency=0.0, n_addresses=5000,
+            contract_every=10, create_every=0):
+        """Initialize the chain."""
+        self.head = blocks
+        self.txns = txns
+        self.latency = latency
+        self.contract_every = contract_every
+        self.create_every = create_every
+        # Creation transaction hash --> address of the contract it created
+        self.created = dict()
+        self.new_contracts = set()
+        self.addresses = [
+            "0x" + hashlib.sha1(str(i).encode()).hexdigest()
+            for i in range(n_addresses)
+        ]
+        self._index = {a: i for i, a in enumerate(self.addresses)}
+        # Counts of calls by method, for checking how a client behaved
+        self.calls = dict()
+        self.lock = threading.Lock()
+        self.methods = {
+            "eth_blockNumber": self.blockNumber,
+            "eth_getBlockByNumber": self.getBlockByNumber,
+            "eth_getCode": self.getCode,
+            "eth_getTransactionReceipt": self.getTransactionReceipt,
+            "eth_newBlockFilter": self.newBlockFilter,
+            "eth_getFilterChanges": self.getFilterChanges,
+        }
+        # Block filters: filter id --> last head reported
+        self.filters = dict()
+        # The lowest block replaced by each reorg()
+        self.forks = list()
+
+    @staticmethod
+    def blockHash(n):
+        """A deterministic hash for block n."""
+        return "0x" + hashlib.sha256(str(n).encode()).hexdigest()
+
+    def version(self, n):
+        """The number of times block n has been replaced by reorg()."""
+        return sum(1 for f in self.forks if f <= n)
+
+    def hashOf(self, n):
+        """The hash of block n on the current chain."""
+        v = self.version(n)
+        return self.blockHash(n if not v else "{}/{}".format(n, v))
+
+    def block(self, n):
+        """Build block n (the same every time, until a reorg() replaces it)."""
+        return self._block(n, self.version(n))
+
+    @lru_cache(maxsize=4096)
+    def _block(self, n, v):
+        rng = random.Random(n if not v else "{}/{}".format(n, v))
+        txns = list()
+        for i in range(self.txns):
+            to = rng.choice(self.addresses)
+            h = self.blockHash("{}:{}".format(n, i) if not v else
+                "{}/{}:{}".format(n, v, i))
+            data = "0xa9059cbb" if self.isContract(to) else "0x"
+            if self.create_every and (n*self.txns + i) % self.create_every == 0:
+                to = None
+                data = "0x6060604052"
+                self.created[h] = "0x" + hashlib.sha1(h.encode()).hexdigest()
+                self.new_contracts.add(self.created[h])
+            txns.append({
+                "hash": h,
+                "nonce": hex(i),
+                "blockHash": self.hashOf(n),
+                "blockNumber": hex(n),
+                "transactionIndex": hex(i),
+                "from": rng.choice(self.addresses),
+                "to": to,
+                "value": hex(rng.randrange(10**21)),
+                "gas": "0x15f90",
+                "gasPrice": "0xba43b7400",
+                "input": data
+            })
+        return {
+            "number": hex(n),
+            "hash": self.hashOf(n),
+            "parentHash": self.hashOf(n - 1),
+            "timestamp": hex(1438269973 + 15*n),
+            "transactions": txns,
+            "uncles": []
+        }
+
+    def isContract(self, address):
+        """Whether an address has code."""
+        i = self._index.get(address)
+        if i is None:
+            return address in self.new_contracts
+        return i % self.contract_every == 0
+
+    def mine(self, n=1):
+        """Add n blocks to the head of the chain."""
+        with self.lock:
+            self.head += n
+
+    def reorg(self, n, mine=0):
+        """Replace blocks n to the head with other blocks, then mine more."""
+        with self.lock:
+            self.forks.append(n)
+            self.head += mine
+
+    # JSON-RPC methods
+    # ----------------
+    def blockNumber(self):
+        return hex(self.head)
+
+    def getBlockByNumber(self, n, full=True):
+        n = self.head if n == "latest" else int(n, 16)
+        if n < 0 or n > self.head:
+            return None
+        return self.block(n)
+
+    def getCode(self, address, tag="latest"):
+        return "0x6060604052" if self.isContract(address) else "0x"
+
+    def getTransactionReceipt(self, h):
+        return {
+            "transactionHash": h,
+            "contractAddress": self.created.get(h),
+            "status": "0x1"
+        }
+
+    def newBlockFilter(self):
+        with self.lock:
+            fid = hex(len(self.filters) + 1)
+            self.filters[fid] = self.head
+        return fid
+
+    def getFilterChanges(self, fid):
+        with self.lock:
+            last = self.filters[fid]
+            self.filters[fid] = self.head
+            return [self.hashOf(n) for n in range(last + 1, self.head + 1)]
+
+    def handle(self, req):
+        """Answer one JSON-RPC request dict."""
+        method = req.get("method")
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        res = {"jsonrpc": "2.0", "id": req.get("id")}
+        if method not in self.methods:
+            res["error"] = {"code": -32601, "message": "method not found"}
+            return res
+        try:
+            res["result"] = self.methods[method](*req.get("params", []))
+        except KeyError:
+            res["error"] = {"code": -32000, "message": "filter not found"}
+        return res
+
+    def serve(self, port=8545, host="localhost"):
+        """Serve on a background thread. Returns the HTTP server."""
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                req = json.loads(body)
+                if node.latency:
+                    time.sleep(node.latency)
+                if isinstance(req, list):
+                    res = [node.handle(r) for r in req]
+                else:
+                    res = node.handle(req)
+                out = json.dumps(res).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--txns", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    node = MockGeth(args.blocks, args.txns, args.latency)
+    server = node.serve(args.port)
+    print("Mock geth serving {} blocks on port {}".format(
+        args.blocks, server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
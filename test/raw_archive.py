@@ -0,0 +1,81 @@
+"""Test the block archive's index and segment handling."""
+import multiprocessing
+import os
+import sys
+sys.path.append("../Preprocessing/Crawler")
+from RawArchive import INDEX_RECORD, RawArchive
+
+
+def _data(n, copy=0):
+    return '{{"number": "{}", "copy": {}}}'.format(hex(n), copy).encode()
+
+
+def test_newest_copy_wins(tmp_path):
+    path = str(tmp_path / "raw")
+    archive = RawArchive(path, segment_bytes=64)
+    for n in range(1, 11):
+        archive.append(n, _data(n))
+    # Rewrites (e.g. after a reorg) land in later segments
+    archive.append(3, _data(3, copy=1))
+    archive.append(7, _data(7, copy=1))
+    archive.append(3, _data(3, copy=2))
+    archive.flush()
+    assert len(os.listdir(path)) > 3
+
+    for a in (archive, RawArchive(path, segment_bytes=64)):
+        assert a.get(3) == _data(3, copy=2)
+        assert a.get(7) == _data(7, copy=1)
+        assert a.get(5) == _data(5)
+        assert a.get(11) is None and 11 not in a and 10 in a
+        assert a.numbers().tolist() == list(range(1, 11))
+        assert [n for n, _ in a.iterate(2, 8)] == list(range(2, 8))
+        assert dict(a.iterate())[3] == _data(3, copy=2)
+    archive.close()
+
+
+def test_truncated_index(tmp_path):
+    """A torn index record is dropped so new records stay aligned."""
+    path = str(tmp_path / "raw")
+    archive = RawArchive(path)
+    archive.append(1, _data(1))
+    archive.close()
+    with open(os.path.join(path, "index.dat"), "ab") as f:
+        f.write(b"\1" * (INDEX_RECORD.size // 2))
+
+    archive = RawArchive(path)
+    archive.append(2, _data(2))
+    archive.flush()
+    assert archive.numbers().tolist() == [1, 2]
+    assert archive.get(2) == _data(2)
+    archive.close()
+
+
+def _appendMany(path, first, n):
+    """Append blocks first..first+n to an archive (runs in a subprocess)."""
+    archive = RawArchive(path, segment_bytes=4096)
+    for i in range(n):
+        archive.append(first + i, _data(first + i, copy=first))
+        if i % 50 == 49:
+            archive.flush()
+    archive.close()
+
+
+def test_processes_share_archive(tmp_path):
+    """Records written by several processes point at their own bytes."""
+    path = str(tmp_path / "raw")
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=_appendMany, args=(path, first, 300))
+        for first in (1, 1001)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert [p.exitcode for p in procs] == [0, 0]
+
+    archive = RawArchive(path)
+    numbers = list(range(1, 301)) + list(range(1001, 1301))
+    assert archive.numbers().tolist() == numbers
+    for n in numbers:
+        assert archive.get(n) == _data(n, copy=1 if n < 1001 else 1001)
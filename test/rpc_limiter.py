@@ -0,0 +1,60 @@
+"""Test that the adaptive limiter only backs off when geth slows down."""
+import json
+import sys
+import time
+sys.path.append("../Preprocessing/Crawler")
+from RPCClient import AdaptiveLimiter, RPCClient
+
+
+class SlowTransport(object):
+    """Answer like geth, taking a fixed time per request in the payload."""
+
+    retry_errors = (OSError,)
+
+    def __init__(self, per_request):
+        # method --> seconds per request
+        self.per_request = per_request
+
+    def send(self, data):
+        payload = json.loads(data)
+        calls = payload if isinstance(payload, list) else [payload]
+        time.sleep(sum(self.per_request[c["method"]] for c in calls))
+        out = [{"id": c["id"], "result": "0x1"} for c in calls]
+        return out if isinstance(payload, list) else out[0]
+
+
+def test_mixed_calls_keep_limit():
+    """Cheap single calls do not make big batches look like overload."""
+    rpc = RPCClient()
+    rpc.transport = SlowTransport({
+        "eth_blockNumber": 0.0005,
+        "eth_getBlockByNumber": 0.0002
+    })
+    start = rpc.limiter.limit
+    for _ in range(5):
+        rpc.request("eth_blockNumber", [])
+    for _ in range(20):
+        rpc.batch([
+            ("eth_getBlockByNumber", [hex(n), True]) for n in range(100)])
+        rpc.request("eth_blockNumber", [])
+    assert rpc.limiter.limit >= start
+
+
+def test_slowdown_cuts_limit():
+    """Requests much slower than usual for their kind shrink the limit."""
+    limiter = AdaptiveLimiter(initial=16)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(latency=0.01, key="eth_getBlockByNumber", size=10)
+    before = limiter.limit
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(latency=0.5, key="eth_getBlockByNumber", size=10)
+    assert limiter.limit < before / 2
+
+
+def test_errors_cut_limit():
+    limiter = AdaptiveLimiter(initial=8)
+    limiter.acquire()
+    limiter.release(error=True)
+    assert limiter.limit == 4
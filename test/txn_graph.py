@@ -0,0 +1,293 @@
+"""Test TxnGraph's bulk build, collapsed edges, checkpoints and CSR export."""
+import os
+import random
+import sys
+sys.path.append("../Analysis")
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import numpy as np
+import pytest
+pytest.importorskip("graph_tool")
+import crawler_util
+import TxnGraph
+from AddressTable import AddressTable
+from CSRSnapshot import CSRSnapshot
+
+STEP = 60
+
+
+def _makeBlocks(n=400, seed=3):
+    """Random blocks with repeated pairs, self sends and creations."""
+    rng = random.Random(seed)
+    addresses = ["0x%040x" % i for i in range(200)]
+    blocks = list()
+    for number in range(1, n + 1):
+        txns = list()
+        for _ in range(rng.randrange(15)):
+            frm = rng.choice(addresses)
+            to = rng.choice(addresses) if rng.random() > 0.05 else frm
+            if rng.random() < 0.02:
+                to = None
+            txns.append({
+                "from": frm,
+                "to": to,
+                "value": rng.random()*10**rng.randrange(-3, 4),
+                "data": "0xab" if rng.random() < 0.2 else "0x"
+            })
+        blocks.append(
+            {"number": number, "timestamp": 1000 + number,
+             "transactions": txns})
+    return blocks
+
+
+@pytest.fixture
+def chain(tmp_path, monkeypatch):
+    """Blocks in a mock mongo (every other one compact) read by TxnGraph."""
+    blocks = _makeBlocks()
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    client.insert_many([
+        crawler_util.compactBlock(b) if b["number"] % 2 else dict(b)
+        for b in blocks
+    ])
+    monkeypatch.setattr(TxnGraph, "DATADIR", str(tmp_path / "data"))
+    monkeypatch.setattr(TxnGraph.TxnGraph, "_getMongoClient",
+        lambda self: (self._updateTimestamps(client), None))
+    table = AddressTable(str(tmp_path / "addresses"))
+    # Ids that do not follow the order addresses appear in
+    table.intern(["0x%040x" % i for i in range(199, 150, -1)])
+    return blocks, table
+
+
+def _reference(blocks, ranges):
+    """
+    Build the graph one transaction at a time, as TxnGraph used to.
+
+    Returns:
+    --------
+    <tuple> (addresses of the vertices in order, (from, to, value) edges,
+    vertex balances, contracts)
+    """
+    vertices = dict()
+    addresses = list()
+    balances = list()
+    edges = list()
+    contracts = list()
+
+    def _vertex(a):
+        if a not in vertices:
+            vertices[a] = len(addresses)
+            addresses.append(a or "")
+            balances.append(0.0)
+            return vertices[a], True
+        return vertices[a], False
+
+    for start, end in ranges:
+        for b in blocks:
+            if not start < b["number"] < end:
+                continue
+            for t in b["transactions"]:
+                if t["to"] == t["from"]:
+                    continue
+                to, new = _vertex(t["to"])
+                if new and t["data"] != "0x":
+                    contracts.append(t["to"])
+                frm, _ = _vertex(t["from"])
+                edges.append((frm, to, t["value"]))
+                balances[to] += t["value"]
+                balances[frm] -= t["value"]
+    return addresses, edges, balances, contracts
+
+
+def _edges(g):
+    """The (from, to, weight[, count]) rows of a TxnGraph, sorted."""
+    eprops = [g.edgeWeights] + ([g.edgeCounts] if g.collapse else [])
+    rows = g.graph.get_edges(eprops).reshape(-1, 2 + len(eprops))
+    return sorted(tuple(r) for r in rows.tolist())
+
+
+def _state(g):
+    return {
+        "addresses": [g.addresses[v] for v in g.graph.vertices()],
+        "ids": g.addressIds.a.tolist(),
+        "balances": g.vertexWeights.a.tolist(),
+        "edges": _edges(g),
+        "contracts": list(g.contracts),
+        "end": (g.end_block, g.end_timestamp)
+    }
+
+
+def test_bulk_matches_per_edge(chain):
+    blocks, table = chain
+    g = TxnGraph.TxnGraph(1, STEP, address_table=table, save=False)
+    for _ in range(3):
+        g.extend(STEP, save=False)
+    ranges = [(1, STEP)] + [(STEP*i, STEP*(i + 1)) for i in range(1, 4)]
+    addresses, edges, balances, contracts = _reference(blocks, ranges)
+
+    assert [g.addresses[v] for v in g.graph.vertices()] == addresses
+    assert _edges(g) == sorted(edges)
+    assert g.vertexWeights.a.tolist() == balances
+    assert g.contracts == contracts
+    # Vertices are tied to their ids in the shared table
+    assert g.addressIds.a.tolist() == \
+        table.lookup([a or None for a in addresses]).tolist()
+    assert int(g.vertex(addresses[5])) == 5
+
+
+def test_collapsed_matches_aggregate(chain):
+    """One edge per pair, holding the sum and count of its transactions."""
+    blocks, table = chain
+    plain = TxnGraph.TxnGraph(1, STEP, address_table=table, save=False)
+    collapsed = TxnGraph.TxnGraph(
+        1, STEP, address_table=table, save=False, collapse=True)
+    for _ in range(5):
+        plain.extend(STEP, save=False)
+        collapsed.extend(STEP, save=False)
+
+    totals = dict()
+    for frm, to, w in _edges(plain):
+        s, n = totals.get((frm, to), (0.0, 0))
+        totals[(frm, to)] = (s + w, n + 1)
+    rows = _edges(collapsed)
+    assert [r[:2] for r in rows] == sorted(totals)
+    for frm, to, w, n in rows:
+        assert n == totals[(frm, to)][1]
+        assert w == pytest.approx(totals[(frm, to)][0])
+    assert collapsed.vertexWeights.a.tolist() == plain.vertexWeights.a.tolist()
+    # The pair index stays sorted and points at the right edges
+    assert (np.diff(collapsed.pairs) > 0).all()
+    edges = collapsed.graph.get_edges()
+    assert sorted(collapsed.pairs.tolist()) == sorted(
+        (int(a) << 32 | int(b)) for a, b in edges)
+
+
+@pytest.mark.parametrize("collapse", [False, True])
+def test_checkpoints_round_trip(chain, collapse):
+    """Any checkpointed state rebuilds from a base plus deltas."""
+    blocks, table = chain
+    g = TxnGraph.TxnGraph(1, STEP, address_table=table, compact_every=2,
+        collapse=collapse)
+    ref = TxnGraph.TxnGraph(1, STEP, address_table=table, save=False,
+        collapse=collapse)
+    states = {STEP: _state(ref)}
+    for _ in range(5):
+        g.extend(STEP)
+        ref.extend(STEP, save=False)
+        states[ref.end_block] = _state(ref)
+        assert _state(g) == states[g.end_block]
+    names = os.listdir(g._checkpointDir())
+    assert any(n.startswith("base_") for n in names)
+
+    for end, state in states.items():
+        h = TxnGraph.TxnGraph(1, end, address_table=table, load=True,
+            collapse=collapse)
+        assert _state(h) == state
+
+    # Resume after the last two checkpoints were lost, then keep going
+    d = g._checkpointDir()
+    for x in (4*STEP, 5*STEP):
+        for name in os.listdir(d):
+            if name.startswith("delta_{}_{}_".format(x, x + STEP)):
+                os.remove(os.path.join(d, name))
+    r = TxnGraph.TxnGraph(1, 4*STEP, address_table=table, resume=True,
+        collapse=collapse)
+    assert _state(r) == states[4*STEP]
+    r = TxnGraph.TxnGraph(1, 5*STEP, address_table=table, resume=True,
+        collapse=collapse)
+    assert _state(r) == states[5*STEP]
+
+    # A fresh build leaves the existing checkpoints alone
+    TxnGraph.TxnGraph(1, STEP, address_table=table, collapse=collapse)
+    h = TxnGraph.TxnGraph(1, 3*STEP, address_table=table, load=True,
+        collapse=collapse)
+    assert _state(h) == states[3*STEP]
+
+
+def test_checkpoint_lineages(chain):
+    """Deltas are only applied to the state they were built on."""
+    blocks, table = chain
+    g = TxnGraph.TxnGraph(1, STEP, address_table=table)
+    for _ in range(3):
+        g.extend(STEP)
+    # A fresh build through 2.5*STEP reaches 3*STEP in another state, with
+    # blocks STEP and 2*STEP but not 2.5*STEP
+    fresh = TxnGraph.TxnGraph(1, int(2.5*STEP), address_table=table)
+    fresh.extend(int(0.5*STEP))
+
+    # Only g's deltas lead on to 4*STEP
+    h = TxnGraph.TxnGraph(1, 4*STEP, address_table=table, load=True)
+    assert _state(h) == _state(g)
+
+    # Now both do, and each goes on from its own state
+    fresh.extend(STEP)
+    ref = TxnGraph.TxnGraph(1, int(2.5*STEP), address_table=table,
+        save=False)
+    ref.extend(int(0.5*STEP), save=False)
+    ref.extend(STEP, save=False)
+    assert _state(fresh) == _state(ref)
+    h = TxnGraph.TxnGraph(1, 4*STEP, address_table=table, load=True)
+    assert _state(h) in (_state(g), _state(ref))
+
+
+def test_checkpoint_paths(chain):
+    """The state at a block is found even if the longest jump misses it."""
+    blocks, table = chain
+    g = TxnGraph.TxnGraph(1, STEP, address_table=table, save=False)
+    g.extend(STEP, save=False)
+    g.checkpoint()
+    g.extend(STEP)
+    state = _state(g)
+    # A longer jump from STEP to past 3*STEP leads nowhere
+    h = TxnGraph.TxnGraph(1, STEP, address_table=table, save=False)
+    h.checkpoint()
+    h.extend(int(2.5*STEP))
+
+    r = TxnGraph.TxnGraph(1, 3*STEP, address_table=table, load=True)
+    assert _state(r) == state
+    # Resuming goes on from the latest state, wherever it came from
+    r = TxnGraph.TxnGraph(1, 4*STEP, address_table=table, resume=True)
+    h.extend(int(0.5*STEP), save=False)
+    assert _state(r) == _state(h)
+
+
+def test_vertex_map(chain):
+    """The id --> vertex map grows by doubling and is rebuilt on load."""
+    blocks, table = chain
+    g = TxnGraph.TxnGraph(1, STEP, address_table=table, compact_every=1)
+    sizes = {len(g.vertex_map)}
+    for _ in range(5):
+        g.extend(STEP)
+        sizes.add(len(g.vertex_map))
+        assert len(g.vertex_map) >= len(table) + 1
+    assert len(sizes) <= 3
+
+    h = TxnGraph.TxnGraph(1, 6*STEP, address_table=table, load=True)
+    used = np.flatnonzero(g.vertex_map >= 0)
+    assert np.flatnonzero(h.vertex_map >= 0).tolist() == used.tolist()
+    assert h.vertex_map[used].tolist() == g.vertex_map[used].tolist()
+    assert all(int(h.vertex(a)) == i for i, a in enumerate(
+        _state(g)["addresses"][:20]) if a)
+
+
+@pytest.mark.parametrize("collapse", [False, True])
+def test_csr_round_trip(chain, collapse):
+    blocks, table = chain
+    g = TxnGraph.TxnGraph(1, 399, address_table=table, save=False,
+        collapse=collapse)
+    s = CSRSnapshot(g.exportCSR())
+    assert (s.num_vertices, s.num_edges) == \
+        (g.graph.num_vertices(), g.graph.num_edges())
+    columns = [s.sources(), s.targets, s.weights]
+    if collapse:
+        columns.append(s.counts)
+    assert sorted(zip(*[c.tolist() for c in columns])) == _edges(g)
+    assert s.balances.tolist() == g.vertexWeights.a.tolist()
+    assert s.address_ids.tolist() == g.addressIds.a.tolist()
+    assert (s.start_block, s.end_block) == (1, 399)
+    assert s.address_table.path == os.path.realpath(table.path)
+
+    h = s.toGraph()
+    assert sorted(map(tuple, h.get_edges().tolist())) == \
+        sorted(map(tuple, g.graph.get_edges().tolist()))
+    assert [h.vertex_properties["address"][v] for v in h.vertices()] == \
+        [g.addresses[v] for v in g.graph.vertices()]
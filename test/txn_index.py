@@ -0,0 +1,122 @@
+"""Test the per-address queries on the flat transaction collection."""
+import sys
+sys.path.append("../Preprocessing/Crawler")
+import mongomock
+import crawler_util
+from TxnIndex import TxnIndex
+
+A, B, C = ("0x%040x" % i for i in (1, 2, 3))
+
+
+def _blocks():
+    """Blocks 1-6, where A sends, receives and sends to itself."""
+    pattern = {
+        1: [(A, B), (B, C)],
+        2: [(B, A), (A, C), (C, B)],
+        3: [],
+        4: [(C, B), (A, A), (B, A)],
+        5: [(B, C)],
+        6: [(A, B), (C, A)]
+    }
+    return [
+        {"number": n, "timestamp": 1000 + n, "transactions": [
+            {"from": f, "to": t, "value": n + i/10., "data": "0x"}
+            for i, (f, t) in enumerate(txns)
+        ]}
+        for n, txns in sorted(pattern.items())
+    ]
+
+
+def _index(blocks=None):
+    db = mongomock.MongoClient()["blockchain"]
+    index = TxnIndex(db)
+    assert index.insert(blocks or _blocks()) == []
+    return index
+
+
+def _keys(cursor):
+    return [(t["block"], t["i"]) for t in cursor]
+
+
+def _expected(test, start=1, end=7):
+    """The (block, i) of the transactions passing test, in chain order."""
+    return [
+        (b["number"], i) for b in _blocks() if start <= b["number"] < end
+        for i, t in enumerate(b["transactions"]) if test(t)
+    ]
+
+
+def test_sent_and_received():
+    index = _index()
+    assert _keys(index.sent(A)) == _expected(lambda t: t["from"] == A)
+    assert _keys(index.received(A)) == _expected(lambda t: t["to"] == A)
+    # [start, end) in blocks, with a limit and only some columns
+    assert _keys(index.sent(A, 2, 6)) == \
+        _expected(lambda t: t["from"] == A, 2, 6)
+    assert _keys(index.received(B, start=4)) == \
+        _expected(lambda t: t["to"] == B, 4)
+    assert _keys(index.sent(A, limit=2)) == \
+        _expected(lambda t: t["from"] == A)[:2]
+    t = next(index.sent(A, columns=["block", "i", "to"]))
+    assert t == {"block": 1, "i": 0, "to": B}
+    assert list(index.sent("0x" + "ff"*20)) == []
+
+
+def test_history():
+    """The union of sent and received, each transaction once, in order."""
+    index = _index()
+    involves = lambda t: A in (t["from"], t["to"])
+    assert _keys(index.history(A)) == _expected(involves)
+    # The self send at (4, 1) is in both branches but listed once
+    assert _keys(index.history(A)).count((4, 1)) == 1
+    assert _keys(index.history(A, 2, 5)) == _expected(involves, 2, 5)
+    assert _keys(index.history(A, end=2)) == [(1, 0)]
+    assert _keys(index.history(A, start=4, limit=3)) == \
+        _expected(involves, 4)[:3]
+    t = list(index.history(C, columns=["value"]))[0]
+    assert set(t) == {"value"} and t["value"] == 1.1
+
+
+def test_block_range():
+    index = _index()
+    txns = list(index.blockRange(2, 5))
+    assert _keys(txns) == _expected(lambda t: True, 2, 5)
+    assert txns[0] == {"block": 2, "i": 0, "timestamp": 1002, "from": B,
+        "to": A, "value": 2.0, "data": "0x"}
+    assert list(index.blockRange(3, 4)) == []
+    txns = list(index.blockRange(4, 7, ["from", "to"]))
+    assert [(t["from"], t["to"]) for t in txns] == \
+        [(C, B), (A, A), (B, A), (B, C), (A, B), (C, A)]
+
+
+def test_insert_and_replace():
+    """Indexing a block again is harmless; replacing it drops the old rows."""
+    blocks = _blocks()
+    index = _index(blocks[:4])
+    assert index.insert(blocks[2:]) == []
+    assert _keys(index.blockRange(1, 7)) == _expected(lambda t: True)
+
+    fork = dict(blocks[3], transactions=[
+        {"from": B, "to": C, "value": 9.0, "data": "0x"}])
+    assert index.replace([fork]) == []
+    assert [(t["from"], t["to"]) for t in index.blockRange(4, 5)] == [(B, C)]
+    assert (4, 1) not in _keys(index.history(A))
+
+
+def test_backfill():
+    """Stored blocks are indexed, whichever schema they were stored in."""
+    blocks = _blocks()
+    client = crawler_util.initMongo(mongomock.MongoClient())
+    client.insert_many([
+        crawler_util.compactBlock(b) if b["number"] % 2 else dict(b)
+        for b in blocks
+    ])
+    index = TxnIndex(client.database)
+    assert index.backfill(client, 2, 6, batch=2) == []
+    assert _keys(index.blockRange(1, 7)) == _expected(lambda t: True, 2, 6)
+    assert index.backfill(client) == []
+    assert _keys(index.history(A)) == \
+        _expected(lambda t: A in (t["from"], t["to"]))
+    assert [t["value"] for t in index.sent(A)] == [
+        t["value"] for b in blocks for t in b["transactions"]
+        if t["from"] == A]